@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Line framing benchmark
+======================
+
+Splits a netsplit sized burst of NAMES/WHO replies, received in 4 KB
+chunks, in lines with the old recursive `check_buffer` implementation,
+and with :class:`luckybot.connections.base.LineBuffer`.
+
+Usage: python benchmarks/line_framing.py [lines] [chunk size]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from luckybot.connections.base import LineBuffer
+
+class OldFraming(object):
+	"""
+		The recursive implementation, as it was before
+	"""
+
+	def __init__(self):
+		self.buffer = ""
+		self.lines = 0
+
+	def recv(self, data):
+		self.buffer += data
+		self.check_buffer()
+
+	def handle_line(self, line):
+		# Stands in for emitting the line to the protocol
+		self.lines += 1
+
+	def check_buffer(self):
+		pos = self.buffer.find("\n")
+
+		if pos != -1:
+			self.handle_line(self.buffer[0:pos+1])
+
+			self.buffer = self.buffer[pos+1:]
+
+			if self.buffer.find("\n") != -1:
+				self.check_buffer()
+
+def create_chunks(num, chunk_size):
+	"""
+		Creates WHO and NAMES replies, and cuts them in chunks like a
+		socket recv would
+	"""
+
+	lines = []
+	for i in range(num):
+		if i % 2:
+			lines.append(":irc.example.net 352 LuckyBot #channel ~ident%d host-%d.example.net irc.example.net user%d H :0 Real Name\r\n" % (i, i, i))
+		else:
+			lines.append(":irc.example.net 353 LuckyBot = #channel :user%d @op%d +voice%d\r\n" % (i, i, i))
+
+	data = "".join(lines)
+
+	return [data[i:i+chunk_size] for i in range(0, len(data), chunk_size)]
+
+def main():
+	num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+
+	chunks = create_chunks(num_lines, chunk_size)
+	print "%d lines in %d chunks of %d bytes" % (num_lines, len(chunks), chunk_size)
+
+	old = OldFraming()
+	start = time.time()
+	try:
+		for chunk in chunks:
+			old.recv(chunk)
+	except RuntimeError as e:
+		print "Recursive check_buffer failed: %s" % e
+	old_time = time.time() - start
+	print "%-22s %8.3f s  %10.1f lines/s" % ('recursive', old_time, old.lines / old_time)
+
+	buffer = LineBuffer()
+	lines = 0
+	start = time.time()
+	for chunk in chunks:
+		lines += len(buffer.feed(chunk))
+	new_time = time.time() - start
+	print "%-22s %8.3f s  %10.1f lines/s" % ('LineBuffer', new_time, lines / new_time)
+
+	print "Speedup: %.1fx" % (old_time / new_time)
+
+	# A single large read holding a complete burst
+	old = OldFraming()
+	try:
+		old.recv("".join(chunks[:200]))
+	except RuntimeError as e:
+		print "Recursive check_buffer on a %d byte read: %s" % (200 * chunk_size, e)
+
+if __name__ == '__main__':
+	main()
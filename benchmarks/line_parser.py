@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+IRC line parser benchmark
+=========================
+
+Parses a netsplit sized burst of JOIN/QUIT lines with the old regexp
+based parser (which parsed each line twice, once in the protocol and
+once for the plugins), and with :meth:`luckybot.protocols.irc.IRCProtocol.parse_line`.
+
+Usage: python benchmarks/line_parser.py [lines]
+"""
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from luckybot.protocols.irc import IRCProtocol
+
+class DummyServer(object):
+	info = {'prefix': '!'}
+
+	def add_listener(self, name, callback):
+		pass
+
+def old_parse_line(data, cmd_prefix='!'):
+	"""
+		The regexp based parser, as it was before
+	"""
+
+	if len(data) == 0:
+		return None
+
+	if data[0] == ':':
+		regexp = re.compile(r'\:(.*?) ([a-z0-9]+) (.*?)\r?\n', re.I)
+		match = regexp.match(data)
+
+		message_from = match.group(1)
+		command = match.group(2)
+		params = match.group(3).strip()
+
+		if message_from.find("@") != -1:
+			regexp2 = re.compile(r'(.*?)!(.*?)@(.*?)$')
+			match2 = regexp2.match(message_from)
+
+			regexp = re.compile(r'#([^ ]+)')
+
+			match = regexp.match(params)
+			if match:
+				channel = '#%s' % match.group(1)
+			else:
+				channel = match2.group(1)
+
+			args = {
+				'sender': message_from,
+				'command': command,
+				'params': params,
+				'nick': match2.group(1),
+				'realname': match2.group(2),
+				'hostname': match2.group(3),
+				'message': params[params.find(':')+1:],
+				'channel': channel
+			}
+
+			message = args['message']
+			if command == 'PRIVMSG' and message[0:len(cmd_prefix)] == cmd_prefix:
+				space_pos = message.find(' ', len(cmd_prefix))
+				if space_pos == -1:
+					space_pos = len(message)
+
+				args['bot_command'] = message[len(cmd_prefix):space_pos]
+				args['bot_args'] = message[space_pos+1:]
+
+			return args
+		else:
+			return {
+				'sender': message_from,
+				'command': command,
+				'params': params,
+				'message': params[params.find(':')+1:]
+			}
+	else:
+		return {'raw': data}
+
+def create_lines(num):
+	"""
+		Creates a netsplit: a QUIT for each user, followed by the JOIN
+		when the servers are linked again
+	"""
+
+	lines = []
+	for i in range(num / 2):
+		lines.append(":user%d!~ident%d@host-%d.example.net QUIT :irc.hub.net irc.leaf.net\r\n" % (i, i, i))
+
+	for i in range(num - num / 2):
+		lines.append(":user%d!~ident%d@host-%d.example.net JOIN :#channel%d\r\n" % (i, i, i, i % 20))
+
+	return lines
+
+def main():
+	num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	lines = create_lines(num_lines)
+	protocol = IRCProtocol(DummyServer())
+
+	print "Netsplit of %d lines" % num_lines
+
+	start = time.time()
+	for line in lines:
+		old_parse_line(line)
+		old_parse_line(line)
+	old = time.time() - start
+	print "%-22s %8.3f s  %10.1f lines/s" % ('regexp, parsed twice', old, num_lines / old)
+
+	start = time.time()
+	for line in lines:
+		protocol.parse_line(line).nick
+		protocol.parse_line(line).channel
+	new = time.time() - start
+	print "%-22s %8.3f s  %10.1f lines/s" % ('partition, parsed once', new, num_lines / new)
+
+	print "Speedup: %.1fx" % (old / new)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Regexp handler dispatch benchmark
+=================================
+
+Compares matching incoming lines against regexp handlers the old way
+(compiling and matching each pattern for each line), matching each
+precompiled pattern, and the combined
+:class:`luckybot.plugin.regexps.RegexpScanner`.
+
+With more handlers than fit in the cache of the :mod:`re` module (100
+patterns), the old way recompiles every pattern for every line and takes
+a few minutes.
+
+Usage: python benchmarks/regexp_dispatch.py [lines] [handlers]
+"""
+
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from luckybot.plugin.decorators import regexpmessage
+from luckybot.plugin.regexps import RegexpScanner
+
+def create_handlers(num):
+	"""
+		Creates a number of regexp handlers with a mix of pattern styles
+	"""
+
+	handlers = []
+	for i in range(num):
+		if i % 4 == 0:
+			pattern, flags = r'.*?\bkeyword%d\b' % i, re.I
+		elif i % 4 == 1:
+			pattern, flags = r'(?P<url>https?://\S+/item%d)' % i, 0
+		elif i % 4 == 2:
+			pattern, flags = r'(\w+)%d(\w+) is (.*)' % i, 0
+		else:
+			pattern, flags = r'\s*ping%d\s*$' % i, re.I
+
+		def handler(event, match):
+			pass
+
+		handlers.append(regexpmessage(pattern, flags)(handler))
+
+	return handlers
+
+def create_lines(num, num_handlers):
+	"""
+		Creates chat lines, a small part of them triggers a handler
+	"""
+
+	random.seed(42)
+	words = ['hello', 'world', 'luckybot', 'irc', 'python', 'channel', 'is', 'the']
+
+	lines = []
+	for i in range(num):
+		line = ' '.join(random.choice(words) for j in range(random.randint(3, 12)))
+		if i % 50 == 0:
+			line += ' keyword%d' % (random.randrange(num_handlers / 4) * 4)
+
+		lines.append(line)
+
+	return lines
+
+def dispatch_old(handlers, lines):
+	results = 0
+	for line in lines:
+		for function in handlers:
+			regexp = re.compile(function.pattern, function.modifiers)
+			if regexp.match(line):
+				results += 1
+
+	return results
+
+def dispatch_precompiled(handlers, lines):
+	results = 0
+	for line in lines:
+		for function in handlers:
+			if function.regexp.match(line):
+				results += 1
+
+	return results
+
+def dispatch_scanner(handlers, lines):
+	scanner = RegexpScanner()
+	scanner.add(handlers)
+
+	results = 0
+	for line in lines:
+		results += len(scanner.match(line))
+
+	return results
+
+def main():
+	num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+	num_handlers = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+	handlers = create_handlers(num_handlers)
+	lines = create_lines(num_lines, num_handlers)
+
+	print "%d lines against %d handlers" % (num_lines, num_handlers)
+
+	timings = []
+	for name, func in (('compile per line', dispatch_old),
+			('precompiled', dispatch_precompiled), ('combined scanner', dispatch_scanner)):
+		start = time.time()
+		results = func(handlers, lines)
+		elapsed = time.time() - start
+		timings.append(elapsed)
+
+		print "%-20s %8.3f s  %8.1f lines/s  %d matches" % (name, elapsed,
+			num_lines / elapsed, results)
+
+	print "Speedup: %.1fx over compile per line, %.1fx over precompiled" % (
+		timings[0] / timings[2], timings[1] / timings[2])
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Transport throughput benchmark
+==============================
+
+Moves data received in 4 KB chunks from a child process to the parent,
+once through a :class:`multiprocessing.Queue` like
+:class:`luckybot.network.multiprocess.MultiProcessSocket` does, and once
+through a :class:`luckybot.network.ringbuffer.RingBuffer` like
+:class:`luckybot.network.multiprocess.RingSocket` does. The parent waits
+in select for the queue pipe or the doorbell, like the reactor.
+
+Usage: python benchmarks/transport_throughput.py [megabytes] [chunk size]
+"""
+
+import os
+import select
+import sys
+import time
+from multiprocessing import Process, Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from luckybot.network.ringbuffer import RingBuffer
+
+def queue_producer(queue, chunk, count):
+	for i in range(count):
+		queue.put(chunk)
+
+	queue.put(None)
+
+def ring_producer(ring, chunk, count):
+	for i in range(count):
+		data = chunk
+		while data:
+			written = ring.write(data)
+			data = data[written:]
+
+			if data:
+				ring.wait_for_space()
+
+	ring.close()
+
+def run_queue(chunk, count):
+	queue = Queue()
+	process = Process(target=queue_producer, args=(queue, chunk, count))
+
+	start = time.time()
+	process.start()
+
+	received = 0
+	fd = queue._reader.fileno()
+	while True:
+		select.select([fd], [], [], 1.0)
+		data = queue.get()
+		if data is None:
+			break
+
+		received += len(data)
+
+	elapsed = time.time() - start
+	process.join()
+
+	return received, elapsed
+
+def run_ring(chunk, count):
+	ring = RingBuffer()
+	process = Process(target=ring_producer, args=(ring, chunk, count))
+
+	start = time.time()
+	process.start()
+
+	received = 0
+	while True:
+		select.select([ring.doorbell], [], [], 1.0)
+		ring.doorbell.drain()
+
+		received += len(ring.read())
+
+		# The writer closes the ring after its last write
+		if ring.is_closed and not len(ring):
+			break
+
+	elapsed = time.time() - start
+	process.join()
+
+	return received, elapsed
+
+def main():
+	megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+	chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+
+	chunk = ("PRIVMSG #channel :%s\r\n" % ("x" * 100)) * (chunk_size // 122 + 1)
+	chunk = chunk[:chunk_size]
+	count = megabytes * 1024 * 1024 // chunk_size
+
+	print "%d MB in %d chunks of %d bytes" % (megabytes, count, chunk_size)
+
+	received, queue_time = run_queue(chunk, count)
+	print "%-22s %8.3f s  %10.1f MB/s" % ('multiprocessing.Queue', queue_time,
+		received / queue_time / 1048576)
+
+	received, ring_time = run_ring(chunk, count)
+	print "%-22s %8.3f s  %10.1f MB/s" % ('RingBuffer', ring_time,
+		received / ring_time / 1048576)
+
+	print "Speedup: %.1fx" % (queue_time / ring_time)
+
+if __name__ == '__main__':
+	main()
@@ -11,6 +11,8 @@ Authentication is based on the hostname of the user.
 .. moduleauthor:: Lucas van Dijk <info@return1.net>
 """
 
+from luckybot.protocols.isupport import casefold
+
 class Authentication(object):
 	"""
 		This class provides functionality to authenticate a user
@@ -28,7 +30,24 @@ class Authentication(object):
 		self.groups = groups
 		self.users = users
 
-	def is_allowed(self, hostname, group):
+		# The users with case folded hostnames, per casemapping
+		self.folded_users = {}
+
+	def get_users(self, casemapping):
+		"""
+			Returns the users dictionary with the hostnames folded
+			according to the given casemapping
+		"""
+
+		users = self.folded_users.get(casemapping)
+		if users is None:
+			users = dict((casefold(hostname, casemapping), group)
+				for hostname, group in self.users.iteritems())
+			self.folded_users[casemapping] = users
+
+		return users
+
+	def is_allowed(self, hostname, group, casemapping='ascii'):
 		"""
 			Checks if a certain user is in a group, or the group
 			given is lower ranked than the group the user is in
@@ -36,19 +55,23 @@ class Authentication(object):
 			:Args:
 				* hostname (string): The user hostname
 				* group (string): Minium required group
+				* casemapping (string): Casemapping of the server the
+				  user is on
 		"""
-		hostname = hostname.lower()
+
+		users = self.get_users(casemapping)
+		hostname = casefold(hostname, casemapping)
 		group = group.lower()
 
-		if not hostname in self.users:
+		if not hostname in users:
 			return False
 
 		if not group in self.groups:
 			return False
 
-		if not self.users[hostname] in self.groups:
+		if not users[hostname] in self.groups:
 			return False
 
-		user_group = self.groups[self.users[hostname]]
+		user_group = self.groups[users[hostname]]
 
 		return self.groups[group] >= user_group
@@ -9,5 +9,5 @@ This module contains all types of connections to different types of servers.
 .. moduleauthor:: Lucas van Dijk <info@return1.net>
 """
 
-from luckybot.connections.base import BaseConnection
+from luckybot.connections.base import BaseConnection, LineBuffer
 from luckybot.connections.irc import IRCServerConnection
@@ -32,7 +32,7 @@ class BaseConnection(SignalEmitter):
 		    :mod:`luckybot.signals`
 	"""
 
-	available_events = ('connected', 'data_in', 'data_out', 'closed')
+	available_events = ('connected', 'data_in', 'data_out', 'closed', 'batch')
 
 	def __init__(self, *args, **kwargs):
 		SignalEmitter.__init__(self)
@@ -62,5 +62,71 @@ class BaseConnection(SignalEmitter):
 			Close connection to the server
 		"""
 
+class LineBuffer(object):
+	"""
+		Splits a stream of received data in lines, keeping only the
+		unterminated tail of the data between calls.
+	"""
+
+	def __init__(self, max_length=8704, delimiter="\n"):
+		"""
+			Initializes an empty buffer
+
+			:Args:
+				* max_length (int): Maximum length of a line, longer lines
+				  are dropped
+				* delimiter (string): The line delimiter
+		"""
 
+		self.max_length = max_length
+		self.delimiter = delimiter
+		self.tail = ""
+		self.discarding = False
+		self.dropped = 0
+
+	def feed(self, data):
+		"""
+			Adds received data to the buffer
+
+			:Args:
+				* data (string): The received data
+
+			:Returns:
+				A list of all completed lines, including the delimiter
+		"""
+
+		if self.tail:
+			data = self.tail + data
+
+		parts = data.split(self.delimiter)
+		self.tail = parts.pop()
+
+		# The start of this line was already dropped
+		if self.discarding and parts:
+			del parts[0]
+			self.discarding = False
+
+		if len(self.tail) > self.max_length:
+			self.tail = ""
+			self.discarding = True
+			self.dropped += 1
+
+		delimiter = self.delimiter
+		max_length = self.max_length
+		lines = []
+		for part in parts:
+			if len(part) > max_length:
+				self.dropped += 1
+				continue
+
+			lines.append(part + delimiter)
+
+		return lines
+
+	def clear(self):
+		"""
+			Throws away any incomplete line
+		"""
 
+		self.tail = ""
+		self.discarding = False
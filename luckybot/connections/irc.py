@@ -12,9 +12,11 @@ server.
 """
 
 from luckybot.protocols import IRCProtocol
-from luckybot.connections import BaseConnection
-from luckybot.network import MultiProcessSocket
+from luckybot.connections import BaseConnection, LineBuffer
+from luckybot.connections.sendqueue import SendQueue
+from luckybot.network import MultiProcessSocket, CONNECTION_CLASSES
 import socket
+from collections import deque
 from datetime import datetime
 
 class IRCServerConnection(BaseConnection):
@@ -39,9 +41,28 @@ class IRCServerConnection(BaseConnection):
 
 		self.connection_class = kwargs['connection_class'] if 'connection_class' in kwargs else MultiProcessSocket
 
+		if isinstance(self.connection_class, basestring):
+			if not self.connection_class.lower() in CONNECTION_CLASSES:
+				raise KeyError, "Unknown connection class %s" % self.connection_class
+
+			self.connection_class = CONNECTION_CLASSES[self.connection_class.lower()]
+
 		self.connection = self.connection_class(socket.SOCK_STREAM)
 		self.protocol = IRCProtocol(self)
-		self.buffer = ""
+
+		max_length = int(kwargs['max_line_length']) if 'max_line_length' in kwargs else 8704
+		self.buffer = LineBuffer(max_length)
+
+		# Lines received but not yet handled, because the line budget
+		# of a main loop iteration was used up
+		self.pending_lines = deque()
+
+		# Flood control
+		burst = int(kwargs['flood_burst']) if 'flood_burst' in kwargs else 5
+		rate = float(kwargs['flood_rate']) if 'flood_rate' in kwargs else 0.5
+		coalesce = str(kwargs['flood_coalesce']).lower() in ('1', 'yes', 'true', 'on') \
+			if 'flood_coalesce' in kwargs else False
+		self.send_queue = SendQueue(self.write, burst, rate, coalesce, self.protocol.isupport)
 		self.first_connect = False
 
 	def connect(self):
@@ -58,6 +79,9 @@ class IRCServerConnection(BaseConnection):
 			
 			del self.connection
 			self.connection = self.connection_class(socket.SOCK_STREAM)
+			self.buffer.clear()
+			self.pending_lines.clear()
+			self.send_queue.clear()
 		else:
 			self.first_connect = True
 
@@ -77,29 +101,69 @@ class IRCServerConnection(BaseConnection):
 		self.connection.open((self.info['hostname'], self.info['port']))
 		self.emit_signal('connected')
 
-	def send(self, line):
+	def send(self, line, priority=None):
 		"""
 			Sends the given line to the IRC server, and automatically
 			adds a newline (as required in the IRC RFC).
+
+			The line goes through the send queue, so it may be delayed
+			to prevent flooding.
+
+			:Args:
+				* line (string): The line to send
+				* priority (int): Optional priority class, see
+				  :mod:`luckybot.connections.sendqueue`
+		"""
+
+		self.send_queue.put(line, priority)
+
+	def write(self, line):
+		"""
+			Writes the given line to the connection right away, bypassing
+			the send queue.
 		"""
 
 		self.connection.send("%s\n" % line)
 		self.emit_signal('data_out', line.strip())
 
-	def recv(self):
+	def recv(self, max_bytes=None, max_lines=None):
 		"""
-			Reads a line from the connection, simple proxy method
-			to the connection recv method
+			Reads all available data from the connection, and emits the
+			data_in signal for each complete line
+
+			:Args:
+				* max_bytes (int): Maximum number of bytes to read
+				* max_lines (int): Maximum number of lines to handle, the
+				  rest is handled by the next call
+
+			:Returns:
+				The data read
 		"""
 
-		data = self.connection.recv()
+		data = self.connection.recv_batch(max_bytes)
+		lines = self.buffer.feed(data) if data else []
+
+		if self.pending_lines or (max_lines is not None and len(lines) > max_lines):
+			pending = self.pending_lines
+			pending.extend(lines)
 
-		if data:
-			self.buffer += data
-			self.check_buffer()
+			count = len(pending) if max_lines is None else min(max_lines, len(pending))
+			lines = [pending.popleft() for i in xrange(count)]
+
+		for line in lines:
+			self.emit_signal('data_in', line)
 
 		return data
 
+	@property
+	def has_pending(self):
+		"""
+			Checks if there are lines or data left over from the last
+			:meth:`recv` call
+		"""
+
+		return bool(self.pending_lines) or self.connection.has_pending
+
 	def close(self):
 		"""
 			Another proxy method for closing the connection with this
@@ -111,23 +175,6 @@ class IRCServerConnection(BaseConnection):
 		self.emit_signal('closed')
 		return result
 
-	def check_buffer(self):
-		"""
-			Checks if a newline is in the buffer (which means end of
-			command), and appends it to the recv queue if so
-		"""
-
-		pos = self.buffer.find("\n")
-
-		if pos != -1:
-			data = self.buffer[0:pos+1]
-			self.emit_signal('data_in', data)
-
-			self.buffer = self.buffer[pos+1:]
-
-			if self.buffer.find("\n") != -1:
-				self.check_buffer()
-
 	def __str__(self):
 		return self.info['hostname']
 
@@ -0,0 +1,307 @@
+"""
+:mod:`luckybot.connections.sendqueue` - Outgoing message queue
+==============================================================
+
+This module contains a send queue which limits the rate of outgoing
+lines with a token bucket, so the bot doesn't get disconnected for
+flooding.
+
+.. module:: luckybot.connections.sendqueue
+   :synopsis: Outgoing message queue with flood control
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+
+from collections import deque
+import time
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Commands which are sent right away, regardless of the flood limit
+HIGH_PRIORITY_COMMANDS = ('PONG', 'QUIT')
+
+# Room left for the prefix the server adds when relaying our message
+PREFIX_ROOM = 100
+
+# Maximum length of an IRC line without CRLF, minus the prefix room,
+# when the server didn't advertise its line length
+MAX_COALESCE_LENGTH = 510 - PREFIX_ROOM
+
+# Commands which can be sent to multiple comma separated targets
+MULTI_TARGET_COMMANDS = ('PRIVMSG', 'NOTICE')
+
+def is_ctcp(text):
+	"""
+		Checks if the text of a message is a CTCP message, like an
+		ACTION, which must be sent on its own
+	"""
+
+	return text[:1] == '\x01' or text[-1:] == '\x01'
+
+class SendQueue(object):
+	"""
+		Per server queue of outgoing lines.
+
+		Each line costs one token, and tokens are refilled at a fixed
+		rate up to the burst size. Lines which can't be sent yet are
+		queued by priority, and adjacent queued PRIVMSGs to the same
+		target are merged into one line. When the server allows multiple
+		targets, adjacent queued messages with the same text to different
+		targets are sent as one line too.
+	"""
+
+	def __init__(self, write, burst=5, rate=0.5, coalesce=False, isupport=None):
+		"""
+			Creates the queue
+
+			:Args:
+				* write (function): Called with each line to actually send it
+				* burst (int): Number of lines which can be sent at once
+				* rate (float): Number of tokens refilled each second
+				* coalesce (bool): Merge queued PRIVMSGs to the same target
+				* isupport (:class:`luckybot.protocols.isupport.ISupport`):
+				  Limits of the server, for the line length and number
+				  of targets
+		"""
+
+		self.write = write
+		self.burst = float(burst)
+		self.rate = float(rate)
+		self.coalesce = coalesce
+		self.isupport = isupport
+
+		self.queues = (deque(), deque(), deque())
+		self.tokens = self.burst
+		self.last_refill = time.time()
+
+		# Metrics
+		self.sent = 0
+		self.delayed = 0
+		self.coalesced = 0
+		self.total_delay = 0.0
+		self.max_delay = 0.0
+
+	def get_priority(self, line):
+		"""
+			Determines the priority class of a line
+		"""
+
+		if line.split(' ', 1)[0].upper() in HIGH_PRIORITY_COMMANDS:
+			return PRIORITY_HIGH
+
+		return PRIORITY_NORMAL
+
+	def refill(self):
+		"""
+			Adds the tokens earned since the last refill
+		"""
+
+		now = time.time()
+		elapsed = max(now - self.last_refill, 0)
+		self.last_refill = now
+
+		self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+
+		return now
+
+	def put(self, line, priority=None):
+		"""
+			Sends the line right away if the flood limit allows it,
+			otherwise queues it
+
+			:Args:
+				* line (string): The line to send, without newline
+				* priority (int): Priority class, determined from the
+				  command when not given
+		"""
+
+		if priority is None:
+			priority = self.get_priority(line)
+
+		now = self.refill()
+
+		if priority == PRIORITY_HIGH:
+			self.tokens -= 1
+			self.send(line, now, now)
+			return
+
+		if not len(self) and self.tokens >= 1:
+			self.tokens -= 1
+			self.send(line, now, now)
+			return
+
+		self.queues[priority].append((line, now))
+		self.delayed += 1
+
+	def send(self, line, queued_at, now):
+		"""
+			Writes the line, and updates the metrics
+		"""
+
+		delay = now - queued_at
+		self.sent += 1
+		self.total_delay += delay
+		self.max_delay = max(self.max_delay, delay)
+
+		self.write(line)
+
+	def flush(self):
+		"""
+			Sends as many queued lines as the flood limit allows
+		"""
+
+		if not len(self):
+			return
+
+		now = self.refill()
+
+		for queue in self.queues:
+			while queue and self.tokens >= 1:
+				line, queued_at = queue.popleft()
+
+				if self.coalesce:
+					line = self.merge_privmsgs(line, queue)
+					line = self.merge_targets(line, queue)
+
+				self.tokens -= 1
+				self.send(line, queued_at, now)
+
+	def max_length(self):
+		"""
+			Maximum length of a merged line
+		"""
+
+		if self.isupport is None:
+			return MAX_COALESCE_LENGTH
+
+		return self.isupport.linelen - 2 - PREFIX_ROOM
+
+	def merge_privmsgs(self, line, queue):
+		"""
+			Merges the following PRIVMSGs in the queue to the same target
+			into the given line, as long as it fits.
+		"""
+
+		if not line.startswith('PRIVMSG '):
+			return line
+
+		target, sep, text = line[8:].partition(' :')
+		if not sep or is_ctcp(text):
+			return line
+
+		header = 'PRIVMSG %s :' % target
+		max_length = self.max_length()
+		while queue:
+			next_line = queue[0][0]
+			if not next_line.startswith(header) or is_ctcp(next_line[len(header):]):
+				break
+
+			merged = '%s | %s' % (line, next_line[len(header):])
+			if len(merged) > max_length:
+				break
+
+			line = merged
+			queue.popleft()
+			self.coalesced += 1
+
+		return line
+
+	def merge_targets(self, line, queue):
+		"""
+			Merges the following PRIVMSGs or NOTICEs with the same text to
+			other targets into the given line, up to the number of targets
+			the server allows in one command.
+		"""
+
+		if self.isupport is None:
+			return line
+
+		command, sep, rest = line.partition(' ')
+		if command not in MULTI_TARGET_COMMANDS:
+			return line
+
+		targets, sep, text = rest.partition(' :')
+		if not sep:
+			return line
+
+		max_targets = self.isupport.max_targets(command)
+		targets = targets.split(',')
+		if max_targets is not None and len(targets) >= max_targets:
+			return line
+
+		header = '%s ' % command
+		trailer = ' :%s' % text
+		length = len(line)
+		max_length = self.max_length()
+
+		while queue:
+			next_line = queue[0][0]
+			if not next_line.startswith(header) or not next_line.endswith(trailer):
+				break
+
+			target = next_line[len(header):-len(trailer)]
+			if not target or ' ' in target or target in targets:
+				break
+
+			if length + len(target) + 1 > max_length:
+				break
+
+			targets.append(target)
+			length += len(target) + 1
+			queue.popleft()
+			self.coalesced += 1
+
+			if max_targets is not None and len(targets) >= max_targets:
+				break
+
+		return '%s%s%s' % (header, ','.join(targets), trailer)
+
+	def next_timeout(self):
+		"""
+			Calculates the time until the next queued line can be sent
+
+			:Returns:
+				Number of seconds, or None if the queue is empty
+		"""
+
+		if not len(self):
+			return None
+
+		if self.tokens >= 1 or not self.rate:
+			return 0
+
+		return (1 - self.tokens) / self.rate
+
+	def clear(self):
+		"""
+			Throws away all queued lines, and fills the bucket
+		"""
+
+		for queue in self.queues:
+			queue.clear()
+
+		self.tokens = self.burst
+		self.last_refill = time.time()
+
+	def stats(self):
+		"""
+			Returns the queue metrics
+
+			:Returns:
+				A dict with the queue depth, number of sent, delayed and
+				merged lines, and the average and maximum delay in seconds
+		"""
+
+		return {
+			'depth': len(self),
+			'sent': self.sent,
+			'delayed': self.delayed,
+			'coalesced': self.coalesced,
+			'avg_delay': self.total_delay / self.sent if self.sent else 0.0,
+			'max_delay': self.max_delay
+		}
+
+	def __len__(self):
+		return len(self.queues[0]) + len(self.queues[1]) + len(self.queues[2])
@@ -11,11 +11,17 @@ This is our main bot controller, manages plugins, servers and more
 """
 
 from luckybot import base_path, user_path, __version__
-from luckybot.processes import ProcessManager
+from luckybot.processes import ProcessManager, Supervisor
 from luckybot.plugin import PluginManager, PluginProxy
+from luckybot.plugin.manifest import Manifest
+from luckybot.plugin.executor import HandlerExecutor
 from luckybot.auth import Authentication
 from luckybot.signals import SignalEmitter
 from luckybot.connections.irc import IRCServerConnection
+from luckybot.network.reactor import Reactor
+from luckybot.network import pool, resolver
+from luckybot.httpclient import HTTPClient
+from luckybot.metrics import Registry, Counter, Histogram, MetricsServer, instrument_engine, collect_bot
 
 from ConfigParser import SafeConfigParser
 from datetime import datetime
@@ -23,9 +29,10 @@ import optparse
 import os
 import re
 import sys
+import time
 from datetime import datetime
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
 
 class LuckyBot(SignalEmitter):
 	"""
@@ -60,6 +67,20 @@ class LuckyBot(SignalEmitter):
 		self.ui = ui_class(self)
 
 		self.start_time = None
+		self.reactor = Reactor()
+
+		# Runtime metrics, most are read from the statistics of each part
+		# of the bot when they're requested
+		self.metrics = Registry()
+		self.lines_in = self.metrics.register(Counter('luckybot_lines_received_total',
+			'Lines received from the server', ('server',)))
+		self.parse_time = self.metrics.register(Histogram('luckybot_parse_duration_seconds',
+			'Time spent parsing received lines'))
+		self.dispatch_time = self.metrics.register(Histogram('luckybot_dispatch_duration_seconds',
+			'Time spent passing a message to the plugins'))
+		self.db_query_time = self.metrics.register(Histogram('luckybot_db_query_duration_seconds',
+			'Duration of database queries'))
+		self.metrics.add_collector(lambda: collect_bot(self))
 
 		# Load settings
 		self.settings = SafeConfigParser()
@@ -71,8 +92,12 @@ class LuckyBot(SignalEmitter):
 		# Setup database
 		self.db_engine = create_engine(self.settings.get('Bot', 'database'))
 		self.db_engine.connect()
+		instrument_engine(self.db_engine, self.db_query_time, self.reactor)
 		self.session_class = sessionmaker(bind=self.db_engine)
-		self.db_session = self.session_class()
+
+		# Each thread gets its own session, so background handlers can
+		# use the database too
+		self.db_session = scoped_session(self.session_class)
 
 		# Setup authentication
 		# Builtin groups
@@ -91,6 +116,29 @@ class LuckyBot(SignalEmitter):
 
 		self.auth = Authentication(groups, users)
 
+		# Setup the HTTP client used by plugins
+		http_workers = 4
+		if self.settings.has_option('Bot', 'http_workers'):
+			http_workers = self.settings.getint('Bot', 'http_workers')
+
+		http_per_host = 2
+		if self.settings.has_option('Bot', 'http_connections_per_host'):
+			http_per_host = self.settings.getint('Bot', 'http_connections_per_host')
+
+		self.http = HTTPClient(self.reactor, http_workers, http_per_host)
+
+		# Setup the worker pool for slow plugin handlers
+		handler_workers = 4
+		if self.settings.has_option('Bot', 'handler_workers'):
+			handler_workers = self.settings.getint('Bot', 'handler_workers')
+
+		max_handler_jobs = 100
+		if self.settings.has_option('Bot', 'max_handler_jobs'):
+			max_handler_jobs = self.settings.getint('Bot', 'max_handler_jobs')
+
+		self.executor = HandlerExecutor(self.reactor, handler_workers, max_handler_jobs,
+			self.db_session.remove)
+
 	@classmethod
 	def get_bot(cls):
 		"""
@@ -138,6 +186,19 @@ class LuckyBot(SignalEmitter):
 
 		return None
 
+	def add_server(self, server):
+		"""
+			Adds a server to the bot, the main loop connects to it
+
+			:Args:
+				* server (:class:`luckybot.connections.irc.IRCServerConnection`):
+				  The server to add
+		"""
+
+		server.add_listener('data_in', self.data_in)
+		server.add_listener('batch', self.batch_in)
+		self.servers.append(server)
+
 	def start(self):
 		"""
 			Creates for each server a subprocess, and runs the bot
@@ -152,24 +213,58 @@ class LuckyBot(SignalEmitter):
 			if self.settings.getboolean('Disabled', plugin):
 				disabled.append(plugin)
 
-		self.plugins = PluginManager(self, disabled)
+		# Plugins running in their own process
+		isolated = []
+		if self.settings.has_section('Isolated'):
+			for plugin in self.settings.options('Isolated'):
+				if self.settings.getboolean('Isolated', plugin):
+					isolated.append(plugin)
+
+		# With lazy loading, plugins are imported when they're first used
+		manifest = None
+		if self.settings.has_option('Bot', 'lazy_plugins') and \
+				self.settings.getboolean('Bot', 'lazy_plugins'):
+			manifest = Manifest(user_path('plugins.json'))
+
+		self.plugins = PluginManager(self, disabled, manifest, isolated)
 		self.plugins.load_plugins(base_path('plugins'))
 
-		self.servers = self.get_servers()
+		# How long resolved server addresses are remembered
+		if self.settings.has_option('Bot', 'dns_cache_ttl'):
+			resolver.setup(self.settings.getfloat('Bot', 'dns_cache_ttl'))
 
-		# Add listeners
-		for server in self.servers:
-			server.add_listener('data_in', self.data_in)
+		# Worker processes for servers using the pool connection class
+		if self.settings.has_option('Bot', 'connection_workers'):
+			pool.setup(self.settings.getint('Bot', 'connection_workers'))
+
+		self.servers = []
+		for server in self.get_servers():
+			self.add_server(server)
 
 		self.emit_signal('servers_loaded')
 
-		process_manager = ProcessManager(self.servers, self.settings.getboolean('Bot', 'keep_alive'))
+		# Reconnect backoff
+		reconnect = {}
+		for option, arg in (('reconnect_delay', 'base_delay'), ('reconnect_max_delay', 'max_delay')):
+			if self.settings.has_option('Bot', option):
+				reconnect[arg] = self.settings.getfloat('Bot', option)
+
+		connect_stagger = 0.0
+		if self.settings.has_option('Bot', 'connect_stagger'):
+			connect_stagger = self.settings.getfloat('Bot', 'connect_stagger')
+
+		# Serve the metrics on a local port or Unix socket
+		if self.settings.has_option('Bot', 'metrics'):
+			self.metrics_server = MetricsServer(self.metrics, self.settings.get('Bot', 'metrics'))
+
+		self.process_manager = ProcessManager(self.servers, self.settings.getboolean('Bot', 'keep_alive'),
+			self.reactor, Supervisor(**reconnect), connect_stagger)
 		num_alive = len(self.servers)
 
 		# Our main loop
 		while num_alive > 0:
 			try:
-				num_alive = process_manager.check_processes()
+				num_alive = self.process_manager.check_processes(self.plugins.next_timer_timeout())
 				self.plugins.check_timers()
 			except KeyboardInterrupt:
 				break
@@ -179,7 +274,17 @@ class LuckyBot(SignalEmitter):
 			Event handler when a server receives data
 		"""
 
+		self.lines_in.inc(str(server))
+
+		start = time.time()
 		message = server.protocol.parse_line(data)
+		parsed = time.time()
+		self.parse_time.observe(parsed - start)
+
+		# Messages in a netsplit or netjoin batch are handled together
+		# when the batch ends
+		if server.protocol.get_batch(message) is not None:
+			return
 
 		# Setup plugin proxy
 		proxy = PluginProxy(server, message, self)
@@ -193,4 +298,17 @@ class LuckyBot(SignalEmitter):
 
 			server.send(server.protocol.pm(message.channel, "BOOM Error: %s" % (str(e))))
 
+		self.dispatch_time.observe(time.time() - parsed)
+
+	def batch_in(self, server, batch):
+		"""
+			Event handler when a server completed a batch of messages
+		"""
 
+		proxy = PluginProxy(server, batch.message, self)
+
+		try:
+			self.plugins.check_batch(proxy, batch)
+		except Exception as e:
+			import traceback
+			traceback.print_exc()
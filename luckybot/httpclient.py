@@ -0,0 +1,309 @@
+"""
+:mod:`luckybot.httpclient` - Non blocking HTTP client
+=====================================================
+
+This module provides a pool of worker threads which fetch HTTP resources
+for plugins, so a slow website doesn't block the bot. Connections are
+kept alive and reused, and the number of concurrent requests to the same
+host is limited.
+
+Results are delivered on the main thread, so callbacks can safely send
+messages to a server.
+
+.. module:: luckybot.httpclient
+   :synopsis: Non blocking HTTP client
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+
+from luckybot import __version__
+
+import httplib
+import socket
+import sys
+import threading
+import traceback
+import urllib2
+import urlparse
+from Queue import Queue
+from StringIO import StringIO
+
+MAX_REDIRECTS = 5
+
+class Future(object):
+	"""
+		The result of a job which runs in the worker pool. Callbacks
+		are called on the main thread, when the job is done.
+	"""
+
+	def __init__(self):
+		self.done = False
+		self.result = None
+		self.error = None
+		self.callbacks = []
+
+	def add_callbacks(self, callback=None, errback=None):
+		"""
+			Adds functions to call when the job is done
+
+			:Args:
+				* callback (function): Called with the result
+				* errback (function): Called with the exception when the
+				  job failed, the traceback is printed when not given
+		"""
+
+		self.callbacks.append((callback, errback))
+
+		if self.done:
+			self.run_callback(callback, errback)
+
+		return self
+
+	def set_result(self, result):
+		self.done = True
+		self.result = result
+
+		for callback, errback in self.callbacks:
+			self.run_callback(callback, errback)
+
+	def set_error(self, error, exc_info=None):
+		self.done = True
+		self.error = error
+
+		if not self.callbacks and exc_info:
+			traceback.print_exception(*exc_info)
+
+		for callback, errback in self.callbacks:
+			self.run_callback(callback, errback)
+
+	def run_callback(self, callback, errback):
+		try:
+			if self.error is not None:
+				if errback:
+					errback(self.error)
+				else:
+					print "Error in background job: %s" % self.error
+			elif callback:
+				callback(self.result)
+		except Exception:
+			traceback.print_exc()
+
+class Response(StringIO):
+	"""
+		A fully read HTTP response, which acts like the file object
+		returned by :func:`urllib2.urlopen`
+	"""
+
+	def __init__(self, url, code, msg, headers, body):
+		StringIO.__init__(self, body)
+
+		self.url = url
+		self.code = code
+		self.msg = msg
+		self.headers = headers
+
+	def info(self):
+		return self.headers
+
+	def geturl(self):
+		return self.url
+
+class HTTPClient(object):
+	"""
+		Pool of worker threads for fetching HTTP resources
+	"""
+
+	def __init__(self, reactor, num_workers=4, max_per_host=2, timeout=15):
+		"""
+			Creates the client, worker threads are started when the first
+			job is added
+
+			:Args:
+				* reactor (:class:`luckybot.network.reactor.Reactor`): Used
+				  to deliver results on the main thread
+				* num_workers (int): Number of worker threads
+				* max_per_host (int): Maximum number of concurrent requests
+				  to the same host
+				* timeout (int): Socket timeout in seconds
+		"""
+
+		self.reactor = reactor
+		self.num_workers = num_workers
+		self.max_per_host = max_per_host
+		self.timeout = timeout
+
+		self.jobs = Queue()
+		self.workers = []
+		self.host_slots = {}
+		self.lock = threading.Lock()
+		self.local = threading.local()
+
+	def start_workers(self):
+		for i in range(self.num_workers - len(self.workers)):
+			worker = threading.Thread(target=self.work, name='HTTPClient-%d' % i)
+			worker.daemon = True
+			worker.start()
+
+			self.workers.append(worker)
+
+	def work(self):
+		"""
+			Main loop of a worker thread
+		"""
+
+		while True:
+			func, args, kwargs, future = self.jobs.get()
+
+			try:
+				result = func(*args, **kwargs)
+			except Exception as e:
+				self.reactor.call_from_thread(future.set_error, e, sys.exc_info())
+			else:
+				self.reactor.call_from_thread(future.set_result, result)
+
+	def run(self, func, *args, **kwargs):
+		"""
+			Runs a function in the worker pool. The function should not
+			touch the database or servers, do that in the callback.
+
+			:Args:
+				* func (function): The function to run
+				* Further arguments are passed to the function
+
+			:Returns:
+				A :class:`Future` for the function result
+		"""
+
+		if len(self.workers) < self.num_workers:
+			self.start_workers()
+
+		future = Future()
+		self.jobs.put((func, args, kwargs, future))
+
+		return future
+
+	def fetch(self, url, parse=None, data=None, headers=None):
+		"""
+			Fetches the given URL in the background
+
+			:Args:
+				* url (string): The URL to fetch
+				* parse (function): Optional function which is called with
+				  the response in the worker thread, its return value
+				  is passed to the callbacks
+				* data (string): Data to POST
+				* headers (dict): Additional request headers
+
+			:Returns:
+				A :class:`Future` for the response
+		"""
+
+		def job():
+			response = self.urlopen(url, data, headers)
+			return parse(response) if parse else response
+
+		return self.run(job)
+
+	def get_host_slot(self, host):
+		with self.lock:
+			if host not in self.host_slots:
+				self.host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+
+			return self.host_slots[host]
+
+	def get_connection(self, scheme, host, port, fresh=False):
+		"""
+			Gets a kept alive connection of the current thread to the
+			given host, or opens a new one
+		"""
+
+		if not hasattr(self.local, 'connections'):
+			self.local.connections = {}
+
+		key = (scheme, host, port)
+		if fresh and key in self.local.connections:
+			self.local.connections.pop(key).close()
+
+		if key not in self.local.connections:
+			cls = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+			self.local.connections[key] = cls(host, port, timeout=self.timeout)
+
+		return self.local.connections[key]
+
+	def request(self, url, data=None, headers=None):
+		"""
+			Does a single request over a kept alive connection, and reads
+			the whole response
+		"""
+
+		parts = urlparse.urlsplit(url)
+		scheme = parts.scheme.lower()
+		if scheme not in ('http', 'https'):
+			raise urllib2.URLError("Unsupported URL scheme %s" % scheme)
+
+		host = parts.hostname
+		port = parts.port or (443 if scheme == 'https' else 80)
+		path = parts.path or '/'
+		if parts.query:
+			path += '?' + parts.query
+
+		request_headers = {
+			'User-Agent': 'LuckyBot/%s' % __version__,
+			'Host': parts.netloc.rpartition('@')[2]
+		}
+		if headers:
+			request_headers.update(headers)
+
+		method = 'POST' if data is not None else 'GET'
+
+		with self.get_host_slot(host):
+			connection = self.get_connection(scheme, host, port)
+
+			try:
+				connection.request(method, path, data, request_headers)
+				response = connection.getresponse()
+			except (httplib.HTTPException, socket.error):
+				# The server may have closed the kept alive connection,
+				# try again once with a fresh one
+				connection = self.get_connection(scheme, host, port, True)
+				connection.request(method, path, data, request_headers)
+				response = connection.getresponse()
+
+			body = response.read()
+
+			if response.will_close:
+				self.get_connection(scheme, host, port, True)
+
+		return response, body
+
+	def urlopen(self, url, data=None, headers=None):
+		"""
+			Fetches the given URL, following redirects. This blocks, so
+			it should only be used in functions running in the pool.
+
+			:Args:
+				* url (string): The URL to fetch
+				* data (string): Data to POST
+				* headers (dict): Additional request headers
+
+			:Returns:
+				A :class:`Response` object
+		"""
+
+		for i in range(MAX_REDIRECTS + 1):
+			response, body = self.request(url, data, headers)
+
+			location = response.getheader('location')
+			if response.status in (301, 302, 303, 307) and location:
+				url = urlparse.urljoin(url, location)
+				data = None
+				continue
+
+			if response.status >= 400:
+				raise urllib2.HTTPError(url, response.status, response.reason,
+					response.msg, StringIO(body))
+
+			return Response(url, response.status, response.reason, response.msg, body)
+
+		raise urllib2.HTTPError(url, response.status, "Too many redirects",
+			response.msg, StringIO(body))
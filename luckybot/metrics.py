@@ -0,0 +1,489 @@
+"""
+:mod:`luckybot.metrics` - Runtime metrics
+=========================================
+
+This module collects metrics of the bot, and serves them in the
+Prometheus text format over HTTP, on a local port or a Unix socket.
+
+Counters and histograms are plain numbers which are only updated on the
+main thread, so updating them doesn't need a lock. Other threads report
+through the reactor. Most metrics are not counted separately at all,
+but are read from the statistics the connections, the plugin manager
+and the worker pools already keep, when the metrics are requested.
+
+.. module:: luckybot.metrics
+   :synopsis: Runtime metrics
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+
+import asyncore
+import os
+import socket
+import threading
+import time
+import traceback
+
+from luckybot.network.reactor import socket_map
+from luckybot.network import pool, resolver
+from luckybot.plugin.instrumentation import BUCKETS, handler_key
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def escape(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_value(value):
+	if value == float('inf'):
+		return '+Inf'
+
+	return repr(float(value))
+
+class MetricFamily(object):
+	"""
+		The samples of one metric, as sent to Prometheus
+	"""
+
+	def __init__(self, name, type, help):
+		"""
+			:Args:
+				* name (string): Name of the metric
+				* type (string): counter, gauge or histogram
+				* help (string): Description of the metric
+		"""
+
+		self.name = name
+		self.type = type
+		self.help = help
+		self.samples = []
+
+	def add(self, value, labels=None, suffix=''):
+		"""
+			Adds a sample
+
+			:Args:
+				* value (float): The value
+				* labels (dict): Label names and values
+				* suffix (string): Appended to the name, for example
+				  _bucket for histograms
+		"""
+
+		self.samples.append((suffix, labels or {}, value))
+		return self
+
+	def add_histogram(self, buckets, total, count, labels=None):
+		"""
+			Adds the samples of a histogram with power of two microsecond
+			buckets, like the ones in :mod:`luckybot.plugin.instrumentation`
+
+			:Args:
+				* buckets (list): Number of observations per bucket
+				* total (float): Sum of all observations in seconds
+				* count (int): Number of observations
+				* labels (dict): Label names and values
+		"""
+
+		labels = labels or {}
+		cumulative = 0
+		for bucket, observations in enumerate(buckets[:-1]):
+			cumulative += observations
+			self.add(cumulative, dict(labels, le=format_value((1 << bucket) / 1000000.0)), '_bucket')
+
+		self.add(count, dict(labels, le='+Inf'), '_bucket')
+		self.add(total, labels, '_sum')
+		self.add(count, labels, '_count')
+
+		return self
+
+	def render(self):
+		lines = ['# HELP %s %s' % (self.name, self.help.replace('\\', '\\\\').replace('\n', '\\n')),
+			'# TYPE %s %s' % (self.name, self.type)]
+
+		for suffix, labels, value in self.samples:
+			if labels:
+				labels = ','.join('%s="%s"' % (name, escape(labels[name])) for name in sorted(labels))
+				lines.append('%s%s{%s} %s' % (self.name, suffix, labels, format_value(value)))
+			else:
+				lines.append('%s%s %s' % (self.name, suffix, format_value(value)))
+
+		return '\n'.join(lines)
+
+class Counter(object):
+	"""
+		A counter with optional labels, which may only be updated on the
+		main thread
+	"""
+
+	def __init__(self, name, help, labels=()):
+		self.name = name
+		self.help = help
+		self.labels = labels
+
+		# Tuple of label values -> count
+		self.values = {}
+
+	def inc(self, *labels):
+		"""
+			Adds one to the counter with the given label values
+		"""
+
+		values = self.values
+		values[labels] = values.get(labels, 0) + 1
+
+	def add(self, amount, *labels):
+		values = self.values
+		values[labels] = values.get(labels, 0) + amount
+
+	def collect(self):
+		family = MetricFamily(self.name, 'counter', self.help)
+		for labels, value in self.values.iteritems():
+			family.add(value, dict(zip(self.labels, labels)))
+
+		return family
+
+class Histogram(object):
+	"""
+		A histogram of durations with power of two microsecond buckets,
+		which may only be updated on the main thread
+	"""
+
+	def __init__(self, name, help, labels=()):
+		self.name = name
+		self.help = help
+		self.labels = labels
+
+		# Tuple of label values -> [buckets, sum, count]
+		self.values = {}
+
+	def observe(self, elapsed, *labels):
+		"""
+			Records a duration
+
+			:Args:
+				* elapsed (float): The duration in seconds
+				* Further arguments are the label values
+		"""
+
+		value = self.values.get(labels)
+		if value is None:
+			value = self.values[labels] = [[0] * BUCKETS, 0.0, 0]
+
+		value[0][min(int(elapsed * 1000000).bit_length(), BUCKETS - 1)] += 1
+		value[1] += elapsed
+		value[2] += 1
+
+	def collect(self):
+		family = MetricFamily(self.name, 'histogram', self.help)
+		for labels, (buckets, total, count) in self.values.iteritems():
+			family.add_histogram(buckets, total, count, dict(zip(self.labels, labels)))
+
+		return family
+
+class Registry(object):
+	"""
+		All metrics of the bot
+	"""
+
+	def __init__(self):
+		self.metrics = []
+		self.collectors = []
+
+	def register(self, metric):
+		"""
+			Adds a :class:`Counter` or :class:`Histogram`, and returns it
+		"""
+
+		self.metrics.append(metric)
+		return metric
+
+	def add_collector(self, collector):
+		"""
+			Adds a function which returns a list of :class:`MetricFamily`
+			objects, called each time the metrics are requested
+		"""
+
+		self.collectors.append(collector)
+
+	def collect(self):
+		families = [metric.collect() for metric in self.metrics]
+
+		for collector in self.collectors:
+			try:
+				families.extend(collector())
+			except Exception:
+				traceback.print_exc()
+
+		return families
+
+	def render(self):
+		"""
+			Returns all metrics in the Prometheus text format
+		"""
+
+		return ''.join(family.render() + '\n' for family in self.collect())
+
+def instrument_engine(engine, histogram, reactor):
+	"""
+		Records the duration of each database query of an SQLAlchemy
+		engine. Queries from worker threads are recorded through the
+		reactor.
+
+		:Args:
+			* engine (:class:`sqlalchemy.engine.Engine`): The engine
+			* histogram (:class:`Histogram`): Receives the durations
+			* reactor (:class:`luckybot.network.reactor.Reactor`): Used
+			  to get back to the main thread
+	"""
+
+	from sqlalchemy import event
+
+	main_thread = threading.current_thread()
+
+	def before(conn, cursor, statement, parameters, context, executemany):
+		conn.info.setdefault('query_start', []).append(time.time())
+
+	def after(conn, cursor, statement, parameters, context, executemany):
+		elapsed = time.time() - conn.info['query_start'].pop()
+
+		if threading.current_thread() is main_thread:
+			histogram.observe(elapsed)
+		else:
+			reactor.call_from_thread(histogram.observe, elapsed)
+
+	event.listen(engine, 'before_cursor_execute', before)
+	event.listen(engine, 'after_cursor_execute', after)
+
+def collect_bot(bot):
+	"""
+		Reads the statistics the parts of the bot keep themselves
+
+		:Args:
+			* bot (:class:`luckybot.controller.LuckyBot`): The bot
+
+		:Returns:
+			A list of :class:`MetricFamily` objects
+	"""
+
+	families = []
+
+	def family(name, type, help):
+		families.append(MetricFamily(name, type, help))
+		return families[-1]
+
+	if bot.start_time is not None:
+		family('luckybot_start_time_seconds', 'gauge', 'Time the bot was started').add(
+			time.mktime(bot.start_time.timetuple()))
+
+	# Servers
+	lines_sent = family('luckybot_lines_sent_total', 'counter', 'Lines sent to the server')
+	depth = family('luckybot_send_queue_depth', 'gauge', 'Lines waiting in the send queue')
+	delayed = family('luckybot_send_queue_delayed_total', 'counter', 'Lines delayed by flood control')
+	coalesced = family('luckybot_send_queue_coalesced_total', 'counter', 'Lines merged with another line')
+	max_delay = family('luckybot_send_queue_max_delay_seconds', 'gauge', 'Longest time a line waited in the send queue')
+	channels = family('luckybot_channels', 'gauge', 'Channels the bot is in')
+	joins = family('luckybot_joins_total', 'counter', 'Completed channel joins')
+	failed_joins = family('luckybot_join_failures', 'gauge', 'Channels which could not be joined')
+	join_latency = family('luckybot_join_latency_seconds', 'gauge', 'Average time between sending a JOIN and the end of the NAMES list')
+
+	for server in getattr(bot, 'servers', ()):
+		labels = {'server': str(server)}
+
+		stats = server.send_queue.stats()
+		lines_sent.add(stats['sent'], labels)
+		depth.add(stats['depth'], labels)
+		delayed.add(stats['delayed'], labels)
+		coalesced.add(stats['coalesced'], labels)
+		max_delay.add(stats['max_delay'], labels)
+
+		channels.add(len(server.protocol.state.channels), labels)
+
+		stats = server.protocol.joins.stats()
+		joins.add(stats['joined'], labels)
+		failed_joins.add(stats['failed'], labels)
+		join_latency.add(stats['avg_latency'], labels)
+
+	# Connections
+	process_manager = getattr(bot, 'process_manager', None)
+	if process_manager is not None:
+		up = family('luckybot_server_up', 'gauge', 'Whether the connection to the server is stable')
+		attempts = family('luckybot_connection_attempts_total', 'counter', 'Connection attempts')
+		failures = family('luckybot_connection_failures_total', 'counter', 'Lost connections')
+		crash_loops = family('luckybot_crash_loops_total', 'counter', 'Times the server kept failing right after connecting')
+
+		for server, stats in process_manager.stats().iteritems():
+			labels = {'server': server}
+			up.add(1 if stats['state'] == 'closed' else 0, labels)
+			attempts.add(stats['attempts'], labels)
+			failures.add(stats['failures'], labels)
+			crash_loops.add(stats['crash_loops'], labels)
+
+	if pool.default_pool is not None and pool.default_pool.workers:
+		connections = family('luckybot_pool_connections', 'gauge', 'Connections per worker process')
+		for worker, load in enumerate(pool.default_pool.stats()):
+			connections.add(load, {'worker': worker})
+
+	family('luckybot_dns_cache_hits_total', 'counter', 'Lookups answered from the DNS cache').add(
+		resolver.default_resolver.hits)
+	family('luckybot_dns_cache_misses_total', 'counter', 'Lookups sent to the resolver').add(
+		resolver.default_resolver.misses)
+
+	# Worker pools
+	stats = bot.executor.stats()
+	family('luckybot_background_jobs', 'gauge', 'Background handlers running or waiting').add(stats['pending'])
+	jobs = family('luckybot_background_jobs_total', 'counter', 'Finished background handlers')
+	jobs.add(stats['completed'], {'result': 'completed'})
+	jobs.add(stats['failed'], {'result': 'failed'})
+	jobs.add(stats['rejected'], {'result': 'rejected'})
+
+	family('luckybot_http_jobs', 'gauge', 'HTTP requests waiting for a worker').add(bot.http.jobs.qsize())
+
+	plugins = getattr(bot, 'plugins', None)
+	if plugins is None:
+		return families
+
+	# Plugin handlers
+	calls = family('luckybot_handler_calls_total', 'counter', 'Plugin handler calls')
+	errors = family('luckybot_handler_errors_total', 'counter', 'Plugin handler calls which raised an exception')
+	durations = family('luckybot_handler_duration_seconds', 'histogram', 'Duration of plugin handler calls')
+
+	for stats in plugins.instrumentation.get_stats():
+		labels = {'plugin': stats.plugin, 'handler': stats.name}
+		calls.add(stats.calls, labels)
+		errors.add(stats.errors, labels)
+		durations.add_histogram(stats.histogram, stats.total, stats.calls, labels)
+
+	# Timers
+	timer_calls = family('luckybot_timer_calls_total', 'counter', 'Timer calls')
+	skipped = family('luckybot_timer_skipped_total', 'counter', 'Timer calls skipped because the previous one was still running')
+	missed = family('luckybot_timer_missed_total', 'counter', 'Timer calls missed because the bot was busy')
+	lag = family('luckybot_timer_lag_seconds', 'gauge', 'How late the last call of the timer was')
+
+	for function in plugins.timers:
+		plugin, name = handler_key(function)
+		labels = {'plugin': plugin, 'handler': name}
+		info = function.timer
+
+		timer_calls.add(info.calls, labels)
+		skipped.add(info.skipped, labels)
+		missed.add(info.missed, labels)
+		lag.add(info.lag, labels)
+
+	# Plugin hosts
+	hosts = [(dirname, host.stats()) for dirname, host in plugins.plugins.items() if hasattr(host, 'stats')]
+	if hosts:
+		host_calls = family('luckybot_plugin_host_calls_total', 'counter', 'Calls sent to plugin hosts')
+		host_pending = family('luckybot_plugin_host_pending', 'gauge', 'Calls a plugin host has not finished yet')
+		host_dropped = family('luckybot_plugin_host_dropped_total', 'counter', 'Calls dropped because the plugin host was busy')
+		host_restarts = family('luckybot_plugin_host_restarts_total', 'counter', 'Times the plugin host was restarted')
+
+		for dirname, stats in hosts:
+			labels = {'plugin': dirname}
+			host_calls.add(stats['called'], labels)
+			host_pending.add(stats['pending'], labels)
+			host_dropped.add(stats['dropped'], labels)
+			host_restarts.add(stats['restarts'], labels)
+
+	return families
+
+class MetricsConnection(asyncore.dispatcher):
+	"""
+		A client of the metrics server, gets one response and is closed
+	"""
+
+	def __init__(self, sock, registry):
+		asyncore.dispatcher.__init__(self, sock, map=socket_map)
+
+		self.registry = registry
+		self.request = ""
+		self.response = ""
+
+	def readable(self):
+		return not self.response
+
+	def writable(self):
+		return bool(self.response)
+
+	def handle_read(self):
+		data = self.recv(4096)
+		if not data:
+			return
+
+		self.request += data
+		if '\r\n\r\n' in self.request or '\n\n' in self.request or len(self.request) > 8192:
+			self.respond()
+
+	def respond(self):
+		parts = self.request.split(' ', 2)
+		path = parts[1].split('?')[0] if len(parts) > 1 else ''
+
+		if parts[0] != 'GET':
+			status = '405 Method Not Allowed'
+			body = 'Only GET is supported\n'
+		elif path in ('/', '/metrics'):
+			status = '200 OK'
+			body = self.registry.render()
+		else:
+			status = '404 Not Found'
+			body = 'Not found\n'
+
+		self.response = 'HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s' % (
+			status, CONTENT_TYPE, len(body), body)
+
+	def handle_write(self):
+		sent = self.send(self.response)
+		self.response = self.response[sent:]
+
+		if not self.response:
+			self.close()
+
+	def handle_close(self):
+		self.close()
+
+	def handle_error(self):
+		traceback.print_exc()
+		self.close()
+
+class MetricsServer(asyncore.dispatcher):
+	"""
+		Serves the metrics over HTTP, on the reactor of the bot
+	"""
+
+	def __init__(self, registry, address):
+		"""
+			Starts listening
+
+			:Args:
+				* registry (:class:`Registry`): The metrics to serve
+				* address (string): `host:port`, only a port to listen on
+				  127.0.0.1, or `unix:/path/to/socket`
+		"""
+
+		asyncore.dispatcher.__init__(self, map=socket_map)
+
+		self.registry = registry
+
+		if address.startswith('unix:'):
+			path = address[5:]
+			if os.path.exists(path):
+				os.unlink(path)
+
+			self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			self.bind(path)
+		else:
+			host, sep, port = address.rpartition(':')
+			host = host.strip('[]') or '127.0.0.1'
+			family = socket.AF_INET6 if ':' in host else socket.AF_INET
+
+			self.create_socket(family, socket.SOCK_STREAM)
+			self.set_reuse_addr()
+			self.bind((host, int(port)))
+
+		self.listen(5)
+
+	def handle_accept(self):
+		pair = self.accept()
+		if pair is not None:
+			MetricsConnection(pair[0], self.registry)
+
+	def handle_error(self):
+		traceback.print_exc()
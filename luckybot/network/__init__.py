@@ -12,7 +12,18 @@ sockets more flexible.
 """
 
 from luckybot.network.base import BaseSocket, Socket
-from luckybot.network.multiprocess import MultiProcessSocket
+from luckybot.network.multiprocess import MultiProcessSocket, RingSocket
+from luckybot.network.asynchronous import AsyncSocket
+from luckybot.network.pool import PoolSocket
+
+# Connection classes which can be selected with the `connection_class`
+# directive in a [Server] section
+CONNECTION_CLASSES = {
+	'multiprocess': MultiProcessSocket,
+	'ring': RingSocket,
+	'async': AsyncSocket,
+	'pool': PoolSocket
+}
 
 
 
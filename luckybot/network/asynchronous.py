@@ -0,0 +1,247 @@
+"""
+:mod:`luckybot.network.asynchronous` - Asynchronous sockets
+===========================================================
+
+This module contains a socket class which runs all connections on one
+event loop inside the controller process, instead of spawning a new
+process for each connection.
+
+Looking up the host and connecting happens in a short lived thread, so
+a slow DNS server or an unreachable address doesn't block the event
+loop.
+
+.. module:: luckybot.network.asynchronous
+   :synopsis: Single process asynchronous sockets
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+
+import asyncore
+import socket
+import threading
+import traceback
+
+from luckybot.network.base import BaseSocket, Socket
+from luckybot.network.reactor import socket_map, Waker
+
+# Wakes up the event loop when a connecting thread is done, created
+# when the first connection is opened
+waker = None
+
+class AsyncDispatcher(asyncore.dispatcher):
+	"""
+		The asyncore dispatcher for a single connection, buffers incoming
+		and outgoing data
+	"""
+
+	def __init__(self):
+		"""
+			Creates the dispatcher, it's added to the event loop when
+			the socket has connected
+		"""
+
+		asyncore.dispatcher.__init__(self, map=socket_map)
+
+		self.in_buffer = []
+		self.out_buffer = ""
+		self.close_when_done = False
+		self.alive = True
+
+	def handle_connected(self, sock):
+		"""
+			Called on the main thread when the socket has connected
+
+			:Args:
+				* sock (socket): The connected socket
+		"""
+
+		if not self.alive:
+			sock.close()
+			return
+
+		sock.setblocking(0)
+		self.set_socket(sock)
+		self.connected = True
+
+		if self.close_when_done and not self.out_buffer:
+			self.handle_close()
+
+	def handle_connect_failed(self, error):
+		"""
+			Called on the main thread when none of the addresses could be
+			connected to
+		"""
+
+		print "Could not connect:", error
+		self.handle_close()
+
+	def readable(self):
+		return True
+
+	def writable(self):
+		return self.connecting or len(self.out_buffer) > 0
+
+	def handle_connect(self):
+		pass
+
+	def handle_read(self):
+		data = self.recv(4096)
+
+		if data:
+			self.in_buffer.append(data)
+
+	def handle_write(self):
+		sent = self.send(self.out_buffer)
+		self.out_buffer = self.out_buffer[sent:]
+
+		if not self.out_buffer and self.close_when_done:
+			self.handle_close()
+
+	def handle_close(self):
+		"""
+			Closes the socket, and tells the connection owner we're done,
+			the same way :class:`luckybot.network.multiprocess.SocketProcess`
+			does.
+		"""
+
+		if not self.alive:
+			return
+
+		self.alive = False
+		if self.socket is not None:
+			self.close()
+
+		self.in_buffer.append("QUIT\n")
+
+	def handle_error(self):
+		traceback.print_exc()
+		self.handle_close()
+
+class AsyncSocket(BaseSocket):
+	"""
+		A non blocking connection which runs on the shared event loop of
+		the controller process
+	"""
+
+	def __init__(self, type):
+		BaseSocket.__init__(self, type)
+
+		self.dispatcher = None
+
+	def open(self, addr):
+		"""
+			Starts resolving and connecting to the given address in a
+			separate thread, data sent in the meantime is buffered
+
+			:Args:
+				* addr (tuple): Where to connect to (address, port)
+		"""
+
+		global waker
+		if waker is None:
+			waker = Waker(socket_map)
+
+		self.addr = addr
+		self.dispatcher = AsyncDispatcher()
+
+		thread = threading.Thread(target=self.connect, args=(self.dispatcher, addr))
+		thread.daemon = True
+		thread.start()
+
+	def connect(self, dispatcher, addr):
+		"""
+			Connects to all addresses of the host, like
+			:class:`luckybot.network.base.Socket` does, runs in its own
+			thread
+		"""
+
+		connection = Socket(self.type)
+
+		try:
+			connection.open(addr)
+		except socket.error as e:
+			waker.wake(dispatcher.handle_connect_failed, e)
+		else:
+			waker.wake(dispatcher.handle_connected, connection.socket)
+
+	def send(self, data):
+		"""
+			Appends data to the outgoing buffer, the event loop will send
+			it when the socket is writable
+		"""
+
+		self.dispatcher.out_buffer += data
+
+		if data.startswith("QUIT"):
+			self.dispatcher.close_when_done = True
+
+	def recv(self):
+		"""
+			Returns all data received since the last call
+		"""
+
+		return self.recv_batch()
+
+	def recv_batch(self, max_bytes=None):
+		"""
+			Returns the data received since the last call, up to the given
+			number of bytes. The QUIT added when the connection closes is
+			always returned on its own.
+
+			:Args:
+				* max_bytes (int): Maximum number of bytes to read
+		"""
+
+		if not self.dispatcher or not self.dispatcher.in_buffer:
+			return ""
+
+		in_buffer = self.dispatcher.in_buffer
+		if in_buffer[0] == "QUIT\n":
+			del in_buffer[0]
+			return "QUIT\n"
+
+		size = 0
+		count = 0
+		for chunk in in_buffer:
+			if chunk == "QUIT\n" or (max_bytes is not None and size >= max_bytes):
+				break
+
+			size += len(chunk)
+			count += 1
+
+		data = "".join(in_buffer[:count])
+		del in_buffer[:count]
+
+		return data
+
+	@property
+	def has_pending(self):
+		return bool(self.dispatcher and self.dispatcher.in_buffer)
+
+	def close(self):
+		"""
+			Closes the connection, after all pending data has been sent
+		"""
+
+		if not self.dispatcher:
+			return
+
+		if self.dispatcher.out_buffer:
+			self.dispatcher.close_when_done = True
+		else:
+			self.dispatcher.handle_close()
+
+	@property
+	def is_alive(self):
+		"""
+			Checks if the connection is still alive, a connection with
+			unread data is considered alive.
+
+			:Returns:
+				A bool, True when still connected, else False
+		"""
+
+		if not self.dispatcher:
+			return False
+
+		return self.dispatcher.alive or len(self.dispatcher.in_buffer) > 0
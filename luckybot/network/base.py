@@ -12,8 +12,11 @@ sockets more flexible.
 """
 
 from abc import ABCMeta, abstractmethod, abstractproperty
+import select
 import socket
-import traceback
+import time
+
+from luckybot.network import resolver
 
 from errno import EALREADY, EINPROGRESS, EWOULDBLOCK, ECONNRESET, \
 	 ENOTCONN, ESHUTDOWN, EINTR, EISCONN, errorcode
@@ -54,39 +57,208 @@ class BaseSocket(object):
 		"""
 		pass
 
+	def recv_batch(self, max_bytes=None):
+		"""
+			Returns all data which is available right now, connections
+			which can read more than one chunk at once override this
+
+			:Args:
+				* max_bytes (int): Stop reading after this many bytes,
+				  the rest is returned by the next call
+
+			:Returns:
+				A string, empty when there's nothing available
+		"""
+
+		return self.recv()
+
+	@property
+	def has_pending(self):
+		"""
+			Checks if data is left over from the last :meth:`recv_batch`
+			call, so the main loop shouldn't wait for new activity
+		"""
+
+		return False
+
+class HappyEyeballs(object):
+	"""
+		Connects to the first address which answers, trying the next
+		address when the previous ones haven't connected within a short
+		delay, so an address which doesn't respond (for example a broken
+		IPv6 route) doesn't hold up the connection (RFC 8305).
+
+		All sockets are non blocking, call :meth:`step` when any of
+		:meth:`sockets` is writable, or when :meth:`timeout` expires.
+	"""
+
+	def __init__(self, addresses, attempt_delay=0.25):
+		"""
+			Starts connecting to the first address
+
+			:Args:
+				* addresses (list): Result of getaddrinfo
+				* attempt_delay (float): Seconds to wait before trying the
+				  next address
+		"""
+
+		self.candidates = list(addresses)
+		self.attempt_delay = attempt_delay
+		self.attempts = {}
+		self.next_attempt = 0
+		self.connected = None
+		self.error = None
+
+		self.start_next(time.time())
+
+	def start_next(self, now):
+		"""
+			Starts connecting to the next address
+		"""
+
+		while self.candidates:
+			af, socktype, proto, canonname, sa = self.candidates.pop(0)
+
+			try:
+				sock = socket.socket(af, socktype, proto)
+				sock.setblocking(0)
+				error = sock.connect_ex(sa)
+			except socket.error as e:
+				self.error = e
+				continue
+
+			if error in (0, EINPROGRESS, EWOULDBLOCK):
+				self.attempts[sock] = sa
+				self.next_attempt = now + self.attempt_delay
+				return
+
+			sock.close()
+			self.error = socket.error(error, errorcode.get(error, str(error)))
+
+		self.next_attempt = None
+
+	def sockets(self):
+		return self.attempts.keys()
+
+	def timeout(self, now):
+		"""
+			Returns the number of seconds until the next address should
+			be tried, or None when there are no addresses left
+		"""
+
+		if self.next_attempt is None:
+			return None
+
+		return max(self.next_attempt - now, 0)
+
+	def step(self, writables, now=None):
+		"""
+			Checks the attempts which became writable, and starts the next
+			attempt when it's time
+
+			:Args:
+				* writables (list): Sockets reported writable by select
+
+			:Returns:
+				The connected socket, or None when still connecting
+
+			:Raises:
+				socket.error when all addresses failed
+		"""
+
+		if now is None:
+			now = time.time()
+
+		for sock in writables:
+			if sock not in self.attempts:
+				continue
+
+			error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+			if error:
+				del self.attempts[sock]
+				sock.close()
+				self.error = socket.error(error, errorcode.get(error, str(error)))
+
+				# Don't wait for the delay when an attempt fails
+				self.next_attempt = now
+				continue
+
+			# Connected, give up the others
+			del self.attempts[sock]
+			self.cancel()
+			self.connected = sock
+
+			return sock
+
+		if self.next_attempt is not None and now >= self.next_attempt:
+			self.start_next(now)
+
+		if not self.attempts and not self.candidates:
+			raise self.error or socket.error((-1, "Could not open socket"))
+
+		return None
+
+	def cancel(self):
+		for sock in self.attempts:
+			sock.close()
+
+		self.attempts = {}
+		self.candidates = []
+		self.next_attempt = None
+
 class Socket(BaseSocket):
 	"""
 		A simple synchronous connection to some host
 	"""
 
-	def open(self, addr):
+	# Maximum number of seconds to wait for a connection
+	connect_timeout = 30.0
+
+	def open(self, addr, addrinfo=None):
 		"""
-			Opens and creates a new socket object, connecting to the given address
+			Opens and creates a new socket object, connecting to the given
+			address. All resolved addresses are tried in parallel, with a
+			small delay between each attempt.
 
 			:Args:
 				* addr (tuple): A tuple containing the address and port
+				* addrinfo (list): The addresses of the host, as returned
+				  by :func:`luckybot.network.resolver.getaddrinfo`, they
+				  are looked up when not given
 		"""
 
-		for res in socket.getaddrinfo(addr[0], addr[1], socket.AF_UNSPEC, self.type):
-			af, socktype, proto, canonname, sa = res
-			try:
-				self._socket = socket.socket(af, self.type, proto)
-			except socket.error, msg:
-				self._socket = None
-				traceback.print_exc()
-				continue
+		self._socket = None
+
+		if addrinfo is None:
+			addrinfo = resolver.getaddrinfo(addr[0], addr[1], self.type)
+
+		connector = HappyEyeballs(addrinfo)
+		if not connector.sockets():
+			raise connector.error or socket.error((-1, "Could not open socket"))
+
+		deadline = time.time() + self.connect_timeout
+
+		while self._socket is None:
+			now = time.time()
+			if now >= deadline:
+				connector.cancel()
+				raise socket.error((-1, "Timeout while connecting to %s" % addr[0]))
+
+			timeout = connector.timeout(now)
+			if timeout is None or timeout > deadline - now:
+				timeout = deadline - now
+
 			try:
-				self._socket.connect(sa)
-			except socket.error, msg:
-				self._socket.close()
-				self._socket = None
-				traceback.print_exc()
+				r, writables, e = select.select([], connector.sockets(), [], timeout)
+			except select.error as e:
+				if e.args[0] != EINTR:
+					raise
+
 				continue
-			break
 
-		if self._socket == None:
-			raise socket.error((-1, "Could not open socket"))
+			self._socket = connector.step(writables)
 
+		self._socket.setblocking(1)
 		self.connected = True
 		self._fileno = self._socket.fileno()
 
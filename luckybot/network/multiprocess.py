@@ -11,22 +11,27 @@ socket running in its own process.
 .. moduleauthor:: Lucas van Dijk <info@return1.net>
 """
 
-from multiprocessing import Process, Queue, Value
+from multiprocessing import Process, Queue
 from Queue import Empty
 import socket
 import select
 
 from luckybot.network.base import BaseSocket, Socket
+from luckybot.network import resolver
+from luckybot.network.reactor import socket_map
+from luckybot.network.ringbuffer import RingBuffer, DEFAULT_SIZE
 
 from errno import EALREADY, EINPROGRESS, EWOULDBLOCK, ECONNRESET, \
 	 ENOTCONN, ESHUTDOWN, EINTR, EISCONN, errorcode
 
 class SocketProcess(Process):
 	"""
-		This is the worker process for a specific connection
+		This is the worker process for a specific connection. It sleeps
+		until either the socket or the send queue has data, so queued
+		lines are sent as soon as they're put in the queue.
 	"""
 
-	def __init__(self, type, addr, recv_queue, send_queue):
+	def __init__(self, type, addr, recv_queue, send_queue, addrinfo=None):
 		"""
 			Initializes the worker
 
@@ -40,6 +45,8 @@ class SocketProcess(Process):
 					where received data is put in
 				* send_queue (:class:`multiprocessing.Queue`): The queue
 					which contains the data to be sent
+				* addrinfo (list): The addresses of the host, resolved by
+					the controller so its cache is used
 
 			.. seealso::
 				Python mod:`socket` module
@@ -51,44 +58,59 @@ class SocketProcess(Process):
 		self.send_queue = send_queue
 		self.type = type
 		self.addr = addr
-		self.check_for_send_queue = Value('b', True)
+		self.addrinfo = addrinfo
+
+		# Data taken from the send queue which hasn't been sent yet
 		self.buffer = ""
+		self.quitting = False
 
-	def poll(self, writeable, timeout=1.0):
+	def poll(self, timeout=None):
 		"""
-			Checks if our connection is readable or writeable, and if so
-			calls the desired function
+			Waits until our connection is readable, or the send queue has
+			data, and handles it. The pipe of the send queue acts as
+			doorbell, and the socket is only watched for writing while
+			there's data the kernel didn't accept yet.
+
+			:Args:
+				* timeout (float): Maximum time to wait, None to wait
+				  until something happens
+
+			:Returns:
+				A bool, False when the connection should be closed
 		"""
 
-		readables = []
-		writeables = []
-		errors = []
-		readables.append(self.connection._socket)
+		sock = self.connection.socket
+		doorbell = self.send_queue._reader.fileno()
 
-		if self.check_for_send_queue.value or writeable:
-			writeables.append(self.connection._socket)
+		readables = [sock]
+		if not self.quitting:
+			readables.append(doorbell)
 
-		errors.append(self.connection._socket)
+		writeables = [sock] if self.buffer else []
 
 		try:
-			readables, writables, errors = select.select(readables, writeables, errors, timeout)
-		except socket.error as e:
+			readables, writeables, errors = select.select(readables, writeables, [sock], timeout)
+		except select.error as e:
 			if e.args[0] == EINTR:
-				return
+				return True
 
 			raise
 
-		read_success = True
-		write_success = True
+		if errors:
+			return False
 
-		if readables:
-			read_success = self.read_data()
+		if doorbell in readables:
+			self.check_queue()
 
-		if writeables:
-			write_success = self.check_queue()
+		if sock in readables and not self.read_data():
+			return False
 
-		return read_success and write_success and not errors
+		# Try to send new data right away, the socket is usually
+		# writable, and otherwise select tells us when it is
+		if self.buffer and not self.write_data():
+			return False
 
+		return not (self.quitting and not self.buffer)
 
 	def read_data(self):
 		"""
@@ -98,6 +120,9 @@ class SocketProcess(Process):
 		try:
 			data = self.connection.recv(4096)
 		except socket.error as e:
+			if e.args[0] in (EWOULDBLOCK, EINTR):
+				return True
+
 			# Connection closed
 			print "No data, print exception"
 			import traceback
@@ -114,20 +139,41 @@ class SocketProcess(Process):
 
 	def check_queue(self):
 		"""
-			Checks the send queue, and sends all data in it
+			Moves all data in the send queue to the outgoing buffer.
+			Nothing after a QUIT is sent.
 		"""
 
+		chunks = [self.buffer]
 		while True:
 			try:
-				data = self.send_queue.get(timeout=2)
-				self.connection.send(data)
-
-				if data.startswith("QUIT"):
-					return False
+				data = self.send_queue.get(False)
 			except Empty:
-				self.check_for_send_queue.value = False
 				break
 
+			chunks.append(data)
+
+			if data.startswith("QUIT"):
+				self.quitting = True
+				break
+
+		self.buffer = "".join(chunks)
+
+	def write_data(self):
+		"""
+			Sends as much of the outgoing buffer as the socket accepts,
+			all queued lines in one call. The rest is kept for when the
+			socket is writable again.
+		"""
+
+		try:
+			sent = self.connection.send(self.buffer)
+		except socket.error as e:
+			if e.args[0] in (EWOULDBLOCK, EINTR):
+				return True
+
+			return False
+
+		self.buffer = self.buffer[sent:]
 		return True
 
 	def run(self):
@@ -137,14 +183,14 @@ class SocketProcess(Process):
 		"""
 
 		self.connection = Socket(self.type)
-		self.connection.open(self.addr)
+		self.connection.open(self.addr, self.addrinfo)
 		self.connection.setblocking(0)
 
 		result = True
 
 		while result:
 			try:
-				result = self.poll(self.check_for_send_queue.value, 0.1)
+				result = self.poll()
 			except KeyboardInterrupt:
 				break
 
@@ -160,6 +206,67 @@ class SocketProcess(Process):
 
 		return 0
 
+class QueueWatcher(object):
+	"""
+		Registers the receive queue of a :class:`MultiProcessSocket` with
+		the reactor, so the main loop wakes up when the socket process has
+		put data in it.
+	"""
+
+	accepting = False
+
+	def __init__(self, connection):
+		self.connection = connection
+		self.ready = False
+		self._fileno = self.get_fileno()
+
+		socket_map[self._fileno] = self
+
+	def get_fileno(self):
+		return self.connection.recv_queue._reader.fileno()
+
+	def readable(self):
+		# Stop watching the queue when the socket process is gone
+		if not self.connection.is_alive:
+			self.handle_close()
+			return False
+
+		return True
+
+	def writable(self):
+		return False
+
+	def handle_read_event(self):
+		self.ready = True
+
+	def handle_write_event(self):
+		pass
+
+	def handle_expt_event(self):
+		pass
+
+	def handle_close(self):
+		if socket_map.get(self._fileno) is self:
+			del socket_map[self._fileno]
+
+	def handle_error(self):
+		import traceback
+		traceback.print_exc()
+
+		self.handle_close()
+
+class DoorbellWatcher(QueueWatcher):
+	"""
+		Registers the doorbell of a receive ring with the reactor
+	"""
+
+	def get_fileno(self):
+		return self.connection.recv_ring.doorbell.fileno()
+
+	def handle_read_event(self):
+		self.connection.recv_ring.doorbell.drain()
+		self.ready = True
+
 class MultiProcessSocket(BaseSocket):
 	"""
 		This connection will be run in a seperate subprocess
@@ -171,6 +278,8 @@ class MultiProcessSocket(BaseSocket):
 		self.recv_queue = Queue()
 		self.send_queue = Queue()
 		self.process = None
+		self.watcher = None
+		self.quit_pending = None
 
 	def open(self, addr):
 		"""
@@ -181,28 +290,78 @@ class MultiProcessSocket(BaseSocket):
 		"""
 		self.addr = addr
 
+		# Resolve here instead of in the subprocess, so the lookup is
+		# cached for the next connection
+		addrinfo = resolver.getaddrinfo(addr[0], addr[1], self.type)
+
 		self.process = SocketProcess(self.type, addr,
-			self.recv_queue, self.send_queue)
+			self.recv_queue, self.send_queue, addrinfo)
 
 		self.process.start()
+		self.watcher = QueueWatcher(self)
 
 	def send(self, data):
 		"""
-			Puts data in the send queue
+			Puts data in the send queue, which wakes up the process
 		"""
+
+		if isinstance(data, unicode):
+			data = data.encode('utf-8')
+
 		self.send_queue.put(data)
-		self.process.check_for_send_queue.value = True
 
 	def recv(self):
 		"""
-			Returns the first item from the queue
+			Returns all items in the queue, if the reactor noticed
+			there's data available
 		"""
 
-		try:
-			return self.recv_queue.get(timeout=0.3)
-		except Empty:
+		return self.recv_batch()
+
+	def recv_batch(self, max_bytes=None):
+		"""
+			Takes items from the queue until it's empty, or the given
+			number of bytes has been read. The QUIT sent by the process
+			when it ends is always returned on its own.
+
+			:Args:
+				* max_bytes (int): Maximum number of bytes to read
+		"""
+
+		if self.quit_pending:
+			data = self.quit_pending
+			self.quit_pending = None
+
+			return data
+
+		if not self.watcher or not self.watcher.ready:
 			return ""
 
+		chunks = []
+		size = 0
+		while max_bytes is None or size < max_bytes:
+			try:
+				data = self.recv_queue.get(False)
+			except Empty:
+				self.watcher.ready = False
+				break
+
+			if data.startswith("QUIT"):
+				if not chunks:
+					return data
+
+				self.quit_pending = data
+				break
+
+			chunks.append(data)
+			size += len(data)
+
+		return "".join(chunks)
+
+	@property
+	def has_pending(self):
+		return self.quit_pending is not None or bool(self.watcher and self.watcher.ready)
+
 	def close(self):
 		"""
 			Sends QUIT command to subprocess
@@ -219,3 +378,269 @@ class MultiProcessSocket(BaseSocket):
 				A bool, True when still connected, else False
 		"""
 		return self.process and self.process.is_alive()
+
+class RingSocketProcess(Process):
+	"""
+		Worker process for a connection which exchanges data with the
+		controller through shared memory rings
+	"""
+
+	def __init__(self, type, addr, recv_ring, send_ring, addrinfo=None):
+		"""
+			Initializes the worker
+
+			:Args:
+				* type (int): Socket type, for example socket.SOCK_STREAM
+				* addr (tuple): Where to connect to (address, port)
+				* recv_ring (:class:`luckybot.network.ringbuffer.RingBuffer`):
+				  The ring where received data is written to
+				* send_ring (:class:`luckybot.network.ringbuffer.RingBuffer`):
+				  The ring which contains the data to be sent
+				* addrinfo (list): The addresses of the host, resolved by
+				  the controller
+		"""
+
+		Process.__init__(self)
+
+		self.type = type
+		self.addr = addr
+		self.addrinfo = addrinfo
+		self.recv_ring = recv_ring
+		self.send_ring = send_ring
+
+	def run(self):
+		"""
+			Runs the process, opens up a connection, and moves data
+			between the socket and the rings until either side closes
+		"""
+
+		try:
+			self.connection = Socket(self.type)
+			self.connection.open(self.addr, self.addrinfo)
+			self.connection.setblocking(0)
+		except socket.error:
+			import traceback
+			traceback.print_exc()
+
+			self.recv_ring.close()
+			return 0
+
+		try:
+			self.loop()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			self.recv_ring.close()
+			self.connection.close()
+
+		print "End of Process"
+
+		return 0
+
+	def loop(self):
+		sock = self.connection.socket
+		doorbell = self.send_ring.doorbell
+
+		# Data received but not yet in the ring, and data to be sent
+		incoming = ""
+		outgoing = ""
+
+		while True:
+			readables = [doorbell]
+			timeout = None
+			if incoming:
+				# The receive ring is full, wait until the controller
+				# made some room
+				self.recv_ring.writer_waiting.value = True
+				readables.append(self.recv_ring.space)
+				timeout = 0.05
+			else:
+				readables.append(sock)
+
+			writeables = [sock] if outgoing else []
+
+			try:
+				readables, writeables, errors = select.select(readables, writeables, [], timeout)
+			except select.error as e:
+				if e.args[0] == EINTR:
+					continue
+
+				raise
+
+			if doorbell in readables:
+				doorbell.drain()
+				outgoing += self.send_ring.read()
+
+			if self.recv_ring.space in readables:
+				self.recv_ring.space.drain()
+
+			if sock in readables:
+				try:
+					data = sock.recv(16384)
+				except socket.error as e:
+					if e.args[0] not in (EWOULDBLOCK, EINTR):
+						return
+
+					data = None
+
+				if data == "":
+					# Connection closed
+					return
+
+				if data:
+					incoming += data
+
+			if incoming:
+				written = self.recv_ring.write(incoming)
+				incoming = incoming[written:]
+
+			if outgoing:
+				try:
+					sent = sock.send(outgoing)
+					outgoing = outgoing[sent:]
+				except socket.error as e:
+					if e.args[0] not in (EWOULDBLOCK, EINTR):
+						return
+
+			if self.send_ring.is_closed and not outgoing and not len(self.send_ring):
+				return
+
+class RingSocket(BaseSocket):
+	"""
+		This connection runs in a seperate subprocess, like
+		:class:`MultiProcessSocket`, but data is passed through shared
+		memory rings instead of queues, so it doesn't have to be pickled.
+	"""
+
+	def __init__(self, type, size=DEFAULT_SIZE):
+		BaseSocket.__init__(self, type)
+
+		self.size = size
+		self.recv_ring = None
+		self.send_ring = None
+		self.process = None
+		self.watcher = None
+		self.pending = ""
+		self.quit_reported = False
+		self.closed = False
+
+	def open(self, addr):
+		"""
+			Creates the rings and a new subprocess for this connection
+
+			:Args:
+				* addr (tuple): Where to connect to (address, port)
+		"""
+
+		self.addr = addr
+		addrinfo = resolver.getaddrinfo(addr[0], addr[1], self.type)
+
+		self.recv_ring = RingBuffer(self.size)
+		self.send_ring = RingBuffer(self.size)
+
+		self.process = RingSocketProcess(self.type, addr, self.recv_ring,
+			self.send_ring, addrinfo)
+		self.process.start()
+		self.watcher = DoorbellWatcher(self)
+
+	def flush_pending(self):
+		"""
+			Writes data which didn't fit in the send ring before
+		"""
+
+		if self.pending:
+			written = self.send_ring.write(self.pending)
+			self.pending = self.pending[written:]
+
+	def send(self, data):
+		"""
+			Writes data to the send ring
+		"""
+
+		if self.closed:
+			return
+
+		if isinstance(data, unicode):
+			data = data.encode('utf-8')
+
+		self.pending += data
+		self.flush_pending()
+
+	def recv(self):
+		"""
+			Returns all data in the receive ring, if the reactor noticed
+			the doorbell. When the process has closed the ring, QUIT is
+			returned like the other connection classes do.
+		"""
+
+		return self.recv_batch()
+
+	def recv_batch(self, max_bytes=None):
+		"""
+			Returns the data in the receive ring, up to the given number
+			of bytes
+
+			:Args:
+				* max_bytes (int): Maximum number of bytes to read
+		"""
+
+		self.flush_pending()
+
+		if not self.watcher or not self.watcher.ready:
+			return ""
+
+		data = self.recv_ring.read(max_bytes)
+		if data:
+			return data
+
+		self.watcher.ready = False
+
+		if self.recv_ring.is_closed and not self.quit_reported:
+			self.quit_reported = True
+			return "QUIT\n"
+
+		return ""
+
+	def close(self):
+		"""
+			Asks the subprocess to send the remaining data and close the
+			connection
+		"""
+
+		if self.closed or not self.process:
+			return
+
+		self.closed = True
+		self.flush_pending()
+		self.send_ring.close()
+
+		if self.watcher:
+			self.watcher.handle_close()
+
+		# The subprocess has its own copies of the doorbell pipes
+		for ring in (self.recv_ring, self.send_ring):
+			ring.doorbell.close()
+			ring.space.close()
+
+	@property
+	def is_alive(self):
+		"""
+			Checks if the connection is still alive, a connection with
+			unread data is considered alive.
+
+			:Returns:
+				A bool, True when still connected, else False
+		"""
+
+		if not self.process:
+			return False
+
+		return self.process.is_alive() or len(self.recv_ring) > 0 or \
+			(self.recv_ring.is_closed and not self.quit_reported)
+
+	@property
+	def has_pending(self):
+		if not self.watcher or not self.recv_ring:
+			return False
+
+		return len(self.recv_ring) > 0 or (self.recv_ring.is_closed and not self.quit_reported)
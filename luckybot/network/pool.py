@@ -0,0 +1,666 @@
+"""
+:mod:`luckybot.network.pool` - Connection worker pool
+=====================================================
+
+This module contains a connection class which runs the sockets of all
+servers in a fixed pool of worker processes, instead of starting a
+process for each server. Each worker waits on all of its sockets at
+once with select.
+
+Servers are spread over the workers with consistent hashing, so a
+server ends up on the same worker when it reconnects, with a bound on
+the number of servers each worker gets.
+
+.. module:: luckybot.network.pool
+   :synopsis: Connection worker pool
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+
+from multiprocessing import Process, Pipe, cpu_count
+from bisect import bisect
+from hashlib import md5
+import cPickle
+import math
+import select
+import socket
+import struct
+import time
+import traceback
+
+from luckybot.network.base import BaseSocket, Socket, HappyEyeballs
+from luckybot.network import resolver
+from luckybot.network.reactor import socket_map
+
+from errno import EWOULDBLOCK, EINTR, EAGAIN
+
+# Message types between the controller and the workers
+MSG_OPEN = 1
+MSG_SEND = 2
+MSG_CLOSE = 3
+MSG_DATA = 4
+MSG_CLOSED = 5
+
+HEADER = struct.Struct('!BI')
+
+class HashRing(object):
+	"""
+		Consistent hash ring, each node is put on the ring a number of
+		times to spread the keys evenly
+	"""
+
+	def __init__(self, nodes, replicas=100):
+		self.points = []
+
+		for node in nodes:
+			for i in range(replicas):
+				self.points.append((self.hash('%s-%d' % (node, i)), node))
+
+		self.points.sort()
+		self.hashes = [point for point, node in self.points]
+
+	def hash(self, key):
+		return int(md5(key).hexdigest()[:8], 16)
+
+	def walk(self, key):
+		"""
+			Yields each node once, in the order they follow the key on
+			the ring
+		"""
+
+		if not self.points:
+			return
+
+		start = bisect(self.hashes, self.hash(key))
+		seen = set()
+		for i in xrange(len(self.points)):
+			node = self.points[(start + i) % len(self.points)][1]
+			if node not in seen:
+				seen.add(node)
+				yield node
+
+class WorkerConnection(object):
+	"""
+		A socket in a worker process
+	"""
+
+	def __init__(self, conn_id, addrinfo):
+		self.id = conn_id
+		self.outgoing = ""
+		self.closing = False
+		self.socket = None
+		self.connector = HappyEyeballs(addrinfo)
+		self.deadline = time.time() + Socket.connect_timeout
+
+		if not self.connector.sockets():
+			raise self.connector.error or socket.error((-1, "Could not open socket"))
+
+	@property
+	def connecting(self):
+		return self.socket is None
+
+	def check_connect(self, writables, now):
+		"""
+			Continues connecting
+
+			:Returns:
+				False when connecting failed
+		"""
+
+		if now >= self.deadline:
+			self.connector.cancel()
+			return False
+
+		try:
+			self.socket = self.connector.step(writables, now)
+		except socket.error:
+			return False
+
+		return True
+
+class PoolWorker(Process):
+	"""
+		Worker process which runs many connections
+	"""
+
+	def __init__(self, index, commands, events, parent_ends):
+		"""
+			Initializes the worker
+
+			:Args:
+				* index (int): Number of this worker
+				* commands (:class:`multiprocessing.Connection`): Pipe with
+				  commands from the controller
+				* events (:class:`multiprocessing.Connection`): Pipe for
+				  received data and closed connections
+				* parent_ends (list): The controller's ends of the pipes,
+				  which are closed in the worker
+		"""
+
+		Process.__init__(self, name='PoolWorker-%d' % index)
+
+		self.daemon = True
+		self.commands = commands
+		self.events = events
+		self.parent_ends = parent_ends
+		self.connections = {}
+
+	def run(self):
+		# Close the controller's ends, so we notice when it's gone
+		for end in self.parent_ends:
+			end.close()
+
+		try:
+			while self.loop():
+				pass
+		except KeyboardInterrupt:
+			pass
+
+		for connection in self.connections.values():
+			if connection.socket:
+				connection.socket.close()
+
+		return 0
+
+	def emit(self, type, conn_id, data=""):
+		self.events.send_bytes(HEADER.pack(type, conn_id) + data)
+
+	def loop(self):
+		readables = [self.commands]
+		writeables = []
+		by_socket = {}
+		timeout = None
+		now = time.time()
+
+		for connection in self.connections.values():
+			if connection.connecting:
+				for sock in connection.connector.sockets():
+					by_socket[sock] = connection
+					writeables.append(sock)
+
+				wait = connection.connector.timeout(now)
+				if wait is None or wait > connection.deadline - now:
+					wait = connection.deadline - now
+
+				if timeout is None or wait < timeout:
+					timeout = max(wait, 0)
+
+				continue
+
+			by_socket[connection.socket] = connection
+			readables.append(connection.socket)
+
+			if connection.outgoing:
+				writeables.append(connection.socket)
+
+		try:
+			readables, writeables, errors = select.select(readables, writeables, [], timeout)
+		except select.error as e:
+			if e.args[0] == EINTR:
+				return True
+
+			raise
+
+		# Connection attempts
+		now = time.time()
+		attempts = {}
+		for sock in writeables:
+			connection = by_socket[sock]
+			if connection.connecting:
+				attempts.setdefault(connection, []).append(sock)
+
+		for connection in self.connections.values():
+			if connection.connecting and not connection.check_connect(attempts.get(connection, []), now):
+				del self.connections[connection.id]
+				self.emit(MSG_CLOSED, connection.id)
+			elif connection.socket is not None and connection.closing and not connection.outgoing:
+				self.close(connection)
+
+		for sock in writeables:
+			connection = by_socket[sock]
+			if sock is connection.socket and connection.id in self.connections:
+				self.handle_write(connection)
+
+		for sock in readables:
+			if sock is self.commands:
+				if not self.handle_commands():
+					return False
+			elif by_socket[sock].id in self.connections:
+				self.handle_read(by_socket[sock])
+
+		return True
+
+	def handle_commands(self):
+		"""
+			Handles all pending commands from the controller
+
+			:Returns:
+				False when the controller is gone
+		"""
+
+		while self.commands.poll():
+			try:
+				message = self.commands.recv_bytes()
+			except EOFError:
+				return False
+
+			type, conn_id = HEADER.unpack_from(message)
+			data = message[HEADER.size:]
+
+			if type == MSG_OPEN:
+				self.open(conn_id, cPickle.loads(data))
+			elif type == MSG_SEND:
+				connection = self.connections.get(conn_id)
+				if connection:
+					connection.outgoing += data
+			elif type == MSG_CLOSE:
+				connection = self.connections.get(conn_id)
+				if connection:
+					connection.closing = True
+					if not connection.outgoing and not connection.connecting:
+						self.close(connection)
+
+		return True
+
+	def open(self, conn_id, addrinfo):
+		try:
+			connection = WorkerConnection(conn_id, addrinfo)
+		except socket.error:
+			traceback.print_exc()
+			self.emit(MSG_CLOSED, conn_id)
+			return
+
+		self.connections[conn_id] = connection
+
+	def close(self, connection):
+		del self.connections[connection.id]
+
+		if connection.connecting:
+			connection.connector.cancel()
+		else:
+			try:
+				connection.socket.close()
+			except socket.error:
+				pass
+
+		self.emit(MSG_CLOSED, connection.id)
+
+	def handle_write(self, connection):
+		if connection.outgoing:
+			try:
+				sent = connection.socket.send(connection.outgoing)
+				connection.outgoing = connection.outgoing[sent:]
+			except socket.error as e:
+				if e.args[0] not in (EWOULDBLOCK, EAGAIN, EINTR):
+					self.close(connection)
+					return
+
+		if connection.closing and not connection.outgoing:
+			self.close(connection)
+
+	def handle_read(self, connection):
+		if connection.connecting:
+			return
+
+		try:
+			data = connection.socket.recv(16384)
+		except socket.error as e:
+			if e.args[0] in (EWOULDBLOCK, EAGAIN, EINTR):
+				return
+
+			data = ""
+
+		if not data:
+			self.close(connection)
+			return
+
+		self.emit(MSG_DATA, connection.id, data)
+
+class WorkerWatcher(object):
+	"""
+		Registers the event pipe of a worker with the reactor, and hands
+		received data to the right :class:`PoolSocket`
+	"""
+
+	accepting = False
+
+	def __init__(self, pool, events):
+		self.pool = pool
+		self.events = events
+		self._fileno = events.fileno()
+
+		socket_map[self._fileno] = self
+
+	def readable(self):
+		return True
+
+	def writable(self):
+		return False
+
+	def handle_read_event(self):
+		try:
+			while self.events.poll():
+				message = self.events.recv_bytes()
+				type, conn_id = HEADER.unpack_from(message)
+
+				self.pool.handle_event(type, conn_id, message[HEADER.size:])
+		except EOFError:
+			# The worker died, so all of its connections are gone
+			self.handle_close()
+			self.pool.worker_died(self)
+
+	def handle_write_event(self):
+		pass
+
+	def handle_expt_event(self):
+		pass
+
+	def handle_close(self):
+		if socket_map.get(self._fileno) is self:
+			del socket_map[self._fileno]
+
+	def handle_error(self):
+		traceback.print_exc()
+
+class ConnectionPool(object):
+	"""
+		Fixed set of worker processes, which run the connections of all
+		:class:`PoolSocket` objects
+	"""
+
+	def __init__(self, num_workers=None, balance=0.25):
+		"""
+			Creates the pool, the workers are started when the first
+			connection is opened
+
+			:Args:
+				* num_workers (int): Number of worker processes, defaults
+				  to the number of CPUs
+				* balance (float): A worker gets at most this much more
+				  than the average number of servers
+		"""
+
+		if not num_workers:
+			try:
+				num_workers = cpu_count()
+			except NotImplementedError:
+				num_workers = 1
+
+		self.num_workers = num_workers
+		self.balance = balance
+		self.ring = HashRing(range(num_workers))
+
+		self.workers = []
+		self.sockets = {}
+		self.next_id = 1
+
+	def start(self):
+		for i in range(self.num_workers):
+			self.workers.append(self.start_worker(i))
+
+	def start_worker(self, index):
+		"""
+			Starts a worker process
+
+			:Returns:
+				A tuple (process, command pipe, event watcher)
+		"""
+
+		commands_reader, commands_writer = Pipe(False)
+		events_reader, events_writer = Pipe(False)
+
+		process = PoolWorker(index, commands_reader, events_writer,
+			[commands_writer, events_reader])
+		process.start()
+
+		commands_reader.close()
+		events_writer.close()
+
+		watcher = WorkerWatcher(self, events_reader)
+		return (process, commands_writer, watcher)
+
+	def assign(self, key):
+		"""
+			Picks the worker for a server: the first worker after the
+			key on the hash ring which isn't full yet. The capacity grows
+			with the number of servers, so adding a server never moves
+			existing ones.
+
+			:Args:
+				* key (string): Identifies the server
+
+			:Returns:
+				The worker number
+		"""
+
+		loads = [0] * self.num_workers
+		for sock in self.sockets.values():
+			loads[sock.worker] += 1
+
+		capacity = int(math.ceil((len(self.sockets) + 1) * (1 + self.balance) / self.num_workers))
+
+		for worker in self.ring.walk(key):
+			if loads[worker] < capacity:
+				return worker
+
+		return loads.index(min(loads))
+
+	def open(self, sock, addr):
+		"""
+			Opens a connection for the given socket in one of the workers
+
+			:Returns:
+				A tuple (connection id, worker number)
+		"""
+
+		# Resolved here so the workers share the cache of the controller
+		addrinfo = resolver.getaddrinfo(addr[0], addr[1], sock.type)
+
+		if not self.workers:
+			self.start()
+
+		worker = self.assign('%s:%s' % addr)
+		conn_id = self.next_id
+		self.next_id += 1
+
+		sock.worker = worker
+		self.sockets[conn_id] = sock
+		self.command(worker, MSG_OPEN, conn_id, cPickle.dumps(addrinfo, cPickle.HIGHEST_PROTOCOL))
+
+		return conn_id, worker
+
+	def command(self, worker, type, conn_id, data=""):
+		"""
+			Sends a command to a worker, when the worker is gone it's
+			replaced and :class:`socket.error` is raised
+		"""
+
+		try:
+			self.workers[worker][1].send_bytes(HEADER.pack(type, conn_id) + data)
+		except (IOError, OSError, EOFError) as e:
+			self.worker_died(self.workers[worker][2])
+			raise socket.error(getattr(e, 'errno', None), "Connection worker %d is gone" % worker)
+
+	def handle_event(self, type, conn_id, data):
+		sock = self.sockets.get(conn_id)
+		if sock is None:
+			return
+
+		if type == MSG_DATA:
+			sock.in_buffer.append(data)
+		elif type == MSG_CLOSED:
+			del self.sockets[conn_id]
+			sock.connection_closed()
+
+	def worker_died(self, watcher):
+		"""
+			Closes the connections of a worker which died, and starts a
+			new worker in its place, so servers keep their place on the
+			hash ring
+		"""
+
+		for index, (process, commands, worker_watcher) in enumerate(self.workers):
+			if worker_watcher is watcher:
+				break
+		else:
+			# Already replaced
+			return
+
+		for conn_id, sock in self.sockets.items():
+			if sock.worker == index:
+				del self.sockets[conn_id]
+				sock.connection_closed()
+
+		watcher.handle_close()
+		watcher.events.close()
+		commands.close()
+
+		if process.is_alive():
+			process.terminate()
+
+		process.join()
+
+		print "Connection worker %d died, starting a new one" % index
+		self.workers[index] = self.start_worker(index)
+
+	def stats(self):
+		"""
+			Returns the number of servers on each worker
+		"""
+
+		loads = [0] * self.num_workers
+		for sock in self.sockets.values():
+			loads[sock.worker] += 1
+
+		return loads
+
+# The pool shared by all pool sockets, created on first use
+default_pool = None
+
+def get_pool():
+	global default_pool
+
+	if default_pool is None:
+		default_pool = ConnectionPool()
+
+	return default_pool
+
+def setup(num_workers=None):
+	"""
+		Configures the shared pool, must be called before the first
+		server connects
+
+		:Args:
+			* num_workers (int): Number of worker processes, defaults to
+			  the number of CPUs
+	"""
+
+	global default_pool
+
+	default_pool = ConnectionPool(num_workers)
+
+class PoolSocket(BaseSocket):
+	"""
+		A connection which runs in the shared worker pool
+	"""
+
+	def __init__(self, type):
+		BaseSocket.__init__(self, type)
+
+		self.pool = None
+		self.conn_id = None
+		self.worker = None
+		self.in_buffer = []
+		self.alive = False
+
+	def open(self, addr):
+		"""
+			Asks a worker to connect to the given address
+
+			:Args:
+				* addr (tuple): Where to connect to (address, port)
+		"""
+
+		self.addr = addr
+		self.pool = get_pool()
+		self.conn_id, self.worker = self.pool.open(self, addr)
+		self.alive = True
+
+	def connection_closed(self):
+		self.alive = False
+		self.in_buffer.append("QUIT\n")
+
+	def send(self, data):
+		if not self.alive:
+			return
+
+		if isinstance(data, unicode):
+			data = data.encode('utf-8')
+
+		try:
+			self.pool.command(self.worker, MSG_SEND, self.conn_id, data)
+		except socket.error:
+			# The worker died, the connection has been closed already
+			pass
+
+	def recv(self):
+		return self.recv_batch()
+
+	def recv_batch(self, max_bytes=None):
+		"""
+			Returns the data received since the last call, up to the given
+			number of bytes. The QUIT added when the connection closes is
+			always returned on its own.
+
+			:Args:
+				* max_bytes (int): Maximum number of bytes to read
+		"""
+
+		in_buffer = self.in_buffer
+		if not in_buffer:
+			return ""
+
+		if in_buffer[0] == "QUIT\n":
+			del in_buffer[0]
+			return "QUIT\n"
+
+		size = 0
+		count = 0
+		for chunk in in_buffer:
+			if chunk == "QUIT\n" or (max_bytes is not None and size >= max_bytes):
+				break
+
+			size += len(chunk)
+			count += 1
+
+		data = "".join(in_buffer[:count])
+		del in_buffer[:count]
+
+		return data
+
+	@property
+	def has_pending(self):
+		return bool(self.in_buffer)
+
+	def close(self):
+		"""
+			Closes the connection, after all pending data has been sent
+		"""
+
+		if self.alive:
+			try:
+				self.pool.command(self.worker, MSG_CLOSE, self.conn_id)
+			except socket.error:
+				pass
+
+	@property
+	def is_alive(self):
+		"""
+			Checks if the connection is still alive, a connection with
+			unread data is considered alive.
+
+			:Returns:
+				A bool, True when still connected, else False
+		"""
+
+		return self.alive or len(self.in_buffer) > 0
@@ -0,0 +1,235 @@
+"""
+:mod:`luckybot.network.reactor` - Readiness based event dispatcher
+==================================================================
+
+This module contains the reactor which waits until any of the registered
+file descriptors is ready, and dispatches the event to the object
+responsible for it. Objects in the map follow the :class:`asyncore.dispatcher`
+interface.
+
+.. module:: luckybot.network.reactor
+   :synopsis: Readiness based event dispatcher
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+
+import asyncore
+import fcntl
+import os
+import select
+import traceback
+from collections import deque
+from errno import EINTR, ENOENT, EBADF, EAGAIN
+
+# Map of file descriptors to their dispatcher objects, shared by all
+# connection classes which want to be woken up by the reactor
+socket_map = {}
+
+class Waker(object):
+	"""
+		Wakes up the reactor from another thread through a pipe, and
+		runs the functions those threads scheduled on the main thread.
+	"""
+
+	accepting = False
+
+	def __init__(self, map):
+		self.read_fd, self.write_fd = os.pipe()
+
+		for fd in (self.read_fd, self.write_fd):
+			flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+			fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+		self.callbacks = deque()
+		map[self.read_fd] = self
+
+	def wake(self, func, *args):
+		"""
+			Schedules a function to be called on the main thread, safe
+			to call from any thread
+
+			:Args:
+				* func (function): The function to call
+				* Further arguments are passed to the function
+		"""
+
+		self.callbacks.append((func, args))
+
+		try:
+			os.write(self.write_fd, 'x')
+		except OSError as e:
+			# The pipe is full, so the reactor wakes up anyway
+			if e.errno != EAGAIN:
+				raise
+
+	def readable(self):
+		return True
+
+	def writable(self):
+		return False
+
+	def handle_read_event(self):
+		try:
+			os.read(self.read_fd, 4096)
+		except OSError as e:
+			if e.errno != EAGAIN:
+				raise
+
+		while self.callbacks:
+			func, args = self.callbacks.popleft()
+
+			try:
+				func(*args)
+			except Exception:
+				traceback.print_exc()
+
+	def handle_write_event(self):
+		pass
+
+	def handle_expt_event(self):
+		pass
+
+	def handle_close(self):
+		pass
+
+	def handle_error(self):
+		traceback.print_exc()
+
+class Reactor(object):
+	"""
+		Waits for activity on any file descriptor in the socket map, using
+		epoll when available, and falls back to poll or select otherwise.
+	"""
+
+	def __init__(self, map=None):
+		"""
+			Constructor, creates the poller object
+
+			:Args:
+				* map (dict): Map of file descriptors to dispatchers,
+				  defaults to the shared socket map
+		"""
+
+		self.map = socket_map if map is None else map
+		self.epoll = select.epoll() if hasattr(select, 'epoll') else None
+		self.registered = {}
+
+		# The dispatcher each file descriptor was registered for
+		self.objects = {}
+		self.waker = Waker(self.map)
+
+	def call_from_thread(self, func, *args):
+		"""
+			Schedules a function to be called on the main thread, and
+			wakes up the reactor. This is the only reactor method which
+			is safe to call from other threads.
+
+			:Args:
+				* func (function): The function to call
+				* Further arguments are passed to the function
+		"""
+
+		self.waker.wake(func, *args)
+
+	def get_eventmask(self, obj):
+		"""
+			Returns the poll event mask for the given dispatcher
+		"""
+
+		mask = 0
+		if obj.readable():
+			mask |= select.POLLIN | select.POLLPRI
+
+		if obj.writable() and not getattr(obj, 'accepting', False):
+			mask |= select.POLLOUT
+
+		return mask
+
+	def update_registrations(self):
+		"""
+			Synchronizes the epoll registrations with the current state
+			of each dispatcher in the map
+		"""
+
+		for fd in self.registered.keys():
+			if fd not in self.map:
+				self.unregister(fd)
+
+		for fd, obj in self.map.items():
+			mask = self.get_eventmask(obj)
+
+			# A new dispatcher got the number of a file descriptor which
+			# was closed, epoll forgot about the old one
+			if self.objects.get(fd) is not obj:
+				self.unregister(fd)
+
+			if not mask:
+				self.unregister(fd)
+			elif fd not in self.registered:
+				self.epoll.register(fd, mask)
+				self.registered[fd] = mask
+				self.objects[fd] = obj
+			elif self.registered[fd] != mask:
+				try:
+					self.epoll.modify(fd, mask)
+				except IOError as e:
+					# The file descriptor has been closed and reused in
+					# the meantime, so epoll already forgot about it
+					if e.errno != ENOENT:
+						raise
+
+					self.epoll.register(fd, mask)
+
+				self.registered[fd] = mask
+
+	def unregister(self, fd):
+		"""
+			Removes a file descriptor from epoll
+		"""
+
+		if fd not in self.registered:
+			return
+
+		del self.registered[fd]
+		del self.objects[fd]
+
+		try:
+			self.epoll.unregister(fd)
+		except IOError as e:
+			if e.errno not in (ENOENT, EBADF):
+				raise
+
+	def poll(self, timeout=None):
+		"""
+			Waits until any file descriptor is ready, or the timeout
+			expires, and calls the handlers of the ready dispatchers.
+
+			:Args:
+				* timeout (float): Maximum time to wait in seconds, None
+				  to wait until there's activity
+		"""
+
+		if self.epoll is None:
+			if hasattr(select, 'poll'):
+				asyncore.poll2(timeout, self.map)
+			else:
+				asyncore.poll(timeout, self.map)
+
+			return
+
+		self.update_registrations()
+
+		try:
+			events = self.epoll.poll(-1 if timeout is None else timeout)
+		except IOError as e:
+			if e.errno == EINTR:
+				return
+
+			raise
+
+		for fd, flags in events:
+			obj = self.map.get(fd)
+			if obj is None:
+				continue
+
+			asyncore.readwrite(obj, flags)
@@ -0,0 +1,131 @@
+"""
+:mod:`luckybot.network.resolver` - Caching name resolver
+========================================================
+
+This module contains a wrapper around :func:`socket.getaddrinfo` which
+remembers the results for a while, so reconnecting to a server doesn't
+need another DNS lookup.
+
+.. module:: luckybot.network.resolver
+   :synopsis: Caching name resolver
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+
+import socket
+import threading
+import time
+
+class Resolver(object):
+	"""
+		Resolves host names, and caches the results. Failed lookups are
+		cached for a shorter time.
+	"""
+
+	def __init__(self, ttl=300.0, negative_ttl=30.0):
+		"""
+			Constructor
+
+			:Args:
+				* ttl (float): Seconds to remember resolved addresses
+				* negative_ttl (float): Seconds to remember failed lookups
+		"""
+
+		self.ttl = ttl
+		self.negative_ttl = negative_ttl
+		self.cache = {}
+		self.lock = threading.Lock()
+
+		# Metrics
+		self.hits = 0
+		self.misses = 0
+
+	def getaddrinfo(self, host, port, type=socket.SOCK_STREAM):
+		"""
+			Resolves the given host, see :func:`socket.getaddrinfo`
+
+			:Args:
+				* host (string): Host name or address
+				* port (int): Port number
+				* type (int): Socket type
+
+			:Returns:
+				A list of (family, type, proto, canonname, sockaddr)
+				tuples, with the address families interleaved
+		"""
+
+		key = (host, port, type)
+		now = time.time()
+
+		with self.lock:
+			entry = self.cache.get(key)
+			if entry is not None and entry[0] > now:
+				self.hits += 1
+				if isinstance(entry[1], socket.error):
+					raise entry[1]
+
+				return list(entry[1])
+
+			self.misses += 1
+
+		try:
+			result = interleave(socket.getaddrinfo(host, port, socket.AF_UNSPEC, type))
+		except socket.error as e:
+			with self.lock:
+				self.cache[key] = (now + self.negative_ttl, e)
+
+			raise
+
+		with self.lock:
+			self.cache[key] = (now + self.ttl, result)
+
+		return list(result)
+
+	def clear(self):
+		with self.lock:
+			self.cache.clear()
+
+def interleave(addrinfo):
+	"""
+		Reorders addresses so the address families alternate, starting
+		with the family of the first address, as recommended for Happy
+		Eyeballs (RFC 8305).
+	"""
+
+	if not addrinfo:
+		return addrinfo
+
+	first_family = addrinfo[0][0]
+	first = [info for info in addrinfo if info[0] == first_family]
+	other = [info for info in addrinfo if info[0] != first_family]
+
+	result = []
+	for i in range(max(len(first), len(other))):
+		if i < len(first):
+			result.append(first[i])
+
+		if i < len(other):
+			result.append(other[i])
+
+	return result
+
+# Resolver shared by all connections, a process which is forked from the
+# bot starts with the addresses the bot already resolved
+default_resolver = Resolver()
+
+def setup(ttl):
+	"""
+		Changes how long the shared resolver caches addresses
+
+		:Args:
+			* ttl (float): Seconds to remember resolved addresses
+	"""
+
+	default_resolver.ttl = ttl
+
+def getaddrinfo(host, port, type=socket.SOCK_STREAM):
+	"""
+		Resolves the given host with the shared resolver
+	"""
+
+	return default_resolver.getaddrinfo(host, port, type)
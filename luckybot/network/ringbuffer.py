@@ -0,0 +1,229 @@
+"""
+:mod:`luckybot.network.ringbuffer` - Shared memory ring buffer
+==============================================================
+
+This module contains a byte ring buffer in shared memory, for passing
+data from one process to another without pickling it. Each ring has
+exactly one writing and one reading process, and two pipes which are
+used as doorbells: one wakes up the reader when data is written, the
+other wakes up a writer waiting for room when data is read. Doorbells
+are only rung when the other side said it's going to wait, so a burst
+of writes costs one wakeup instead of one per write.
+
+The read and write positions only ever grow, the writer only changes the
+head, and the reader only changes the tail, so no locks are needed.
+
+.. module:: luckybot.network.ringbuffer
+   :synopsis: Shared memory ring buffer
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+
+from multiprocessing.sharedctypes import RawArray, RawValue
+import ctypes
+import fcntl
+import os
+import select
+from errno import EAGAIN, EINTR
+
+DEFAULT_SIZE = 256 * 1024
+
+class Doorbell(object):
+	"""
+		Non blocking pipe which wakes up a process waiting in select
+	"""
+
+	def __init__(self):
+		self.read_fd, self.write_fd = os.pipe()
+
+		for fd in (self.read_fd, self.write_fd):
+			flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+			fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+	def ring(self):
+		try:
+			os.write(self.write_fd, 'x')
+		except OSError as e:
+			# A full pipe wakes up the reader anyway
+			if e.errno not in (EAGAIN, EINTR):
+				raise
+
+	def drain(self):
+		while True:
+			try:
+				if not os.read(self.read_fd, 4096):
+					return
+			except OSError as e:
+				if e.errno == EINTR:
+					continue
+
+				if e.errno != EAGAIN:
+					raise
+
+				return
+
+	def fileno(self):
+		return self.read_fd
+
+	def close(self):
+		for fd in (self.read_fd, self.write_fd):
+			try:
+				os.close(fd)
+			except OSError:
+				pass
+
+class RingBuffer(object):
+	"""
+		Single producer, single consumer byte ring in shared memory.
+
+		The ring must be created before the other process is forked, so
+		both processes share the same memory and doorbell.
+	"""
+
+	def __init__(self, size=DEFAULT_SIZE):
+		"""
+			Allocates the ring
+
+			:Args:
+				* size (int): Capacity in bytes
+		"""
+
+		self.size = size
+		self.data = RawArray(ctypes.c_char, size)
+		self.address = ctypes.addressof(self.data)
+
+		# Total number of bytes written and read
+		self.head = RawValue(ctypes.c_uint64, 0)
+		self.tail = RawValue(ctypes.c_uint64, 0)
+
+		self.closed = RawValue(ctypes.c_bool, False)
+
+		# Set by the reader when it has emptied the ring and may go to
+		# sleep, so the writer knows it should ring the doorbell
+		self.reader_waiting = RawValue(ctypes.c_bool, True)
+		self.doorbell = Doorbell()
+
+		# Set by the writer when the ring is full, so the reader knows
+		# it should ring the space doorbell
+		self.writer_waiting = RawValue(ctypes.c_bool, False)
+		self.space = Doorbell()
+
+	def write(self, data):
+		"""
+			Copies as much of the data in the ring as fits, and wakes up
+			the reader
+
+			:Args:
+				* data (string): The bytes to write
+
+			:Returns:
+				The number of bytes written
+		"""
+
+		head = self.head.value
+		length = min(len(data), self.size - (head - self.tail.value))
+		if length <= 0:
+			return 0
+
+		offset = head % self.size
+		first = min(length, self.size - offset)
+		ctypes.memmove(self.address + offset, data, first)
+		if length > first:
+			ctypes.memmove(self.address, data[first:length], length - first)
+
+		# Only publish the new head after the data has been copied
+		self.head.value = head + length
+
+		if self.reader_waiting.value:
+			self.reader_waiting.value = False
+			self.doorbell.ring()
+
+		return length
+
+	def read(self, max_length=None):
+		"""
+			Takes the available bytes from the ring. When the ring is
+			emptied, the reader is marked as waiting for the doorbell.
+
+			:Args:
+				* max_length (int): Maximum number of bytes to read
+
+			:Returns:
+				A string, empty when there's nothing available
+		"""
+
+		data = self.take(max_length)
+
+		if max_length is None or len(data) < max_length:
+			# Announce we're going to wait, and pick up anything written
+			# before the writer could have noticed
+			self.reader_waiting.value = True
+			if len(self):
+				data += self.take(None if max_length is None else max_length - len(data))
+
+		return data
+
+	def take(self, max_length=None):
+		tail = self.tail.value
+		length = self.head.value - tail
+		if max_length is not None:
+			length = min(length, max_length)
+
+		if length <= 0:
+			return ""
+
+		offset = tail % self.size
+		first = min(length, self.size - offset)
+		data = ctypes.string_at(self.address + offset, first)
+		if length > first:
+			data += ctypes.string_at(self.address, length - first)
+
+		self.tail.value = tail + length
+
+		if self.writer_waiting.value:
+			self.writer_waiting.value = False
+			self.space.ring()
+
+		return data
+
+	def wait_for_space(self, timeout=0.05):
+		"""
+			Blocks the writer until the reader made room in the ring. The
+			timeout covers a wakeup which got lost because the reader
+			checked the flag just before it was set.
+
+			:Args:
+				* timeout (float): Maximum time to wait in seconds
+		"""
+
+		self.writer_waiting.value = True
+		if self.free() > 0:
+			self.writer_waiting.value = False
+			return
+
+		try:
+			select.select([self.space], [], [], timeout)
+		except select.error as e:
+			if e.args[0] != EINTR:
+				raise
+
+		self.space.drain()
+
+	def close(self):
+		"""
+			Tells the reader no more data will be written
+		"""
+
+		self.closed.value = True
+		self.reader_waiting.value = False
+		self.doorbell.ring()
+
+	@property
+	def is_closed(self):
+		return self.closed.value
+
+	def free(self):
+		return self.size - len(self)
+
+	def __len__(self):
+		return int(self.head.value - self.tail.value)
@@ -12,9 +12,9 @@ for a specifick IRC event
 """
 
 from luckybot.plugin import TYPE_COMMAND, TYPE_USER_EVENT, TYPE_SERVER_EVENT, \
-	TYPE_REGEXP_RAW, TYPE_REGEXP_MESSAGE, TYPE_TIMER
+	TYPE_REGEXP_RAW, TYPE_REGEXP_MESSAGE, TYPE_TIMER, TYPE_BATCH
 
-from datetime import datetime
+import re
 
 def command(command):
 	"""
@@ -71,6 +71,26 @@ def serverevent(code):
 
 	return function_modifier
 
+def batchevent(type):
+	"""
+		Decorator which makes a given function act as a callback for an
+		IRCv3 batch, like a netsplit or netjoin. The messages in such a
+		batch are not passed to other handlers one by one, the function
+		receives them all at once as second argument, a
+		:class:`luckybot.protocols.irc.Batch`.
+
+		:Args:
+			* type (string|list|tuple): Batch type(s) to watch for
+	"""
+
+	def function_modifier(func):
+		func.handler_type = TYPE_BATCH
+		func.event = [type] if isinstance(type, basestring) else type
+
+		return func
+
+	return function_modifier
+
 def regexpraw(pattern, modifiers=0):
 	"""
 		Decorator which makes sure when the given regexp matches
@@ -89,6 +109,7 @@ def regexpraw(pattern, modifiers=0):
 		func.handler_type = TYPE_REGEXP_RAW
 		func.pattern = pattern
 		func.modifiers = modifiers
+		func.regexp = re.compile(pattern, modifiers)
 
 		return func
 
@@ -112,32 +133,77 @@ def regexpmessage(pattern, modifiers=0):
 		func.handler_type = TYPE_REGEXP_MESSAGE
 		func.pattern = pattern
 		func.modifiers = modifiers
+		func.regexp = re.compile(pattern, modifiers)
 
 		return func
 
 	return function_modifier
 
+def background(func):
+	"""
+		Decorator which makes a handler run in a worker thread instead
+		of on the main loop, use it for handlers which do slow things
+		like network queries or running commands. Replies to the same
+		channel are still sent in order.
+
+		Place it above the handler type decorator::
+
+			@background
+			@command('slow')
+			def slow_command(self, event):
+				...
+	"""
+
+	func.background = True
+
+	return func
+
 class TimerInfo(object):
 	"""
 		A function which will be called periodically
 	"""
 
-	def __init__(self, seconds, last_call=None):
+	def __init__(self, seconds, jitter=0):
 		self.seconds = seconds
-		self.last_call = last_call
+		self.jitter = jitter
 
-def timer(seconds):
+		# Result of the last call, when it's a job which is still running
+		# the next call is skipped
+		self.pending = None
+
+		# Metrics
+		self.calls = 0
+		self.skipped = 0
+		self.missed = 0
+
+		# Seconds between when the last call was due and when it was made
+		self.lag = 0.0
+
+	def is_running(self):
+		"""
+			Checks if the job started by the last call is still running
+		"""
+
+		return self.pending is not None and not getattr(self.pending, 'done', True)
+
+def timer(seconds, jitter=0):
 	"""
 		Decorator to periodically call a function, note that functions
 		using this decorator won't receive a server argument, so they
 		need to know to which server to send data.
 
+		A timer can return a :class:`luckybot.httpclient.Future` for the
+		work it started in the background, the timer is skipped until
+		that work is done.
+
 		:Args:
 			* seconds (int): How much seconds between 2 calls
+			* jitter (float): Maximum random delay in seconds added to each
+			  call, to spread timers which would otherwise fire together
 	"""
 
 	def function_modifier(func):
-		func.timer = TimerInfo(seconds, datetime.now())
+		func.timer = TimerInfo(seconds, jitter)
 		func.handler_type = TYPE_TIMER
 
 		return func
@@ -0,0 +1,182 @@
+"""
+:mod:`luckybot.plugin.executor` - Background handler execution
+===============================================================
+
+This module provides a pool of worker threads which runs slow plugin
+handlers, so they don't block the main loop. Jobs with the same key
+(usually a server and channel) run one after another, in the order
+they were submitted, so replies to a channel stay in order.
+
+.. module:: luckybot.plugin.executor
+   :synopsis: Background handler execution
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+
+import threading
+import traceback
+from collections import deque
+from Queue import Queue
+
+class HandlerExecutor(object):
+	"""
+		Runs handlers in a pool of worker threads, with at most one
+		running job for each key.
+
+		All bookkeeping is done on the main thread, workers only report
+		back through the reactor when a job is done.
+	"""
+
+	def __init__(self, reactor, num_workers=4, max_jobs=100, cleanup=None):
+		"""
+			Creates the executor, worker threads are started when the
+			first job is submitted
+
+			:Args:
+				* reactor (:class:`luckybot.network.reactor.Reactor`): Used
+				  to report finished jobs to the main thread
+				* num_workers (int): Number of worker threads
+				* max_jobs (int): Maximum number of running and waiting
+				  jobs, new jobs are refused when this is reached
+				* cleanup (function): Called in the worker thread after
+				  each job, for example to release a database session
+		"""
+
+		self.reactor = reactor
+		self.num_workers = num_workers
+		self.max_jobs = max_jobs
+		self.cleanup = cleanup
+
+		self.jobs = Queue()
+		self.workers = []
+
+		# Key -> jobs waiting for the running job with the same key,
+		# a key is present as long as one of its jobs is running
+		self.waiting = {}
+		self.num_jobs = 0
+
+		# Metrics
+		self.completed = 0
+		self.failed = 0
+		self.rejected = 0
+
+	def start_workers(self):
+		for i in range(self.num_workers - len(self.workers)):
+			worker = threading.Thread(target=self.work, name='HandlerExecutor-%d' % i)
+			worker.daemon = True
+			worker.start()
+
+			self.workers.append(worker)
+
+	def work(self):
+		"""
+			Main loop of a worker thread
+		"""
+
+		while True:
+			key, func, args, errback = self.jobs.get()
+			error = None
+
+			try:
+				func(*args)
+			except Exception as e:
+				error = e
+				traceback.print_exc()
+			finally:
+				if self.cleanup:
+					try:
+						self.cleanup()
+					except Exception:
+						traceback.print_exc()
+
+			self.reactor.call_from_thread(self.job_done, key, error, errback)
+
+	def submit(self, key, func, args=(), errback=None):
+		"""
+			Schedules a function to run in the pool, after all earlier
+			jobs with the same key have finished
+
+			:Args:
+				* key (hashable): Jobs with the same key run in order
+				* func (function): The function to run
+				* args (tuple): Arguments for the function
+				* errback (function): Called on the main thread with the
+				  exception when the function fails
+
+			:Returns:
+				False if the job is refused because too many jobs are
+				pending, True otherwise
+		"""
+
+		if self.num_jobs >= self.max_jobs:
+			self.rejected += 1
+			return False
+
+		self.num_jobs += 1
+
+		if key in self.waiting:
+			self.waiting[key].append((func, args, errback))
+			return True
+
+		self.waiting[key] = deque()
+		self.start(key, func, args, errback)
+
+		return True
+
+	def start(self, key, func, args, errback):
+		if len(self.workers) < self.num_workers:
+			self.start_workers()
+
+		self.jobs.put((key, func, args, errback))
+
+	def job_done(self, key, error, errback):
+		"""
+			Called on the main thread when a job has finished, starts the
+			next job with the same key
+		"""
+
+		self.num_jobs -= 1
+
+		if error is None:
+			self.completed += 1
+		else:
+			self.failed += 1
+
+			if errback:
+				try:
+					errback(error)
+				except Exception:
+					traceback.print_exc()
+
+		waiting = self.waiting[key]
+		if waiting:
+			func, args, errback = waiting.popleft()
+			self.start(key, func, args, errback)
+		else:
+			del self.waiting[key]
+
+	def is_running(self, key):
+		"""
+			Checks if a job with the given key is running or waiting
+		"""
+
+		return key in self.waiting
+
+	def stats(self):
+		"""
+			Returns the executor metrics
+
+			:Returns:
+				A dict with the number of pending, completed, failed and
+				rejected jobs
+		"""
+
+		return {
+			'pending': self.num_jobs,
+			'completed': self.completed,
+			'failed': self.failed,
+			'rejected': self.rejected
+		}
+
+	def __len__(self):
+		return self.num_jobs
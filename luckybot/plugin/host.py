@@ -0,0 +1,669 @@
+"""
+:mod:`luckybot.plugin.host` - Plugin host processes
+===================================================
+
+This module runs a plugin in its own process. The handlers of the plugin
+are registered in the controller as usual, but calling one sends the
+message to the plugin host over a pipe. The host runs the real handler,
+and sends the lines it wants to send back to the controller.
+
+A CPU heavy plugin doesn't slow down the rest of the bot this way, and
+all memory of a plugin is returned when it's unloaded or reloaded,
+because its process exits.
+
+The host process is a fork of the controller, so plugins can use the
+settings, the authentication and the database as usual. The channel
+state of the servers is not available in a plugin host, and neither
+are the other plugins.
+
+.. module:: luckybot.plugin.host
+   :synopsis: Plugin host processes
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+
+from multiprocessing import Process, Pipe
+import threading
+import time
+import traceback
+
+from luckybot.signals import SignalEmitter
+from luckybot.protocols.irc import IRCProtocol
+from luckybot.network.reactor import Reactor, socket_map
+from luckybot.httpclient import HTTPClient
+from luckybot.plugin.manifest import HandlerStub, describe, snapshot
+from luckybot.plugin.proxy import PluginProxy
+
+# Messages from the controller to the host
+MSG_SERVER = 1
+MSG_CALL = 2
+MSG_QUIT = 3
+
+# Messages from the host to the controller
+MSG_LOADED = 4
+MSG_FAILED = 5
+MSG_DONE = 6
+MSG_SEND = 7
+MSG_ERROR = 8
+
+# Maximum number of calls waiting for a host, further calls are dropped
+MAX_PENDING = 100
+
+# Seconds to wait for a host to load its plugin, and to exit
+STARTUP_TIMEOUT = 30
+STOP_TIMEOUT = 5
+
+# Seconds to wait before restarting a host which died, doubled after
+# each restart up to the maximum. A host which ran longer than the
+# maximum starts over at the first delay.
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 300
+
+class PipeWatcher(object):
+	"""
+		Registers one end of a pipe with a reactor, and passes each
+		received message to a callback
+	"""
+
+	accepting = False
+
+	def __init__(self, conn, callback, closed, map=None):
+		"""
+			:Args:
+				* conn (:class:`multiprocessing.Connection`): The pipe
+				* callback (function): Called with each message
+				* closed (function): Called when the other end is gone
+				* map (dict): Socket map of the reactor, defaults to the
+				  shared socket map
+		"""
+
+		self.conn = conn
+		self.callback = callback
+		self.closed = closed
+		self.map = socket_map if map is None else map
+		self._fileno = conn.fileno()
+
+		self.map[self._fileno] = self
+
+	def readable(self):
+		return True
+
+	def writable(self):
+		return False
+
+	def handle_read_event(self):
+		try:
+			while self.conn.poll():
+				self.callback(self.conn.recv())
+		except (EOFError, IOError):
+			self.handle_close()
+			self.closed()
+
+	def handle_write_event(self):
+		pass
+
+	def handle_expt_event(self):
+		pass
+
+	def handle_close(self):
+		if self.map.get(self._fileno) is self:
+			del self.map[self._fileno]
+
+	def handle_error(self):
+		traceback.print_exc()
+
+class RemoteServer(SignalEmitter):
+	"""
+		Stands in for a server connection in a plugin host, lines are
+		sent to the controller
+	"""
+
+	available_events = ('connected', 'data_in')
+
+	def __init__(self, host, key, info):
+		SignalEmitter.__init__(self)
+
+		self.host = host
+		self.key = key
+		self.info = info
+		self.protocol = IRCProtocol(self)
+
+	def update(self, info, tokens):
+		"""
+			Takes the configuration and the RPL_ISUPPORT tokens of the
+			server in the controller
+		"""
+
+		self.info = info
+		self.protocol.isupport.reset()
+		self.protocol.isupport.parse(['%s=%s' % token if token[1] else token[0]
+			for token in tokens.iteritems()])
+		self.protocol.state.update_modes()
+
+	def send(self, line, priority=None):
+		self.host.emit(MSG_SEND, self.key, line, priority)
+
+	def __str__(self):
+		return self.info['hostname']
+
+class PluginHost(Process):
+	"""
+		Process which runs a single plugin
+	"""
+
+	def __init__(self, bot, directory, name, conn, parent_end):
+		"""
+			:Args:
+				* bot (:class:`luckybot.controller.LuckyBot`): The bot
+				* directory (string): Directory the plugin lives in
+				* name (string): Directory name of the plugin
+				* conn (:class:`multiprocessing.Connection`): Pipe to the
+				  controller
+				* parent_end (:class:`multiprocessing.Connection`): The
+				  controller's end of the pipe, which is closed in the host
+		"""
+
+		Process.__init__(self, name='PluginHost-%s' % name)
+
+		self.daemon = True
+		self.bot = bot
+		self.directory = directory
+		self.dirname = name
+		self.conn = conn
+		self.parent_end = parent_end
+
+		self.plugin = None
+		self.running = True
+
+	def setup(self):
+		"""
+			Replaces the parts of the bot which can't be shared with the
+			controller: the reactor, the HTTP client threads, the worker
+			pool and the database connections
+		"""
+
+		from sqlalchemy import create_engine
+		from sqlalchemy.orm import sessionmaker, scoped_session
+
+		bot = self.bot
+		http = bot.http
+
+		bot.reactor = Reactor({})
+		bot.http = HTTPClient(bot.reactor, http.num_workers, http.max_per_host, http.timeout)
+		bot.executor = None
+
+		bot.db_engine = create_engine(bot.settings.get('Bot', 'database'))
+		bot.session_class = sessionmaker(bind=bot.db_engine)
+		bot.db_session = scoped_session(bot.session_class)
+
+		# Servers are added when the controller tells about them
+		bot.servers = []
+		self.servers = {}
+
+	def run(self):
+		self.parent_end.close()
+
+		try:
+			self.setup()
+			self.plugin = self.bot.plugins.get_plugin_class(self.directory, self.dirname)
+			initial = snapshot(self.plugin)
+			if hasattr(self.plugin, 'initialize'):
+				self.plugin.initialize()
+
+			self.emit(MSG_LOADED, describe(self.plugin), initial)
+		except Exception as e:
+			traceback.print_exc()
+			self.emit(MSG_FAILED, str(e))
+			return 1
+
+		PipeWatcher(self.conn, self.handle_message, self.stop, self.bot.reactor.map)
+
+		try:
+			while self.running:
+				self.bot.reactor.poll()
+		except KeyboardInterrupt:
+			pass
+
+		if hasattr(self.plugin, 'destroy'):
+			self.plugin.destroy()
+
+		return 0
+
+	def stop(self):
+		self.running = False
+
+	def emit(self, *message):
+		try:
+			self.conn.send(message)
+		except (IOError, EOFError):
+			# The controller is gone
+			self.stop()
+
+	def handle_message(self, message):
+		type = message[0]
+
+		if type == MSG_SERVER:
+			key, info, tokens = message[1:]
+			if key not in self.servers:
+				self.servers[key] = RemoteServer(self, key, info)
+				self.bot.servers.append(self.servers[key])
+
+			self.servers[key].update(info, tokens)
+		elif type == MSG_CALL:
+			self.call(*message[1:])
+		elif type == MSG_QUIT:
+			self.stop()
+
+	def call(self, call_id, member, key, message, args):
+		"""
+			Calls a handler of the plugin, and tells the controller when
+			it's done. When the handler returns a job which is still
+			running, the call is done when that job is.
+		"""
+
+		function = getattr(self.plugin, member, None)
+		server = self.servers.get(key)
+		result = None
+
+		try:
+			# Match objects can't be sent, so regexp handlers get the
+			# matched text instead
+			if hasattr(function, 'regexp') and args:
+				args = (function.regexp.match(args[0]),) + args[1:]
+
+			if function is None:
+				pass
+			elif key is None:
+				if not function.timer.is_running():
+					result = function.timer.pending = function()
+			else:
+				result = function(PluginProxy(server, message, self.bot), *args)
+		except Exception as e:
+			traceback.print_exc()
+
+			if server is not None and message is not None:
+				self.emit(MSG_ERROR, key, message.channel, str(e))
+
+		def done(result=None):
+			self.emit(MSG_DONE, call_id)
+
+		def failed(error):
+			print "Handler %s of %s failed: %s" % (member, self.dirname, error)
+			done()
+
+		if hasattr(result, 'add_callbacks'):
+			result.add_callbacks(done, failed)
+		else:
+			done()
+
+class RemoteCall(object):
+	"""
+		A call of a handler in a plugin host, `done` is set when the
+		host finished it
+	"""
+
+	def __init__(self, call_id):
+		self.id = call_id
+		self.done = False
+		self.started = time.time()
+
+class RemoteHandler(HandlerStub):
+	"""
+		A handler of a plugin which runs in a plugin host
+	"""
+
+	def __init__(self, plugin, handler):
+		HandlerStub.__init__(self, plugin.manager, plugin.dirname, handler)
+
+		self.host = plugin
+
+	def resolve(self):
+		return self
+
+	def __call__(self, *args):
+		"""
+			Sends the call to the plugin host, timers are called
+			without arguments
+
+			:Returns:
+				A :class:`RemoteCall`, or None when the call was dropped
+		"""
+
+		if not args:
+			return self.host.call(self.member, None, None, ())
+
+		proxy = args[0]
+		args = args[1:]
+
+		if hasattr(self, 'regexp') and args:
+			args = (args[0].string,) + args[1:]
+
+		return self.host.call(self.member, proxy.server, proxy.message, args)
+
+class RemotePlugin(object):
+	"""
+		A plugin which runs in a plugin host, the host is restarted
+		when it dies. The plugin is loaded synchronously the first time,
+		restarts don't block the main loop.
+	"""
+
+	def __init__(self, manager, directory, name):
+		"""
+			Starts the plugin host, and waits until it loaded the plugin
+
+			:Args:
+				* manager (:class:`luckybot.plugin.PluginManager`): The plugin manager
+				* directory (string): Directory the plugin lives in
+				* name (string): Directory name of the plugin
+		"""
+
+		self.manager = manager
+		self.bot = manager.bot
+		self.directory = directory
+		self.dirname = name
+
+		self.process = None
+		self.conn = None
+		self.watcher = None
+		self.stopping = False
+
+		# Set while a restarted host is loading the plugin
+		self.starting = False
+		self.started = None
+		self.failures = 0
+		self.restart_timer = None
+		self.startup_timer = None
+
+		# Calls the host hasn't finished yet, by ID
+		self.calls = {}
+		self.next_id = 1
+
+		# RPL_ISUPPORT tokens of each server, as last sent to the host
+		self.synced = {}
+		self.server_keys = {}
+
+		# Metrics
+		self.called = 0
+		self.dropped = 0
+		self.restarts = 0
+
+		entry = self.start()
+
+		self.PLUGIN_INFO = dict(entry['info'])
+		self.PLUGIN_INFO['plugin_dir'] = directory
+		self.PLUGIN_INFO['dirname'] = name
+		self.PLUGIN_INFO.setdefault('name', name)
+		self.PLUGIN_INFO.setdefault('version', '')
+
+		self.handlers = {}
+		for handler in entry['handlers']:
+			function = RemoteHandler(self, handler)
+			self.handlers.setdefault(function.handler_type, []).append(function)
+
+	def start(self):
+		"""
+			Starts the plugin host
+
+			:Returns:
+				The manifest entry of the plugin, see
+				:func:`luckybot.plugin.manifest.describe`
+		"""
+
+		from luckybot.plugin import PluginException
+
+		conn = self.launch()
+
+		message = None
+		try:
+			if conn.poll(STARTUP_TIMEOUT):
+				message = conn.recv()
+		except (EOFError, IOError):
+			pass
+
+		if message is None or message[0] != MSG_LOADED:
+			self.stop()
+			raise PluginException, "Could not start plugin host for %s: %s" % (self.dirname,
+				message[1] if message else "no reply")
+
+		self.watcher = PipeWatcher(conn, self.handle_message, self.host_died)
+
+		# The handlers before the plugin was initialized, for the manifest
+		self.initial = message[2]
+
+		return message[1]
+
+	def launch(self):
+		"""
+			Starts the host process
+
+			:Returns:
+				Our end of the pipe to the host
+		"""
+
+		conn, child_conn = Pipe()
+		self.process = PluginHost(self.bot, self.directory, self.dirname, child_conn, conn)
+		self.process.start()
+		child_conn.close()
+
+		self.conn = conn
+		self.synced = {}
+		self.started = time.time()
+
+		return conn
+
+	def restart(self):
+		"""
+			Starts a new plugin host after the previous one died, the
+			plugin is loaded while the main loop goes on
+		"""
+
+		self.restart_timer = None
+		if self.stopping or self.conn is not None:
+			return
+
+		try:
+			self.launch()
+		except Exception:
+			traceback.print_exc()
+			self.stop()
+			self.schedule_restart()
+			return
+
+		self.starting = True
+		self.watcher = PipeWatcher(self.conn, self.handle_message, self.host_died)
+
+		self.startup_timer = threading.Timer(STARTUP_TIMEOUT, self.bot.reactor.call_from_thread,
+			(self.startup_expired, self.process))
+		self.startup_timer.daemon = True
+		self.startup_timer.start()
+
+	def schedule_restart(self):
+		"""
+			Restarts the host after a delay, which doubles after each
+			restart
+		"""
+
+		delay = min(RESTART_DELAY * 2 ** self.failures, MAX_RESTART_DELAY)
+		self.failures += 1
+
+		print "Restarting the plugin host of %s in %d seconds" % (self.dirname, delay)
+
+		self.restart_timer = threading.Timer(delay, self.bot.reactor.call_from_thread,
+			(self.restart,))
+		self.restart_timer.daemon = True
+		self.restart_timer.start()
+
+	def cancel_startup(self):
+		self.starting = False
+
+		if self.startup_timer is not None:
+			self.startup_timer.cancel()
+			self.startup_timer = None
+
+	def startup_expired(self, process):
+		if self.starting and self.process is process:
+			print "Plugin host of %s didn't load the plugin in time" % self.dirname
+			self.host_died()
+
+	def stop(self):
+		"""
+			Stops the plugin host, calls which are still running are
+			considered done
+		"""
+
+		if self.watcher is not None:
+			self.watcher.handle_close()
+			self.watcher = None
+
+		if self.conn is not None:
+			try:
+				self.conn.send((MSG_QUIT,))
+			except (IOError, EOFError):
+				pass
+
+			self.conn.close()
+			self.conn = None
+
+		if self.process is not None:
+			self.process.join(STOP_TIMEOUT)
+			if self.process.is_alive():
+				self.process.terminate()
+				self.process.join()
+
+			self.process = None
+
+		for call in self.calls.itervalues():
+			call.done = True
+
+		self.calls = {}
+		self.cancel_startup()
+
+	def destroy(self):
+		"""
+			Called when the plugin is unloaded
+		"""
+
+		self.stopping = True
+
+		if self.restart_timer is not None:
+			self.restart_timer.cancel()
+			self.restart_timer = None
+
+		self.stop()
+
+	def host_died(self):
+		# Already stopped, for example when the pipe closes after a
+		# failed startup
+		if self.conn is None:
+			return
+
+		self.watcher = None
+		self.stop()
+
+		if self.stopping:
+			return
+
+		print "Plugin host of %s died" % self.dirname
+
+		if time.time() - self.started > MAX_RESTART_DELAY:
+			self.failures = 0
+
+		self.schedule_restart()
+
+	def sync_servers(self):
+		"""
+			Sends the configuration and features of the servers which
+			changed since they were last sent
+		"""
+
+		for server in getattr(self.bot, 'servers', ()):
+			key = id(server)
+			tokens = server.protocol.isupport.tokens
+
+			if self.synced.get(key) != tokens:
+				self.conn.send((MSG_SERVER, key, server.info, tokens))
+				self.synced[key] = dict(tokens)
+				self.server_keys[key] = server
+
+	def call(self, member, server, message, args):
+		"""
+			Sends a call of a handler to the plugin host
+
+			:Args:
+				* member (string): Name of the handler
+				* server (:class:`luckybot.connections.irc.IRCServerConnection`):
+				  The server the message came from, None for timers
+				* message (:class:`luckybot.protocols.irc.IRCMessage`): The
+				  message, None for timers
+				* args (tuple): Further arguments for the handler
+		"""
+
+		if self.conn is None or self.starting:
+			return None
+
+		if len(self.calls) >= MAX_PENDING:
+			self.dropped += 1
+			print "Plugin host of %s is too busy, dropping %s" % (self.dirname, member)
+			return None
+
+		call = RemoteCall(self.next_id)
+		self.next_id += 1
+
+		try:
+			self.sync_servers()
+			self.conn.send((MSG_CALL, call.id, member,
+				id(server) if server is not None else None, message, args))
+		except (IOError, EOFError):
+			return None
+
+		self.calls[call.id] = call
+		self.called += 1
+
+		return call
+
+	def handle_message(self, message):
+		type = message[0]
+
+		if type == MSG_DONE:
+			call = self.calls.pop(message[1], None)
+			if call is not None:
+				call.done = True
+		elif type == MSG_LOADED:
+			self.cancel_startup()
+			self.restarts += 1
+		elif type == MSG_FAILED:
+			print "Plugin host of %s could not load the plugin: %s" % (self.dirname, message[1])
+			self.host_died()
+		elif type == MSG_SEND:
+			key, line, priority = message[1:]
+			server = self.server_keys.get(key)
+			if server is not None:
+				server.send(line, priority)
+		elif type == MSG_ERROR:
+			key, channel, error = message[1:]
+			server = self.server_keys.get(key)
+			if server is not None:
+				server.send(server.protocol.pm(channel, "BOOM Error: %s" % error))
+
+	def get_functions_for_type(self, type):
+		return list(self.handlers.get(type, ()))
+
+	def get_handlers(self):
+		return dict((type, list(functions)) for type, functions in self.handlers.iteritems())
+
+	def stats(self):
+		"""
+			Returns the metrics of the plugin host
+
+			:Returns:
+				A dict with the process ID, the number of calls sent,
+				running and dropped, and the number of restarts
+		"""
+
+		return {
+			'pid': self.process.pid if self.process is not None else None,
+			'called': self.called,
+			'pending': len(self.calls),
+			'dropped': self.dropped,
+			'restarts': self.restarts
+		}
@@ -0,0 +1,194 @@
+"""
+:mod:`luckybot.plugin.instrumentation` - Handler instrumentation
+================================================================
+
+This module keeps track of how often each plugin handler is called, how
+often it fails, and how long it takes. Durations are counted in a
+histogram with power of two buckets, so recording a call only takes a
+few additions.
+
+Statistics are kept per plugin and handler name, so they survive
+reloading a plugin.
+
+.. module:: luckybot.plugin.instrumentation
+   :synopsis: Handler instrumentation
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+
+import json
+import time
+
+# Number of histogram buckets, bucket n counts the calls which took less
+# than 2^n microseconds, the last one counts everything slower
+BUCKETS = 32
+
+def handler_key(function):
+	"""
+		Returns the (plugin, handler) names of a handler
+
+		:Args:
+			* function (function): A bound plugin method, or a handler stub
+	"""
+
+	plugin = getattr(function, 'plugin', None)
+	if plugin is None:
+		plugin = getattr(function, 'im_self', None)
+		plugin = plugin.PLUGIN_INFO['dirname'] if plugin is not None else None
+
+	return (plugin, function.__name__)
+
+class HandlerStats(object):
+	"""
+		Call counts and durations of one handler
+	"""
+
+	__slots__ = ('plugin', 'name', 'calls', 'errors', 'total', 'max', 'histogram')
+
+	def __init__(self, plugin, name):
+		self.plugin = plugin
+		self.name = name
+		self.reset()
+
+	def reset(self):
+		self.calls = 0
+		self.errors = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.histogram = [0] * BUCKETS
+
+	def record(self, elapsed, failed=False):
+		"""
+			Records a call
+
+			:Args:
+				* elapsed (float): Duration of the call in seconds
+				* failed (bool): Whether the handler raised an exception
+		"""
+
+		self.calls += 1
+		if failed:
+			self.errors += 1
+
+		self.total += elapsed
+		if elapsed > self.max:
+			self.max = elapsed
+
+		self.histogram[min(int(elapsed * 1000000).bit_length(), BUCKETS - 1)] += 1
+
+	@property
+	def average(self):
+		return self.total / self.calls if self.calls else 0.0
+
+	def percentile(self, fraction):
+		"""
+			Returns the duration in seconds which the given fraction of
+			the calls didn't exceed, rounded up to a bucket boundary
+
+			:Args:
+				* fraction (float): For example 0.99 for the 99th percentile
+		"""
+
+		if not self.calls:
+			return 0.0
+
+		needed = fraction * self.calls
+		count = 0
+		for bucket, calls in enumerate(self.histogram):
+			count += calls
+			if count >= needed:
+				break
+
+		return min((1 << bucket) / 1000000.0, self.max)
+
+	def as_dict(self):
+		return {
+			'plugin': self.plugin,
+			'handler': self.name,
+			'calls': self.calls,
+			'errors': self.errors,
+			'total': self.total,
+			'average': self.average,
+			'max': self.max,
+			'p50': self.percentile(0.5),
+			'p99': self.percentile(0.99),
+			'histogram': list(self.histogram)
+		}
+
+class Instrumentation(object):
+	"""
+		The statistics of all handlers
+	"""
+
+	def __init__(self):
+		# (plugin, handler) -> HandlerStats
+		self.handlers = {}
+
+	def get(self, function):
+		"""
+			Returns the :class:`HandlerStats` of a handler. Only the names
+			are kept, so the statistics don't keep an unloaded plugin
+			alive.
+		"""
+
+		key = handler_key(function)
+		stats = self.handlers.get(key)
+		if stats is None:
+			stats = self.handlers[key] = HandlerStats(*key)
+
+		return stats
+
+	def timed(self, function, stats, reactor):
+		"""
+			Wraps a handler which runs in a worker thread, the duration is
+			recorded on the main thread
+
+			:Args:
+				* function (function): The handler
+				* stats (:class:`HandlerStats`): Its statistics
+				* reactor (:class:`luckybot.network.reactor.Reactor`): Used
+				  to get back to the main thread
+		"""
+
+		def run(*args):
+			start = time.time()
+			failed = True
+
+			try:
+				function(*args)
+				failed = False
+			finally:
+				reactor.call_from_thread(stats.record, time.time() - start, failed)
+
+		return run
+
+	def reset(self):
+		for stats in self.handlers.itervalues():
+			stats.reset()
+
+	def get_stats(self, plugin=None):
+		"""
+			Returns the statistics of the handlers which have been called,
+			the slowest in total first
+
+			:Args:
+				* plugin (string): Only return the handlers of this plugin
+		"""
+
+		stats = [stats for stats in self.handlers.itervalues()
+			if stats.calls and (plugin is None or stats.plugin == plugin)]
+		stats.sort(key=lambda stats: stats.total, reverse=True)
+
+		return stats
+
+	def dump(self, path):
+		"""
+			Writes the statistics to a JSON file
+		"""
+
+		with open(path, 'w') as file:
+			json.dump({
+				'time': time.time(),
+				'buckets': BUCKETS,
+				'handlers': [stats.as_dict() for stats in self.get_stats()]
+			}, file, indent=1)
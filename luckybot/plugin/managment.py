@@ -12,15 +12,18 @@ This module provides the basic class for our plugin system.
 
 import sys
 import os
-import re
 import imp
 import inspect
 import gc
+import time
+from collections import OrderedDict
 from abc import ABCMeta
-from datetime import timedelta, datetime
 
 from luckybot.protocols.irc import Message
 from luckybot.language import Language
+from luckybot.plugin.regexps import RegexpScanner
+from luckybot.plugin.scheduler import TimerScheduler
+from luckybot.plugin.instrumentation import Instrumentation
 
 TYPE_COMMAND = 1
 TYPE_USER_EVENT = 2
@@ -28,16 +31,44 @@ TYPE_SERVER_EVENT = 3
 TYPE_REGEXP_RAW = 4
 TYPE_REGEXP_MESSAGE = 5
 TYPE_TIMER = 6
+TYPE_BATCH = 7
 
 class PluginException(Exception):
 	pass
 
+class PluginMeta(ABCMeta):
+	"""
+		Metaclass for plugins, which records the names of the handlers
+		tagged by the decorators in :mod:`luckybot.plugin.decorators`
+		once, when the plugin class is created.
+	"""
+
+	def __init__(cls, name, bases, members):
+		ABCMeta.__init__(cls, name, bases, members)
+
+		# Members of base classes can be overridden by subclasses
+		members = {}
+		for klass in reversed(cls.__mro__):
+			members.update(klass.__dict__)
+
+		# Sorted, so handlers are called in the same order as before
+		handlers = {}
+		for member in sorted(members):
+			if member[0] == '_':
+				continue
+
+			handler_type = getattr(members[member], 'handler_type', None)
+			if handler_type is not None:
+				handlers.setdefault(handler_type, []).append(member)
+
+		cls._handlers = handlers
+
 class Plugin(object):
 	"""
 		Base plugin class, each plugin should derive from this one
 	"""
 
-	__metaclass__ = ABCMeta
+	__metaclass__ = PluginMeta
 
 	def __init__(self, bot, plugin_dir, dirname):
 		"""
@@ -77,40 +108,155 @@ class Plugin(object):
 				* type (int): The function handler type
 		"""
 
-		members = dir(self)
-		functions = []
+		return [getattr(self, member) for member in self._handlers.get(type, ())]
 
-		for member in members:
-			if member[0] == '_':
-				continue
+	def get_handlers(self):
+		"""
+			Gets all plugin handler functions
+
+			:Returns:
+				A dict with the handler type as key, and a list of
+				functions as value
+		"""
 
-			if hasattr(getattr(self, member), 'handler_type'):
-				if getattr(self, member).handler_type == type:
-					functions.append(getattr(self, member))
-		return functions
+		return dict((type, [getattr(self, member) for member in members])
+			for type, members in self._handlers.iteritems())
 
 class PluginManager(object):
 	"""
 		This class handles plugin (re)loading
 	"""
 
-	def __init__(self, bot, disabled=[]):
+	def __init__(self, bot, disabled=[], manifest=None, isolated=[]):
 		"""
 			Constructor, initializes some members
+
+			:Args:
+				* bot (:class:`luckybot.controller.LuckyBot`): The bot
+				* disabled (list): Directory names of disabled plugins
+				* manifest (:class:`luckybot.plugin.manifest.Manifest`):
+				  When given, plugins in the manifest are only imported
+				  when one of their handlers is called
+				* isolated (list): Directory names of plugins which run
+				  in their own process
 		"""
 
 		self.bot = bot
 		self.disabled = disabled
+		self.isolated = isolated
 		self.plugin_dirs = []
+		self.manifest = manifest
 
 		self.plugins = {}
 
-		self.commands = []
-		self.user_events = []
-		self.server_events = []
-		self.message_regexps = []
-		self.raw_regexps = []
-		self.timers = []
+		self.commands = set()
+		self.user_events = set()
+		self.server_events = set()
+		self.message_regexps = set()
+		self.raw_regexps = set()
+		self.timers = set()
+		self.batch_events = set()
+
+		self.registered = {
+			TYPE_COMMAND: self.commands,
+			TYPE_USER_EVENT: self.user_events,
+			TYPE_SERVER_EVENT: self.server_events,
+			TYPE_REGEXP_MESSAGE: self.message_regexps,
+			TYPE_REGEXP_RAW: self.raw_regexps,
+			TYPE_TIMER: self.timers,
+			TYPE_BATCH: self.batch_events
+		}
+
+		# The handlers of each loaded plugin, by handler type
+		self.handlers = {}
+
+		# Lookup tables from command name or IRC command to the handlers,
+		# ordered dicts so handlers keep their order and are removed in O(1)
+		self.command_index = {}
+		self.user_event_index = {}
+		self.server_event_index = {}
+		self.batch_event_index = {}
+
+		# Scanners which match a line against all regexp handlers at once
+		self.raw_scanner = RegexpScanner()
+		self.message_scanner = RegexpScanner()
+
+		self.indexes = {
+			TYPE_COMMAND: self.command_index,
+			TYPE_USER_EVENT: self.user_event_index,
+			TYPE_SERVER_EVENT: self.server_event_index,
+			TYPE_BATCH: self.batch_event_index
+		}
+
+		self.scanners = {
+			TYPE_REGEXP_RAW: self.raw_scanner,
+			TYPE_REGEXP_MESSAGE: self.message_scanner
+		}
+
+		# Heap of timers ordered by their next deadline
+		self.scheduler = TimerScheduler()
+
+		# Worker pool for handlers tagged with the background decorator
+		self.executor = getattr(bot, 'executor', None)
+
+		# Call counts and durations of each handler
+		self.instrumentation = Instrumentation()
+
+	def get_index_keys(self, function):
+		"""
+			Gets the keys under which the given handler should be put in
+			the lookup tables
+
+			:Args:
+				* function (function): A command or event handler
+		"""
+
+		if function.handler_type == TYPE_COMMAND:
+			keys = function.command
+		else:
+			keys = function.event
+
+		if isinstance(keys, (basestring, int)):
+			keys = [keys]
+
+		# Server replies arrive as zero padded numerics
+		return ['%03d' % key if isinstance(key, int) else key for key in keys]
+
+	def add_to_index(self, index, functions):
+		"""
+			Adds each given handler to a lookup table
+
+			:Args:
+				* index (dict): The lookup table
+				* functions (list): List of handlers to add
+		"""
+
+		for function in functions:
+			for key in self.get_index_keys(function):
+				handlers = index.get(key)
+				if handlers is None:
+					handlers = index[key] = OrderedDict()
+
+				handlers[function] = None
+
+	def remove_from_index(self, index, functions):
+		"""
+			Removes each given handler from a lookup table
+
+			:Args:
+				* index (dict): The lookup table
+				* functions (list): List of handlers to remove
+		"""
+
+		for function in functions:
+			for key in self.get_index_keys(function):
+				handlers = index.get(key)
+				if not handlers or function not in handlers:
+					continue
+
+				del handlers[function]
+				if not handlers:
+					del index[key]
 
 	def load_plugin(self, dir, name):
 		"""
@@ -120,17 +266,55 @@ class PluginManager(object):
 				* name (string): The directory name of the plugin
 		"""
 
-		plugin = self.get_plugin_class(dir, name)
+		initial = None
+
+		if name in self.isolated:
+			from luckybot.plugin.host import RemotePlugin
+			plugin = RemotePlugin(self, dir, name)
+			initial = plugin.initial
+		else:
+			plugin = self.get_plugin_class(dir, name)
+
+			if self.manifest is not None:
+				from luckybot.plugin.manifest import snapshot
+				initial = snapshot(plugin)
+
+			if hasattr(plugin, 'initialize'):
+				plugin.initialize()
+
+		if self.manifest is not None:
+			self.manifest.update(dir, name, plugin, initial)
+
+		self.register(name, plugin)
+
+	def register(self, name, plugin):
+		"""
+			Adds the handlers of a plugin to the lookup tables
+
+			:Args:
+				* name (string): The directory name of the plugin
+				* plugin (:class:`Plugin`): The plugin, or a stub for it
+		"""
+
+		# The same function objects are used when unloading, so they
+		# can be removed from the sets
+		handlers = plugin.get_handlers()
 
-		if hasattr(plugin, 'initialize'):
-			plugin.initialize()
+		for type, functions in handlers.iteritems():
+			if type not in self.registered:
+				continue
 
-		self.commands.extend(plugin.get_functions_for_type(TYPE_COMMAND))
-		self.user_events.extend(plugin.get_functions_for_type(TYPE_USER_EVENT))
-		self.server_events.extend(plugin.get_functions_for_type(TYPE_SERVER_EVENT))
-		self.raw_regexps.extend(plugin.get_functions_for_type(TYPE_REGEXP_RAW))
-		self.message_regexps.extend(plugin.get_functions_for_type(TYPE_REGEXP_MESSAGE))
-		self.timers.extend(plugin.get_functions_for_type(TYPE_TIMER))
+			self.registered[type].update(functions)
+
+			if type in self.indexes:
+				self.add_to_index(self.indexes[type], functions)
+			elif type in self.scanners:
+				self.scanners[type].add(functions)
+			elif type == TYPE_TIMER:
+				for function in functions:
+					self.scheduler.add(function)
+
+		self.handlers[name] = handlers
 		self.plugins[name] = plugin
 
 	def load_plugins(self, dir):
@@ -151,7 +335,12 @@ class PluginManager(object):
 			if file in self.disabled:
 				continue
 
-			self.load_plugin(dir, file)
+			entry = self.manifest.get(dir, file) if self.manifest is not None else None
+			if entry is not None:
+				from luckybot.plugin.manifest import PluginStub
+				self.register(file, PluginStub(self, dir, file, entry))
+			else:
+				self.load_plugin(dir, file)
 
 		if dir not in self.plugin_dirs:
 			self.plugin_dirs.append(dir)
@@ -183,29 +372,19 @@ class PluginManager(object):
 			return False
 
 		# Remove all functions
-		functions = self.plugins[name].get_functions_for_type(TYPE_COMMAND)
-		for function in functions:
-			self.commands.remove(function)
-
-		functions = self.plugins[name].get_functions_for_type(TYPE_SERVER_EVENT)
-		for function in functions:
-			self.server_events.remove(function)
-
-		functions = self.plugins[name].get_functions_for_type(TYPE_USER_EVENT)
-		for function in functions:
-			self.user_events.remove(function)
-
-		functions = self.plugins[name].get_functions_for_type(TYPE_REGEXP_MESSAGE)
-		for function in functions:
-			self.message_regexps.remove(function)
+		for type, functions in self.handlers.pop(name, {}).iteritems():
+			if type not in self.registered:
+				continue
 
-		functions = self.plugins[name].get_functions_for_type(TYPE_REGEXP_RAW)
-		for function in functions:
-			self.raw_regexps.remove(function)
+			self.registered[type].difference_update(functions)
 
-		functions = self.plugins[name].get_functions_for_type(TYPE_TIMER)
-		for function in functions:
-			self.timers.remove(function)
+			if type in self.indexes:
+				self.remove_from_index(self.indexes[type], functions)
+			elif type in self.scanners:
+				self.scanners[type].remove(functions)
+			elif type == TYPE_TIMER:
+				for function in functions:
+					self.scheduler.remove(function)
 
 		if hasattr(self.plugins[name], 'destroy'):
 			self.plugins[name].destroy()
@@ -216,6 +395,38 @@ class PluginManager(object):
 
 		return True
 
+	def load_stub(self, stub):
+		"""
+			Imports the plugin of a handler stub, in place of its stubs
+
+			:Args:
+				* stub (:class:`luckybot.plugin.manifest.HandlerStub`): The stub
+
+			:Returns:
+				The real handler, or None when the plugin couldn't be loaded
+		"""
+
+		from luckybot.plugin.manifest import PluginStub
+
+		plugin = self.plugins.get(stub.plugin)
+		if isinstance(plugin, PluginStub):
+			directory = plugin.PLUGIN_INFO['plugin_dir']
+			self.unload_plugin(stub.plugin)
+
+			try:
+				self.load_plugin(directory, stub.plugin)
+			except PluginException:
+				import traceback
+				traceback.print_exc()
+
+				return None
+
+		plugin = self.plugins.get(stub.plugin)
+		if plugin is None or isinstance(plugin, PluginStub):
+			return None
+
+		return getattr(plugin, stub.member, None)
+
 	def reload_plugin(self, name):
 		"""
 			Reloads a given plugin
@@ -281,59 +492,158 @@ class PluginManager(object):
 		if self.raw_regexps:
 			# Call plugins which want to perform a regexp on the raw
 			# message
-			for function in self.raw_regexps:
-				# Match the regexp
-				regexp = re.compile(function.pattern, function.modifiers)
-				match = regexp.match(message.raw)
-
-				if match:
-					function(proxy, match)
+			for function, match in self.raw_scanner.match(message.raw):
+				self.call_handler(function, proxy, match)
 
-		if self.commands:
+		# Handlers are copied before calling them, because a handler
+		# can (un)load plugins
+		if self.command_index:
 			# Check for command plugins
 			if hasattr(message, 'bot_command'):
-				for function in self.commands:
-					if message.bot_command.lower() in function.command:
-						function(proxy)
+				functions = self.command_index.get(message.bot_command.lower())
+				if functions:
+					for function in tuple(functions):
+						self.call_handler(function, proxy)
 
-		if self.server_events:
+		if self.server_event_index:
 			# Server replies
 			if message.type == Message.SERVER_MESSAGE:
-				for function in self.server_events:
-					if message.command in function.event:
-						function(proxy)
+				functions = self.server_event_index.get(message.command)
+				if functions:
+					for function in tuple(functions):
+						self.call_handler(function, proxy)
 
-		if self.user_events:
+		if self.user_event_index:
 			# User proxys
 			if message.type == Message.USER_MESSAGE:
-				for function in self.user_events:
-					if message.command in function.event:
-						function(proxy)
+				functions = self.user_event_index.get(message.command)
+				if functions:
+					for function in tuple(functions):
+						self.call_handler(function, proxy)
 
 		if self.message_regexps:
 			if message.type == Message.USER_MESSAGE and message.command == "PRIVMSG":
-				for function in self.message_regexps:
-					# Match the regexp
-					regexp = re.compile(function.pattern, function.modifiers)
-					match = regexp.match(message.message)
+				for function, match in self.message_scanner.match(message.message):
+					self.call_handler(function, proxy, match)
+
+	def check_batch(self, proxy, batch):
+		"""
+			Calls the handlers for a completed batch
+
+			:Args:
+				* proxy (:class:`luckybot.plugin.proxy.PluginProxy`): Plugin
+				  proxy object for the message which started the batch
+				* batch (:class:`luckybot.protocols.irc.Batch`): The batch
+		"""
+
+		functions = self.batch_event_index.get(batch.type)
+		if functions:
+			for function in tuple(functions):
+				self.call_handler(function, proxy, batch)
+
+	def call_handler(self, function, proxy, *args):
+		"""
+			Calls a handler, handlers tagged with the background decorator
+			are run in the worker pool, after earlier background handlers
+			for the same server and channel.
+
+			:Args:
+				* function (function): The handler
+				* proxy (:class:`luckybot.plugin.proxy.PluginProxy`): Plugin proxy object
+				* Further arguments are passed to the handler
+		"""
 
-					if match:
-						function(proxy, match)
+		# Import the plugin of a stub first, the handler may have to run
+		# in the background
+		if hasattr(function, 'resolve'):
+			function = function.resolve()
+			if function is None:
+				return
+
+		stats = self.instrumentation.get(function)
+
+		if not getattr(function, 'background', False) or self.executor is None:
+			start = time.time()
+			try:
+				function(proxy, *args)
+			except Exception:
+				stats.record(time.time() - start, True)
+				raise
+
+			stats.record(time.time() - start)
+			return
+
+		server = proxy.server
+		message = proxy.message
+		key = (server, getattr(message, 'channel', None))
+
+		def error(e):
+			server.send(server.protocol.pm(message.channel, "BOOM Error: %s" % (str(e))))
+
+		timed = self.instrumentation.timed(function, stats, self.executor.reactor)
+		if not self.executor.submit(key, timed, (proxy.thread_safe(),) + args, error):
+			print "Too many background jobs, dropping %s for %s" % (function.__name__, key[1])
 
 	def check_timers(self):
 		"""
-			Checks for plugin timers, and calls them again, after the given
-			amount of time
+			Calls the plugin timers which are due
 		"""
 
-		for timer in self.timers:
-			if not timer.timer.last_call:
-				timer.timer.last_call = datetime.now()
-				timer()
-			else:
-				if (timer.timer.last_call + timedelta(seconds=timer.timer.seconds)) < datetime.now():
-					timer.timer.last_call = datetime.now()
-					timer()
+		if self.timers:
+			self.scheduler.run_due(self.call_timer)
+
+	def call_timer(self, function):
+		"""
+			Calls a timer, unless the work started by its previous call
+			is still running
+
+			:Args:
+				* function (function): The timer
+
+			:Returns:
+				False if the timer was skipped, True otherwise
+		"""
 
+		if hasattr(function, 'resolve'):
+			function = function.resolve()
+			if function is None:
+				return True
 
+		stats = self.instrumentation.get(function)
+
+		if getattr(function, 'background', False) and self.executor is not None:
+			key = ('timer', function)
+			if self.executor.is_running(key):
+				return False
+
+			timed = self.instrumentation.timed(function, stats, self.executor.reactor)
+			if not self.executor.submit(key, timed):
+				print "Too many background jobs, dropping timer %s" % function.__name__
+
+			return True
+
+		if function.timer.is_running():
+			return False
+
+		start = time.time()
+		try:
+			function.timer.pending = function()
+		except Exception:
+			stats.record(time.time() - start, True)
+			raise
+
+		stats.record(time.time() - start)
+
+		return True
+
+	def next_timer_timeout(self):
+		"""
+			Calculates how long the main loop can wait before a timer
+			is due.
+
+			:Returns:
+				The number of seconds until the next timer is due, or None
+				when there are no timers
+		"""
 
+		return self.scheduler.next_timeout()
@@ -0,0 +1,254 @@
+"""
+:mod:`luckybot.plugin.manifest` - Plugin manifest
+=================================================
+
+This module keeps a manifest of the handlers each plugin has, so the
+bot can start without importing its plugins. Stubs are registered for
+the handlers in the manifest, and the plugin is only imported when one
+of them is called for the first time.
+
+The manifest is stored as JSON, and an entry is only used when none of
+the files of its plugin changed since it was written. Plugins which
+change their handlers in `initialize`, for example to add commands
+stored in the database, are always imported.
+
+.. module:: luckybot.plugin.manifest
+   :synopsis: Plugin manifest
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+
+import json
+import os
+import re
+
+from luckybot.plugin.decorators import TimerInfo
+
+MANIFEST_VERSION = 1
+
+# Plugin metadata which is kept in the manifest
+INFO_KEYS = ('name', 'author', 'version', 'description', 'website')
+
+def plugin_mtime(directory):
+	"""
+		Returns the time the most recently changed file of a plugin
+		was modified, compiled files are ignored
+
+		:Args:
+			* directory (string): The plugin directory
+	"""
+
+	mtime = 0
+	for root, dirs, files in os.walk(directory):
+		for file in files:
+			if file.endswith(('.pyc', '.pyo')):
+				continue
+
+			try:
+				mtime = max(mtime, os.path.getmtime(os.path.join(root, file)))
+			except OSError:
+				pass
+
+	return mtime
+
+def describe(plugin):
+	"""
+		Creates the manifest entry for a loaded plugin
+
+		:Args:
+			* plugin (:class:`luckybot.plugin.Plugin`): The plugin
+	"""
+
+	handlers = []
+	for type, functions in plugin.get_handlers().iteritems():
+		for function in functions:
+			handler = {
+				'member': function.__name__,
+				'type': type,
+				'doc': function.__doc__
+			}
+
+			for key in ('command', 'event', 'pattern', 'modifiers'):
+				if hasattr(function, key):
+					handler[key] = getattr(function, key)
+
+			if hasattr(function, 'timer'):
+				handler['timer'] = [function.timer.seconds, function.timer.jitter]
+
+			handlers.append(handler)
+
+	return {
+		'info': dict((key, plugin.PLUGIN_INFO[key]) for key in INFO_KEYS if key in plugin.PLUGIN_INFO),
+		'handlers': handlers
+	}
+
+def snapshot(plugin):
+	"""
+		Returns a copy of the manifest entry of a plugin, which isn't
+		affected when the plugin changes its handlers later, or None
+		when the entry can't be stored
+	"""
+
+	try:
+		return json.loads(json.dumps(describe(plugin)))
+	except (TypeError, ValueError):
+		return None
+
+class Manifest(object):
+	"""
+		The handlers of each plugin, stored in a JSON file
+	"""
+
+	def __init__(self, path):
+		"""
+			Loads the manifest
+
+			:Args:
+				* path (string): Path of the JSON file
+		"""
+
+		self.path = path
+		self.plugins = {}
+		self.changed = False
+
+		try:
+			with open(path) as file:
+				data = json.load(file)
+
+			if data.get('version') == MANIFEST_VERSION:
+				self.plugins = data.get('plugins', {})
+		except (IOError, ValueError, AttributeError):
+			pass
+
+	def get(self, directory, name):
+		"""
+			Returns the entry for a plugin, or None when the plugin is not
+			in the manifest or has been changed since
+
+			:Args:
+				* directory (string): Directory the plugin lives in
+				* name (string): Directory name of the plugin
+		"""
+
+		entry = self.plugins.get(os.path.join(directory, name))
+		if entry is None or entry.get('eager') or \
+				entry.get('mtime') != plugin_mtime(os.path.join(directory, name)):
+			return None
+
+		return entry
+
+	def update(self, directory, name, plugin, initial=None):
+		"""
+			Stores the entry of a plugin which has just been loaded, and
+			writes the manifest
+
+			:Args:
+				* directory (string): Directory the plugin lives in
+				* name (string): Directory name of the plugin
+				* plugin (:class:`luckybot.plugin.Plugin`): The plugin
+				* initial (dict): The entry of the plugin before it was
+				  initialized, see :func:`snapshot`
+		"""
+
+		entry = snapshot(plugin)
+		if entry is None:
+			# Something can't be stored, this plugin is always imported
+			self.plugins.pop(os.path.join(directory, name), None)
+		else:
+			# The handlers depend on what initialize found, so they
+			# can't be known without importing the plugin
+			if initial is not None and initial['handlers'] != entry['handlers']:
+				entry['eager'] = True
+
+			entry['mtime'] = plugin_mtime(os.path.join(directory, name))
+			self.plugins[os.path.join(directory, name)] = entry
+
+		self.changed = True
+		self.save()
+
+	def save(self):
+		"""
+			Writes the manifest to disk, if it changed
+		"""
+
+		if not self.changed:
+			return
+
+		try:
+			with open(self.path + '.tmp', 'w') as file:
+				json.dump({'version': MANIFEST_VERSION, 'plugins': self.plugins}, file)
+
+			os.rename(self.path + '.tmp', self.path)
+			self.changed = False
+		except (IOError, OSError):
+			import traceback
+			traceback.print_exc()
+
+class HandlerStub(object):
+	"""
+		Stands in for a handler of a plugin which hasn't been imported yet,
+		with the same attributes the decorators set
+	"""
+
+	def __init__(self, manager, plugin, handler):
+		"""
+			:Args:
+				* manager (:class:`luckybot.plugin.PluginManager`): The plugin manager
+				* plugin (string): Directory name of the plugin
+				* handler (dict): Entry of the handler in the manifest
+		"""
+
+		self.manager = manager
+		self.plugin = plugin
+		self.member = handler['member']
+		self.handler_type = handler['type']
+
+		self.__name__ = str(self.member)
+		self.__doc__ = handler.get('doc')
+
+		for key in ('command', 'event'):
+			if key in handler:
+				setattr(self, key, handler[key])
+
+		if 'pattern' in handler:
+			self.pattern = handler['pattern']
+			self.modifiers = handler.get('modifiers', 0)
+			self.regexp = re.compile(self.pattern, self.modifiers)
+
+		if 'timer' in handler:
+			self.timer = TimerInfo(*handler['timer'])
+
+	def resolve(self):
+		"""
+			Imports the plugin, and returns the real handler
+		"""
+
+		return self.manager.load_stub(self)
+
+	def __call__(self, *args):
+		function = self.resolve()
+		if function is not None:
+			return function(*args)
+
+class PluginStub(object):
+	"""
+		Stands in for a plugin which hasn't been imported yet
+	"""
+
+	def __init__(self, manager, directory, name, entry):
+		self.PLUGIN_INFO = dict(entry['info'])
+		self.PLUGIN_INFO['plugin_dir'] = directory
+		self.PLUGIN_INFO['dirname'] = name
+		self.PLUGIN_INFO.setdefault('name', name)
+		self.PLUGIN_INFO.setdefault('version', '')
+
+		self.handlers = {}
+		for handler in entry['handlers']:
+			stub = HandlerStub(manager, name, handler)
+			self.handlers.setdefault(stub.handler_type, []).append(stub)
+
+	def get_functions_for_type(self, type):
+		return list(self.handlers.get(type, ()))
+
+	def get_handlers(self):
+		return dict((type, list(functions)) for type, functions in self.handlers.iteritems())
@@ -10,6 +10,26 @@ This module provides some proxy classes useful for plugins.
 .. moduleauthor:: Lucas van Dijk <info@return1.net>
 """
 
+class ThreadSafeServer(object):
+	"""
+		Wraps a server connection for handlers running in a worker
+		thread. Lines are sent from the main thread, in the order the
+		handler sent them.
+	"""
+
+	def __init__(self, server, reactor):
+		self.server = server
+		self.reactor = reactor
+
+	def send(self, line, priority=None):
+		self.reactor.call_from_thread(self.server.send, line, priority)
+
+	def __getattr__(self, name):
+		return getattr(self.server, name)
+
+	def __str__(self):
+		return str(self.server)
+
 class PluginProxy(object):
 	"""
 		Plugin event, an object of this class will be passed to the plugin
@@ -38,6 +58,13 @@ class PluginProxy(object):
 		def part(self):
 			self.server.send(self.server.protocol.part(self.message.channel))
 
+		@property
+		def users(self):
+			return self.server.protocol.state.get_users(self.message.channel)
+
+		def has_user(self, nick):
+			return self.server.protocol.state.is_in_channel(self.message.channel, nick)
+
 		def __str__(self):
 			return self.message.channel
 
@@ -65,7 +92,8 @@ class PluginProxy(object):
 			self.server.send(self.server.protocol.kick(self.message.channel, self.message.nick))
 
 		def is_allowed(self, group):
-			return self.bot.auth.is_allowed(self.message.hostname, group)
+			return self.bot.auth.is_allowed(self.message.hostname, group,
+				self.server.protocol.isupport.casemapping)
 
 		@property
 		def nick(self):
@@ -75,6 +103,18 @@ class PluginProxy(object):
 		def hostname(self):
 			return self.message.hostname
 
+		@property
+		def modes(self):
+			"""
+				Member modes of the user in the current channel
+			"""
+
+			return self.server.protocol.state.get_modes(self.message.channel, self.message.nick)
+
+		@property
+		def channels(self):
+			return self.server.protocol.state.get_user_channels(self.message.nick)
+
 		def __str__(self):
 			return self.message.nick
 
@@ -84,7 +124,25 @@ class PluginProxy(object):
 		"""
 		self.server = server
 		self.message = message
+		self.bot = bot
 
 		# Create some dummy objects for a nice api to say things
 		self.user = PluginProxy.User(server, message, bot)
 		self.channel = PluginProxy.Channel(server, message)
+
+	@property
+	def state(self):
+		"""
+			The :class:`luckybot.protocols.state.StateTracker` of the
+			server, with the channels we're in and their users
+		"""
+
+		return self.server.protocol.state
+
+	def thread_safe(self):
+		"""
+			Creates a copy of this proxy which can be used from a worker
+			thread
+		"""
+
+		return PluginProxy(ThreadSafeServer(self.server, self.bot.reactor), self.message, self.bot)
@@ -0,0 +1,182 @@
+"""
+:mod:`luckybot.plugin.regexps` - Combined regexp matching
+=========================================================
+
+This module provides a scanner which matches a line against the patterns
+of all regexp handlers at once, by merging the patterns into one big
+alternation.
+
+.. module:: luckybot.plugin.regexps
+   :synopsis: Combined regexp matching
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+
+import re
+
+# Python's regexp engine supports at most 100 groups in one pattern
+MAX_GROUPS = 99
+
+# Backreferences and inline flags change meaning when a pattern is
+# merged with others, so these patterns are matched on their own
+UNSAFE_PATTERN = re.compile(r'\\[1-9]|\(\?P=|\(\?[iLmsux]+\)')
+
+class CombinedRegexp(object):
+	"""
+		One alternation of several handler patterns, each wrapped in a
+		capturing group so we know which alternative matched.
+	"""
+
+	def __init__(self, entries, flags):
+		"""
+			Compiles the alternation
+
+			:Args:
+				* entries (list): List of (position, function) tuples
+				* flags (int): The regexp flags shared by all patterns
+		"""
+
+		self.entries = entries
+		self.group_map = {}
+
+		parts = []
+		group = 1
+		for i, (position, function) in enumerate(entries):
+			parts.append('(%s)' % function.regexp.pattern)
+			self.group_map[group] = i
+			group += function.regexp.groups + 1
+
+		self.regexp = re.compile('|'.join(parts), flags)
+
+	def match(self, line, matches):
+		"""
+			Matches the line, and appends each matching handler to the
+			given list.
+
+			Alternatives before the one reported by the engine can't
+			match, so only the ones after it need to be checked separately.
+		"""
+
+		match = self.regexp.match(line)
+		if not match:
+			return
+
+		first = self.group_map[match.lastindex]
+		for position, function in self.entries[first:]:
+			match = function.regexp.match(line)
+			if match:
+				matches.append((position, function, match))
+
+class RegexpScanner(object):
+	"""
+		Matches a line against the patterns of many regexp handlers,
+		scanning the line only once when none of them match.
+	"""
+
+	def __init__(self):
+		self.functions = []
+		self.combined = None
+		self.single = None
+
+	def add(self, functions):
+		"""
+			Adds regexp handlers to the scanner
+
+			:Args:
+				* functions (list): Handlers tagged with :func:`regexpraw`
+				  or :func:`regexpmessage`
+		"""
+
+		self.functions.extend(functions)
+		self.combined = None
+
+	def remove(self, functions):
+		"""
+			Removes regexp handlers from the scanner
+
+			:Args:
+				* functions (list): Previously added handlers
+		"""
+
+		removed = set(functions)
+		self.functions = [function for function in self.functions if function not in removed]
+		self.combined = None
+
+	def build(self):
+		"""
+			Groups the patterns by their flags, and merges each group
+			into as few alternations as possible
+		"""
+
+		self.combined = []
+		self.single = []
+
+		by_flags = {}
+		for position, function in enumerate(self.functions):
+			if UNSAFE_PATTERN.search(function.regexp.pattern):
+				self.single.append((position, function))
+			else:
+				by_flags.setdefault(function.regexp.flags, []).append((position, function))
+
+		for flags, entries in by_flags.iteritems():
+			chunk = []
+			num_groups = 0
+			for entry in entries:
+				groups = entry[1].regexp.groups + 1
+				if chunk and num_groups + groups > MAX_GROUPS:
+					self.add_combined(chunk, flags)
+					chunk = []
+					num_groups = 0
+
+				chunk.append(entry)
+				num_groups += groups
+
+			if chunk:
+				self.add_combined(chunk, flags)
+
+	def add_combined(self, entries, flags):
+		"""
+			Creates the alternation for the given handlers, when the
+			patterns can't be merged (for example because they use the
+			same group names) they are matched on their own.
+		"""
+
+		if len(entries) == 1 or sum(entry[1].regexp.groups + 1 for entry in entries) > MAX_GROUPS:
+			self.single.extend(entries)
+			return
+
+		try:
+			self.combined.append(CombinedRegexp(entries, flags))
+		except (re.error, AssertionError, OverflowError):
+			self.single.extend(entries)
+
+	def match(self, line):
+		"""
+			Matches the given line against all patterns
+
+			:Args:
+				* line (string): The line to match
+
+			:Returns:
+				A list of (function, match) tuples, in the order the
+				handlers were added
+		"""
+
+		if self.combined is None:
+			self.build()
+
+		matches = []
+		for combined in self.combined:
+			combined.match(line, matches)
+
+		for position, function in self.single:
+			match = function.regexp.match(line)
+			if match:
+				matches.append((position, function, match))
+
+		matches.sort(key=lambda entry: entry[0])
+
+		return [(function, found) for position, function, found in matches]
+
+	def __len__(self):
+		return len(self.functions)
@@ -0,0 +1,188 @@
+"""
+:mod:`luckybot.plugin.scheduler` - Timer scheduling
+===================================================
+
+This module contains the scheduler for plugin timers. Timers are kept in
+a heap ordered by their next deadline, so the main loop only has to look
+at the first one to know how long it can wait.
+
+.. module:: luckybot.plugin.scheduler
+   :synopsis: Timer scheduling
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+
+import heapq
+import itertools
+import random
+import sys
+import time
+import traceback
+
+def _get_monotonic():
+	"""
+		Looks up clock_gettime(CLOCK_MONOTONIC) through ctypes, so timers
+		aren't affected when the system clock is changed. Falls back to
+		:func:`time.time` when it's not available.
+	"""
+
+	if not sys.platform.startswith('linux'):
+		return time.time
+
+	try:
+		import ctypes
+		import ctypes.util
+	except ImportError:
+		return time.time
+
+	class timespec(ctypes.Structure):
+		_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+	try:
+		library = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'),
+			use_errno=True)
+		clock_gettime = library.clock_gettime
+	except (OSError, AttributeError):
+		return time.time
+
+	clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+	CLOCK_MONOTONIC = 1
+
+	def monotonic():
+		t = timespec()
+		if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+			return time.time()
+
+		return t.tv_sec + t.tv_nsec * 1e-9
+
+	return monotonic
+
+monotonic = _get_monotonic()
+
+class TimerScheduler(object):
+	"""
+		Min heap of timers, ordered by the time they should be called.
+
+		The next deadline of a timer is calculated from its previous
+		deadline instead of the time it was actually called, so timers
+		don't drift. Periods which were missed completely, because the
+		bot was busy, are skipped instead of called in a burst.
+	"""
+
+	def __init__(self):
+		# Heap of [fire time, sequence number, function, deadline] lists,
+		# the function is set to None when a timer is removed
+		self.heap = []
+		self.entries = {}
+		self.counter = itertools.count()
+
+	def schedule(self, function, deadline):
+		"""
+			Puts a timer in the heap, the fire time is its deadline plus
+			a random jitter
+		"""
+
+		info = function.timer
+		fire_at = deadline
+		if info.jitter:
+			fire_at += random.uniform(0, info.jitter)
+
+		entry = [fire_at, next(self.counter), function, deadline]
+		self.entries[function] = entry
+		heapq.heappush(self.heap, entry)
+
+	def add(self, function, now=None):
+		"""
+			Adds a timer, it's first called after its interval
+
+			:Args:
+				* function (function): Handler tagged with :func:`timer`
+				* now (float): Current monotonic time
+		"""
+
+		if now is None:
+			now = monotonic()
+
+		self.remove(function)
+		self.schedule(function, now + function.timer.seconds)
+
+	def remove(self, function):
+		"""
+			Removes a timer. The heap entry is only marked as removed,
+			and thrown away when it reaches the top.
+
+			:Args:
+				* function (function): A previously added timer
+		"""
+
+		entry = self.entries.pop(function, None)
+		if entry is not None:
+			entry[2] = None
+
+	def next_timeout(self, now=None):
+		"""
+			Calculates how long until the first timer is due
+
+			:Returns:
+				Number of seconds, or None when there are no timers
+		"""
+
+		heap = self.heap
+		while heap and heap[0][2] is None:
+			heapq.heappop(heap)
+
+		if not heap:
+			return None
+
+		if now is None:
+			now = monotonic()
+
+		return max(heap[0][0] - now, 0)
+
+	def run_due(self, call, now=None):
+		"""
+			Calls all timers which are due, and schedules their next call
+
+			:Args:
+				* call (function): Called with each due timer, should return
+				  False when the timer was skipped because it's still running
+				* now (float): Current monotonic time
+		"""
+
+		if now is None:
+			now = monotonic()
+
+		heap = self.heap
+		due = []
+		while heap and heap[0][0] <= now:
+			entry = heapq.heappop(heap)
+			if entry[2] is not None:
+				due.append(entry)
+
+		for entry in due:
+			fire_at, seq, function, deadline = entry
+			if function is None or self.entries.get(function) is not entry:
+				# Removed or re-added by an earlier timer in this run
+				continue
+
+			info = function.timer
+			info.lag = now - fire_at
+			deadline += info.seconds
+			if deadline <= now and info.seconds > 0:
+				missed = int((now - deadline) // info.seconds) + 1
+				deadline += missed * info.seconds
+				info.missed += missed
+
+			# Reschedule first, so the timer can remove itself
+			self.schedule(function, deadline)
+
+			try:
+				if call(function) is False:
+					info.skipped += 1
+				else:
+					info.calls += 1
+			except Exception:
+				traceback.print_exc()
+
+	def __len__(self):
+		return len(self.entries)
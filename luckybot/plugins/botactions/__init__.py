@@ -87,8 +87,11 @@ class BotActions(Plugin):
 				'prefix': event.server.info['prefix']
 			}
 
+		if 'connection_class' in event.server.info:
+			info['connection_class'] = event.server.info['connection_class']
+
 		server = IRCServerConnection(**info)
-		self.bot.servers.append(server)
+		self.bot.add_server(server)
 
 		event.channel.pm(self.language('added_server'))
 
@@ -121,12 +124,15 @@ class BotActions(Plugin):
 
 		args = event.message.bot_args.split()
 		error = False
+		channels = []
 		for channel in args:
 			if not channel.startswith('#'):
 				errors = True
 				continue
 
-			event.server.send(event.server.protocol.join(channel))
+			channels.append(channel)
+
+		event.server.protocol.joins.join(channels)
 
 		if error:
 			event.user.notice(self.language('invalid_channels'))
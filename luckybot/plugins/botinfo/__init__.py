@@ -9,6 +9,7 @@ commands, uptime, credits and more.
 .. moduleauthor:: Lucas van Dijk <info@return1.net>
 """
 
+from luckybot import user_path
 from luckybot.plugin import Plugin, TYPE_COMMAND
 from luckybot.plugin.decorators import command, serverevent
 from luckybot.protocols.irc import Format
@@ -77,6 +78,50 @@ class BotInfo(Plugin):
 
 		self.send_to_channel = ""
 
+	@command('handlerstats')
+	def handlerstats(self, event):
+		"""
+			Shows the slowest plugin handlers, or writes the statistics
+			of all handlers to a file
+
+			Usage: !handlerstats [plugin], !handlerstats dump or !handlerstats reset
+		"""
+
+		if not event.user.is_allowed('admin'):
+			event.user.notice(self.language('permission_denied'))
+			return
+
+		instrumentation = self.bot.plugins.instrumentation
+		args = event.message.bot_args
+
+		if args == 'dump':
+			path = user_path(datetime.now().strftime('handler_stats-%Y%m%d-%H%M%S.json'))
+			instrumentation.dump(path)
+			event.user.notice(self.language('handler_stats_dumped', path=path))
+			return
+
+		if args == 'reset':
+			instrumentation.reset()
+			event.user.notice(self.language('handler_stats_reset'))
+			return
+
+		stats = instrumentation.get_stats(args or None)
+		if not stats:
+			event.user.notice(self.language('no_handler_stats'))
+			return
+
+		for handler in stats[:10]:
+			event.user.pm(self.language('handler_stats',
+				plugin=handler.plugin,
+				handler=handler.name,
+				calls=handler.calls,
+				errors=handler.errors,
+				total=round(handler.total, 3),
+				average=round(handler.average * 1000, 2),
+				p99=round(handler.percentile(0.99) * 1000, 2),
+				max=round(handler.max * 1000, 2)
+			))
+
 	@command(['help', 'info'])
 	def help(self, event):
 		"""
@@ -11,7 +11,7 @@ outputs it to the channel.
 
 from xml.etree import ElementTree
 from luckybot.plugin import Plugin
-from luckybot.plugin.decorators import command
+from luckybot.plugin.decorators import command, background
 from luckybot.protocols.irc import Format
 from gameserver.db import Server
 from sqlalchemy.orm import sessionmaker
@@ -72,6 +72,7 @@ class GameserverPlugin(Plugin):
 		Server.metadata.bind = self.bot.db_engine
 		Server.metadata.create_all()
 
+	@background
 	@command('gameserver')
 	def get_gameserver_stats(self, event):
 		"""
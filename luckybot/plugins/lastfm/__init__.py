@@ -28,15 +28,18 @@ class LastFMInfo(object):
 		This class can be used to get Last.FM profile data
 	"""
 
-	def __init__(self, username):
+	def __init__(self, username, urlopen=None):
 		"""
 			Initializes the class
 
 			@type username: string
 			@param username: The username of the profile you want to get data from
+			@type urlopen: function
+			@param urlopen: Function to open URLs with, defaults to urllib2.urlopen
 		"""
 
 		self.username = username
+		self.urlopen = urlopen or urllib.urlopen
 
 	def _get_xml(self, url):
 		"""
@@ -49,7 +52,7 @@ class LastFMInfo(object):
 			@return: An Element object
 		"""
 
-		data = urllib.urlopen(url)
+		data = self.urlopen(url)
 
 		try:
 			tree = ElementTree.ElementTree(file=data)
@@ -176,33 +179,22 @@ class LastFMPlugin(Plugin):
 			event.user.send_notice(self.language('no_user_given'))
 
 	def send_now_playing(self, user, event):
-		lastfm = LastFMInfo(user)
-		try:
-			track = lastfm.now_playing()
-		except:
-			import traceback
-			traceback.print_exc()
-			event.channel.pm(self.language('user_not_found'))
-		else:
+		lastfm = LastFMInfo(user, self.bot.http.urlopen)
+
+		def show_track(track):
 			if not track:
 				event.channel.pm(self.language('no_track_playing'))
 			else:
 				track.update(user=user)
 				event.channel.pm(self.language('now_playing', **track))
 
-
-		del lastfm
+		self.bot.http.run(lastfm.now_playing).add_callbacks(show_track,
+			lambda error: self.user_not_found(error, event))
 
 	def send_top_tracks(self, user, event):
-		lastfm = LastFMInfo(user)
+		lastfm = LastFMInfo(user, self.bot.http.urlopen)
 
-		try:
-			tracks = lastfm.get_top_tracks()
-		except:
-			import traceback
-			traceback.print_exc()
-			event.channel.pm(self.language('user_not_found'))
-		else:
+		def show_tracks(tracks):
 			if len(tracks) == 0:
 				event.channel.pm(self.language('no_top_tracks'))
 			else:
@@ -214,16 +206,13 @@ class LastFMPlugin(Plugin):
 					event.channel.pm(self.language('top_tracks_tpl', **track))
 					i += 1
 
+		self.bot.http.run(lastfm.get_top_tracks).add_callbacks(show_tracks,
+			lambda error: self.user_not_found(error, event))
+
 	def send_top_artists(self, user, event):
-		lastfm = LastFMInfo(user)
+		lastfm = LastFMInfo(user, self.bot.http.urlopen)
 
-		try:
-			artists = lastfm.get_top_artists()
-		except:
-			import traceback
-			traceback.print_exc()
-			event.channel.pm(self.language('user_not_found'))
-		else:
+		def show_artists(artists):
 			if len(artists) == 0:
 				event.channel.pm(self.language('no_top_artists'))
 			else:
@@ -235,16 +224,13 @@ class LastFMPlugin(Plugin):
 					event.channel.pm(self.language('top_artists_tpl', **artist))
 					i += 1
 
+		self.bot.http.run(lastfm.get_top_artists).add_callbacks(show_artists,
+			lambda error: self.user_not_found(error, event))
+
 	def send_weekly_top(self, user, event):
-		lastfm = LastFMInfo(user)
+		lastfm = LastFMInfo(user, self.bot.http.urlopen)
 
-		try:
-			tracks = lastfm.get_weekly_tracks()
-		except:
-			import traceback
-			traceback.print_exc()
-			event.channel.pm(self.language('user_not_found'))
-		else:
+		def show_tracks(tracks):
 			if len(tracks) == 0:
 				event.channel.pm(self.language('no_top_tracks'))
 			else:
@@ -255,3 +241,13 @@ class LastFMPlugin(Plugin):
 					track.update(num=i)
 					event.channel.pm(self.language('top_tracks_tpl', **track))
 					i += 1
+
+		self.bot.http.run(lastfm.get_weekly_tracks).add_callbacks(show_tracks,
+			lambda error: self.user_not_found(error, event))
+
+	def user_not_found(self, error, event):
+		"""
+			Called when retreiving last.fm data failed
+		"""
+
+		event.channel.pm(self.language('user_not_found'))
@@ -36,12 +36,15 @@ from luckybot.plugin.decorators import command
 from luckybot.protocols.irc import Format
 
 class BaseRadio(object):
+	def __init__(self, urlopen=None):
+		self.urlopen = urlopen or urllib.urlopen
+
 	@classmethod
-	def get_radio(self, name):
+	def get_radio(self, name, urlopen=None):
 		classes = self.__subclasses__()
 		for subclass in classes:
 			if subclass.__name__.lower() == ('radio_%s' % name).lower():
-				return subclass()
+				return subclass(urlopen)
 
 		return False
 
@@ -52,7 +55,7 @@ class BaseRadio(object):
 		raise NotImplementedError
 
 	def get_xml(self, url):
-		data = urllib.urlopen(url)
+		data = self.urlopen(url)
 		contents = data.read()
 
 		contents = contents.replace('&', '&amp;')
@@ -108,7 +111,7 @@ class Radio_3fm(BaseRadio):
 
 class Radio_FreshFM(BaseRadio):
 	def now_playing(self):
-		http = urllib.urlopen('http://www.freshfm.nl')
+		http = self.urlopen('http://www.freshfm.nl')
 		contents = http.read()
 
 		regexp = r"<br/><p>(.*?)</p>\s+</div>"
@@ -148,28 +151,28 @@ class RadioPlugin(Plugin):
 			For all available radio stations use !radiolist
 		"""
 		
-		radio = BaseRadio.get_radio(event.message.bot_args)
+		radio = BaseRadio.get_radio(event.message.bot_args, self.bot.http.urlopen)
 
 		if radio:
-			try:
-				np = radio.now_playing()
-			except urllib.HTTPError as e:
-				event.channel.pm(str(e))
-				return
-			
-			vars = {
-				'radio': event.message.bot_args.lower().title(),
-				'artist': np[0] or self.language('unknown'),
-				'title': np[1] or self.language('unknown')
-			}
-			
-			tpl = 'now_playing'
-			
-			if len(np) == 3:
-				vars.update(program=np[2])
-				tpl = 'now_playing_program'
-			
-			event.channel.pm(self.language(tpl, **vars))
+			def show_now_playing(np):
+				vars = {
+					'radio': event.message.bot_args.lower().title(),
+					'artist': np[0] or self.language('unknown'),
+					'title': np[1] or self.language('unknown')
+				}
+
+				tpl = 'now_playing'
+
+				if len(np) == 3:
+					vars.update(program=np[2])
+					tpl = 'now_playing_program'
+
+				event.channel.pm(self.language(tpl, **vars))
+
+			def show_error(error):
+				event.channel.pm(str(error))
+
+			self.bot.http.run(radio.now_playing).add_callbacks(show_now_playing, show_error)
 		else:
 			event.channel.pm(self.language('radio_does_not_exists'))
 
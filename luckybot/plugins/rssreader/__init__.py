@@ -26,8 +26,16 @@ class RssFeed(object):
 		Reads RSS feeds
 	"""
 
-	def __init__(self, url):
+	def __init__(self, url, urlopen=None):
+		"""
+			:Args:
+				* url (string): The feed URL
+				* urlopen (function): Function to open the URL with,
+				  defaults to :func:`urllib2.urlopen`
+		"""
+
 		self.url = url
+		self.urlopen = urlopen or urllib.urlopen
 
 	def get_xml(self, url):
 		"""
@@ -40,7 +48,7 @@ class RssFeed(object):
 				Element object (of elementtree module)
 		"""
 
-		data = urllib.urlopen(url)
+		data = self.urlopen(url)
 
 		try:
 			tree = ElementTree.ElementTree(file=data)
@@ -167,19 +175,23 @@ class Rss(Plugin):
 				if not url:
 					raise RssException, self.language('not_found')
 
-			rss = RssFeed(url)
-
-			if event.message.bot_command == 'last':
-				rss.read(1)
-			else:
-				rss.read(3)
+			rss = RssFeed(url, self.bot.http.urlopen)
+		except RssException as error:
+			event.channel.pm(error)
+			return
 
+		def show_feed(result):
 			event.channel.pm(self.language('rss_title', title=rss.title))
 			for item in rss:
 				event.channel.pm(self.language('rss_item', title=item['title'], url=item['link']))
-		except RssException as error:
+
+		def show_error(error):
 			event.channel.pm(error)
 
+		# Fetch the feed in the background
+		max = 1 if event.message.bot_command == 'last' else 3
+		self.bot.http.run(rss.read, max).add_callbacks(show_feed, show_error)
+
 	@command('feeds')
 	def list_feeds(self, event):
 		"""
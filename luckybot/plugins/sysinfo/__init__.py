@@ -11,7 +11,7 @@ is running on.
 """
 
 from luckybot.plugin import Plugin
-from luckybot.plugin.decorators import command
+from luckybot.plugin.decorators import command, background
 from luckybot.protocols.irc import Format
 
 import os
@@ -30,6 +30,7 @@ class SysinfoPlugin(Plugin):
 		'website': 'http://www.wiebelt.nl'
 	}
 
+	@background
 	@command('server_load')
 	def load(self, event):
 		"""
@@ -41,6 +42,7 @@ class SysinfoPlugin(Plugin):
 
 		event.channel.pm(self.language('load_tmpl', output=load[0]))
 
+	@background
 	@command('os')
 	def get_os(self, event):
 		"""
@@ -68,6 +70,7 @@ class SysinfoPlugin(Plugin):
 
 		event.channel.pm(send)
 
+	@background
 	@command('usage')
 	def get_usage(self, event):
 		"""
@@ -89,6 +92,7 @@ class SysinfoPlugin(Plugin):
 		send = self.language('usage_tmpl', cpu=cpu, memory=memory)
 		event.channel.pm(send)
 
+	@background
 	@command('cpu')
 	def get_cpu(self, event):
 		"""
@@ -139,6 +143,7 @@ class SysinfoPlugin(Plugin):
 		send = self.language(tmpl, model=cpu_model, freq=cpu_mhz, cache=cpu_cache, temp=cpu_temp)
 		event.channel.pm(send)
 
+	@background
 	@command('memory')
 	def get_memory(self, event):
 		# Get memory usage information
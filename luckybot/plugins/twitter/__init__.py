@@ -39,13 +39,14 @@ class TwitterSearch(TweetsReader):
 		Wrapper for twitter search API
 	"""
 
-	def __init__(self, query, refresh_url=None):
+	def __init__(self, query, refresh_url=None, urlopen=None):
 		"""
 			Initializes a new twitter search
 		"""
 
 		self.query = query
 		self.refresh_url = refresh_url
+		self.urlopen = urlopen or urllib2.urlopen
 
 	def search(self, query_string):
 		"""
@@ -53,7 +54,7 @@ class TwitterSearch(TweetsReader):
 		"""
 
 		print query_string
-		page = urllib2.urlopen('http://search.twitter.com/search.json' + query_string)
+		page = self.urlopen('http://search.twitter.com/search.json' + query_string)
 		data = json.loads(page.read())
 
 		if 'refresh_url' in data:
@@ -86,13 +87,14 @@ class TwitterUser(TweetsReader):
 		Wrapper for user timeline API
 	"""
 
-	def __init__(self, user):
+	def __init__(self, user, urlopen=None):
 		self.user = user
 		self.last_id = None
+		self.urlopen = urlopen or urllib2.urlopen
 
 	def refresh(self):
 		if last_id:
-			page = urllib2.urlopen('http://api.twitter.com/1/statuses/user_timeline.json?trim_user=1&screen_name=' + self.user + '&since_id=' + self.last_id)
+			page = self.urlopen('http://api.twitter.com/1/statuses/user_timeline.json?trim_user=1&screen_name=' + self.user + '&since_id=' + self.last_id)
 			data = json.loads(page.read())
 
 			if data:
@@ -107,7 +109,7 @@ class TwitterUser(TweetsReader):
 			Get tweets from given user
 		"""
 
-		page = urllib2.urlopen('http://api.twitter.com/1/statuses/user_timeline.json?trim_user=1&screen_name=' + self.user)
+		page = self.urlopen('http://api.twitter.com/1/statuses/user_timeline.json?trim_user=1&screen_name=' + self.user)
 		data = json.loads(page.read())
 
 		if data:
@@ -138,17 +140,9 @@ class TwitterPlugin(Plugin):
 			event.channel.pm(self.language('twit_syntax'))
 			return
 
-		user = TwitterUser(event.message.bot_args)
-		try:
-			tweets = user.get_tweets()
-		except urllib2.HTTPError as e:
-			if e.code == 401:
-				event.channel.pm(self.language('tweets_private', user=event.message.bot_args))
-			elif e.code == 404:
-				event.channel.pm(self.language('user_not_found', user=event.message.bot_args))
-			else:
-				raise
-		else:
+		user = TwitterUser(event.message.bot_args, self.bot.http.urlopen)
+
+		def show_tweets(tweets):
 			if tweets:
 				event.channel.pm(self.language('tweets_from', user=event.message.bot_args))
 
@@ -161,6 +155,16 @@ class TwitterPlugin(Plugin):
 			else:
 				event.channel.pm(self.language('no_tweets_found'))
 
+		def show_error(error):
+			if isinstance(error, urllib2.HTTPError) and error.code == 401:
+				event.channel.pm(self.language('tweets_private', user=event.message.bot_args))
+			elif isinstance(error, urllib2.HTTPError) and error.code == 404:
+				event.channel.pm(self.language('user_not_found', user=event.message.bot_args))
+			else:
+				event.channel.pm(str(type(error)) + ', ' + str(error))
+
+		self.bot.http.run(user.get_tweets).add_callbacks(show_tweets, show_error)
+
 	@command('twitnotify')
 	def add_notification(self, event):
 		"""
@@ -181,41 +185,45 @@ class TwitterPlugin(Plugin):
 				raise TwitterException, self.language('twitnotify_syntax')
 
 			# Check search query/user
-			try:
-				if notify_type == 'search':
-					tweets = TwitterSearch(name)
-				else:
-					tweets = TwitterUser(name)
+			if notify_type == 'search':
+				tweets = TwitterSearch(name, urlopen=self.bot.http.urlopen)
+			else:
+				tweets = TwitterUser(name, self.bot.http.urlopen)
+		except TwitterException as error:
+			event.channel.pm(error)
+			return
 
-				results = tweets.get_tweets()
-			except:
+		def add(results):
+			try:
+				if not results:
+					raise TwitterException, self.language('no_tweets_found')
+
+				# Check if the name is already in use
+				if self.bot.db_session.query(Notification).filter_by(name=name, type=notify_type).count() > 0:
+					raise TwitterException, self.language('name_in_use')
+
+				notification = Notification()
+				notification.name = name
+				notification.type = notify_type
+				notification.server = event.server.info['hostname']
+				notification.channel = str(event.channel)
+				notification.is_approved = event.user.is_allowed('moderator')
+				self.bot.db_session.add(notification)
+				self.bot.db_session.commit()
+
+				event.user.notice(self.language('twitnotify_added'))
+			except TwitterException as error:
+				event.channel.pm(error)
+			except Exception as error:
+				event.channel.pm(str(type(error)) + ', ' + str(error))
 				import traceback
 				traceback.print_exc()
-				results = None
-
-			if not results:
-				raise TwitterException, self.language('no_tweets_found')
 
-			# Check if the name is already in use
-			if self.bot.db_session.query(Notification).filter_by(name=name, type=notify_type).count() > 0:
-				raise TwitterException, self.language('name_in_use')
+		def show_error(error):
+			print "Twitter error: %s" % error
+			event.channel.pm(self.language('no_tweets_found'))
 
-			notification = Notification()
-			notification.name = name
-			notification.type = notify_type
-			notification.server = event.server.info['hostname']
-			notification.channel = str(event.channel)
-			notification.is_approved = event.user.is_allowed('moderator')
-			self.bot.db_session.add(notification)
-			self.bot.db_session.commit()
-
-			event.user.notice(self.language('twitnotify_added'))
-		except TwitterException as error:
-			event.channel.pm(error)
-		except Exception as error:
-			event.channel.pm(str(type(error)) + ', ' + str(error))
-			import traceback
-			traceback.print_exc()
+		self.bot.http.run(tweets.get_tweets).add_callbacks(add, show_error)
 
 	@command('reviewnotify')
 	def review_notify(self, event):
@@ -257,7 +265,7 @@ class TwitterPlugin(Plugin):
 		else:
 			event.user.notice(self.language('review_syntax'))
 
-	@timer(30)
+	@timer(30, jitter=5)
 	def notification_poller(self):
 		"""
 			Polls every 30 seconds to check for new twitter messages
@@ -267,49 +275,82 @@ class TwitterPlugin(Plugin):
 			# Query DB
 			notifications = self.bot.db_session.query(Notification).filter_by(is_approved=True)
 
+			retreivers = []
 			for notification in notifications:
 				if notification.type == 'search':
-					retreiver = TwitterSearch(notification.name)
+					retreiver = TwitterSearch(notification.name, urlopen=self.bot.http.urlopen)
 				else:
-					retreiver = TwitterUser(notification.name)
-
-				tweets = retreiver.get_tweets()
-				if tweets:
-					# Only send latest tweet
-					# parse date
-					timestamp = parse(tweets[0]['created_at']).replace(tzinfo=gettz('Europe/London'))
-
-					if notification.last_check:
-						last_check = notification.last_check.replace(tzinfo=gettz('Europe/London'))
-					else:
-						last_check = datetime.now(gettz('Europe/London')) - timedelta(minutes=10)
-
-					if timestamp > last_check:
-						server = self.bot.get_server(notification.server)
-						timestamp = timestamp.astimezone(gettz())
-
-						if server and server.connection.is_alive:
-							if notification.type == 'search':
-								server.send(server.protocol.pm(notification.channel, self.language('new_tweet_search',
-									text=tweets[0]['text'].encode('utf-8'),
-									date=timestamp.strftime('%a, %d %b %Y %H:%M:%S'),
-									query=unquote_plus(notification.name)
-								)))
-							else:
-								server.send(server.protocol.pm(notification.channel, self.language('new_tweet_user',
-									text=tweets[0]['text'].encode('utf-8'),
-									date=timestamp.strftime('%a, %d %b %Y %H:%M:%S'),
-									user=unquote_plus(notification.name)
-								)))
-
-							notification.last_check = datetime.now()
-							self.bot.db_session.commit()
+					retreiver = TwitterUser(notification.name, self.bot.http.urlopen)
+
+				retreivers.append((notification, retreiver))
+
+			if not retreivers:
+				return None
+
+			# Fetch the tweets in the background, the next poll is skipped
+			# while this is still running
+			future = self.bot.http.run(self.fetch_tweets, retreivers)
+			future.add_callbacks(self.notify_all)
+
+			return future
 		except Exception as e:
 			import traceback
 			traceback.print_exc()
 
+	def fetch_tweets(self, retreivers):
+		"""
+			Fetches the tweets for each notification, runs in the
+			HTTP client pool
+		"""
 
+		results = []
+		for notification, retreiver in retreivers:
+			try:
+				results.append((notification, retreiver.get_tweets()))
+			except Exception:
+				import traceback
+				traceback.print_exc()
 
+		return results
 
+	def notify_all(self, results):
+		for notification, tweets in results:
+			self.notify(notification, tweets)
 
+	def notify(self, notification, tweets):
+		"""
+			Sends the latest tweet for a notification, if it's new
+		"""
+
+		if not tweets:
+			return
+
+		# Only send latest tweet
+		# parse date
+		timestamp = parse(tweets[0]['created_at']).replace(tzinfo=gettz('Europe/London'))
 
+		if notification.last_check:
+			last_check = notification.last_check.replace(tzinfo=gettz('Europe/London'))
+		else:
+			last_check = datetime.now(gettz('Europe/London')) - timedelta(minutes=10)
+
+		if timestamp > last_check:
+			server = self.bot.get_server(notification.server)
+			timestamp = timestamp.astimezone(gettz())
+
+			if server and server.connection.is_alive:
+				if notification.type == 'search':
+					server.send(server.protocol.pm(notification.channel, self.language('new_tweet_search',
+						text=tweets[0]['text'].encode('utf-8'),
+						date=timestamp.strftime('%a, %d %b %Y %H:%M:%S'),
+						query=unquote_plus(notification.name)
+					)))
+				else:
+					server.send(server.protocol.pm(notification.channel, self.language('new_tweet_user',
+						text=tweets[0]['text'].encode('utf-8'),
+						date=timestamp.strftime('%a, %d %b %Y %H:%M:%S'),
+						user=unquote_plus(notification.name)
+					)))
+
+				notification.last_check = datetime.now()
+				self.bot.db_session.commit()
@@ -3,7 +3,8 @@ mod:`luckybot.processes` - Processes manager
 ============================================
 
 This class manages all processes used for each connection to the IRC server.
-When one fails, it automatically restarts it.
+When one fails, it automatically restarts it, waiting longer after each
+failed attempt so a dead network doesn't cause a reconnect storm.
 
 .. module:: luckybot.processes
    :synopsis: Handles processes for connections to the irc servers
@@ -11,18 +12,213 @@ When one fails, it automatically restarts it.
 .. moduleauthor:: Lucas van Dijk <info@return1.net>
 """
 
+from luckybot.network.reactor import Reactor
+from luckybot.plugin.scheduler import monotonic
+from collections import deque
+import random
+import socket
+import traceback
+
+# Circuit breaker states of a server: connected and stable, waiting
+# before the next connection attempt, and connected but not stable yet
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half-open'
+
+class ServerHealth(object):
+	"""
+		Keeps track of the connection attempts and failures of one server
+	"""
+
+	def __init__(self, now):
+		self.state = STATE_HALF_OPEN
+		self.since = now
+		self.time_in_state = {STATE_CLOSED: 0.0, STATE_OPEN: 0.0, STATE_HALF_OPEN: 0.0}
+
+		self.next_attempt = now
+		self.connected_at = now
+		self.failures = 0
+		self.recent_failures = deque()
+
+		# Metrics
+		self.attempts = 0
+		self.total_failures = 0
+		self.crash_loops = 0
+		self.crash_looping = False
+
+	def set_state(self, state, now):
+		self.time_in_state[self.state] += now - self.since
+		self.state = state
+		self.since = now
+
+class Supervisor(object):
+	"""
+		Decides when a server may reconnect.
+
+		After a connection is lost the server waits, with an exponential
+		backoff and random jitter. A new connection has to stay up for a
+		while before the failures are forgotten. When a server fails too
+		often in a short time, it's considered to be in a crash loop and
+		waits the maximum delay.
+	"""
+
+	def __init__(self, base_delay=1.0, max_delay=300.0, stable_after=60.0,
+		crash_threshold=5, crash_window=600.0):
+		"""
+			Constructor
+
+			:Args:
+				* base_delay (float): Seconds to wait after the first failure
+				* max_delay (float): Maximum number of seconds to wait
+				* stable_after (float): Seconds a connection has to stay up
+				  before its failures are reset
+				* crash_threshold (int): Number of failures within the crash
+				  window which counts as a crash loop
+				* crash_window (float): Seconds to look back for crash loops
+		"""
+
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.stable_after = stable_after
+		self.crash_threshold = crash_threshold
+		self.crash_window = crash_window
+
+		self.servers = {}
+
+	def get(self, server, now=None):
+		if server not in self.servers:
+			self.servers[server] = ServerHealth(monotonic() if now is None else now)
+
+		return self.servers[server]
+
+	def connecting(self, server, now):
+		"""
+			Records a connection attempt
+		"""
+
+		health = self.get(server, now)
+		health.attempts += 1
+		health.connected_at = now
+		health.set_state(STATE_HALF_OPEN, now)
+
+	def alive(self, server, now):
+		"""
+			Marks a connection as stable when it has been up long enough
+		"""
+
+		health = self.get(server, now)
+		if health.state == STATE_HALF_OPEN and now - health.connected_at >= self.stable_after:
+			health.failures = 0
+			health.crash_looping = False
+			health.set_state(STATE_CLOSED, now)
+
+	def lost(self, server, now):
+		"""
+			Records a lost connection or failed attempt, and calculates
+			when the next attempt may be made
+
+			:Returns:
+				The number of seconds to wait
+		"""
+
+		health = self.get(server, now)
+		health.failures += 1
+		health.total_failures += 1
+
+		recent = health.recent_failures
+		recent.append(now)
+		while recent and recent[0] < now - self.crash_window:
+			recent.popleft()
+
+		if len(recent) >= self.crash_threshold:
+			if not health.crash_looping:
+				health.crash_loops += 1
+				health.crash_looping = True
+
+			delay = self.max_delay
+		else:
+			delay = min(self.max_delay, self.base_delay * 2 ** (health.failures - 1))
+
+		# Wait between half and the full delay, so servers which failed
+		# at the same moment don't all reconnect at the same moment
+		delay = random.uniform(delay / 2, delay)
+
+		health.next_attempt = now + delay
+		health.set_state(STATE_OPEN, now)
+
+		return delay
+
+	def time_until_attempt(self, server, now):
+		"""
+			Returns the number of seconds until a waiting server may
+			reconnect, or None when it isn't waiting
+		"""
+
+		health = self.servers.get(server)
+		if health is None or health.state != STATE_OPEN:
+			return None
+
+		return max(health.next_attempt - now, 0)
+
+	def stats(self, now=None):
+		"""
+			Returns the health metrics of each server
+
+			:Returns:
+				A dict with the server name as key, and a dict with the
+				state, seconds spent in each state, number of connection
+				attempts, failures and crash loops as value
+		"""
+
+		if now is None:
+			now = monotonic()
+
+		result = {}
+		for server, health in self.servers.iteritems():
+			time_in_state = dict(health.time_in_state)
+			time_in_state[health.state] += now - health.since
+
+			result[str(server)] = {
+				'state': health.state,
+				'time_in_state': time_in_state,
+				'attempts': health.attempts,
+				'failures': health.total_failures,
+				'consecutive_failures': health.failures,
+				'crash_loops': health.crash_loops,
+				'crash_looping': health.crash_looping,
+				'next_attempt': max(health.next_attempt - now, 0) if health.state == STATE_OPEN else None
+			}
+
+		return result
+
 class ProcessManager(object):
 	"""
 		This class manages each subprocess for any socket
 	"""
 
-	def __init__(self, servers, keep_alive=True):
+	# Maximum time to wait for activity, so dead processes are noticed
+	max_wait = 5.0
+
+	# Maximum number of bytes read and lines handled for each server in
+	# one iteration, so a flooding server can't starve the others
+	recv_budget = 64 * 1024
+	line_budget = 500
+
+	def __init__(self, servers, keep_alive=True, reactor=None, supervisor=None, connect_stagger=0.0):
 		"""
 			Constructor, initializes the manager
 
 			:Args:
 				* servers (list): List of server connections to watch
 				* keep_alive (bool): Keep processes alive?
+				* reactor (:class:`luckybot.network.reactor.Reactor`): The
+				  reactor to wait on, a new one is created when not given
+				* supervisor (:class:`Supervisor`): Decides when servers
+				  may reconnect, one with the default settings is created
+				  when not given
+				* connect_stagger (float): Seconds between starting the
+				  connections to the servers, all servers connect at once
+				  when 0
 
 			.. seealso
 			   :mod:`luckybot.connections`
@@ -30,21 +226,84 @@ class ProcessManager(object):
 
 		self.servers = servers
 		self.keep_alive = keep_alive
+		self.reactor = reactor if reactor else Reactor()
+		self.supervisor = supervisor if supervisor else Supervisor()
+
+		self.connect_stagger = connect_stagger
+		self.next_start = 0
+
+		# The server which is handled first rotates each iteration
+		self.offset = 0
 
-	def check_processes(self):
+	def check_processes(self, timeout=None):
 		"""
-			Checks each process if they're still alive, or any data is
-			waiting to be read.
+			Waits until any connection has data available, and checks
+			each process if they're still alive.
 
 			If the process is dead, it optionally restarts it again.
+
+			:Args:
+				* timeout (float): Maximum time to wait for data, for
+				  example until the next plugin timer is due
 		"""
 
-		num_alive = 0
+		if timeout is None or timeout > self.max_wait:
+			timeout = self.max_wait
+
+		now = monotonic()
 		for server in self.servers:
+			# Left over data should be handled right away
+			if server.has_pending:
+				timeout = 0
+				break
+
+			# Wake up when the next server may be started
+			if not hasattr(server, 'started'):
+				timeout = min(timeout, max(self.next_start - now, 0))
+				continue
+
+			# Wake up when queued lines may be sent
+			send_timeout = server.send_queue.next_timeout()
+			if send_timeout is not None and send_timeout < timeout:
+				timeout = send_timeout
+
+			# Wake up when a server may reconnect
+			wait = self.supervisor.time_until_attempt(server, now)
+			if wait is not None and wait < timeout:
+				timeout = wait
+
+		self.reactor.poll(timeout)
+
+		servers = self.servers
+		if len(servers) > 1:
+			self.offset = (self.offset + 1) % len(servers)
+			servers = servers[self.offset:] + servers[:self.offset]
+
+		now = monotonic()
+		num_alive = 0
+		for server in servers:
+			if not hasattr(server, 'started'):
+				if now >= self.next_start:
+					self.start_server(server, now)
+					self.next_start = now + self.connect_stagger
+
+				num_alive += 1
+				continue
+
+			wait = self.supervisor.time_until_attempt(server, now)
+			if wait is not None:
+				# Waiting before reconnecting
+				if wait <= 0:
+					self.start_server(server, now)
+
+				num_alive += 1
+				continue
+
 			alive = server.connection.is_alive
 
 			if alive:
-				data = server.recv()
+				server.send_queue.flush()
+				data = server.recv(self.recv_budget, self.line_budget)
 
 				if data.startswith("QUIT"):
 					try:
@@ -52,21 +311,43 @@ class ProcessManager(object):
 						server.close()
 					except socket.error:
 						print "Exception while closing"
-						import traceback
 						traceback.print_exc()
-						pass
 
 					alive = False
 				else:
+					self.supervisor.alive(server, now)
 					num_alive += 1
 
-			if not alive:
-				if (hasattr(server, 'started') and self.keep_alive) or not hasattr(server, 'started'):
-					# Make sure its really closed, and respawn the process again
-					server.connect()
-					server.started = True
+			if not alive and self.keep_alive:
+				delay = self.supervisor.lost(server, now)
+				print "Connection to %s lost, reconnecting in %.1f seconds" % (server, delay)
 
-					# Asume connection is successfull
-					num_alive += 1
+				num_alive += 1
 
 		return num_alive
+
+	def start_server(self, server, now):
+		"""
+			Connects to a server, a failed attempt is handled like a lost
+			connection
+		"""
+
+		server.started = True
+		self.supervisor.connecting(server, now)
+
+		try:
+			# Make sure its really closed, and respawn the process again
+			server.connect()
+		except socket.error:
+			traceback.print_exc()
+
+			delay = self.supervisor.lost(server, now)
+			print "Could not connect to %s, retrying in %.1f seconds" % (server, delay)
+
+	def stats(self):
+		"""
+			Returns the connection health metrics of each server, see
+			:meth:`Supervisor.stats`
+		"""
+
+		return self.supervisor.stats()
@@ -10,5 +10,6 @@ All available classes for handling protocols are located here
 .. moduleauthor:: Lucas van Dijk <info@return1.net>
 """
 
-from luckybot.protocols.irc import IRCProtocol
+from luckybot.protocols.irc import IRCProtocol, IRCMessage
 from luckybot.protocols.base import Message
+from luckybot.protocols.state import StateTracker
@@ -15,20 +15,15 @@ class Message(object):
 		This class represents a line from the server
 	"""
 
+	__slots__ = ('type', 'raw')
+
 	RAW_MESSAGE = 0
 	USER_MESSAGE = 1
 	SERVER_MESSAGE = 2
 
-	def __init__(self, type, raw, *args, **kwargs):
-		self.data = kwargs
-		self.data['type'] = type
-		self.data['raw'] = raw
-
-	def __getattr__(self, name):
-		if name in self.data:
-			return self.data[name]
-		else:
-			raise AttributeError, "No attribute named %s" % name
+	def __init__(self, type, raw):
+		self.type = type
+		self.raw = raw
 
 	def __str__(self):
 		return self.raw
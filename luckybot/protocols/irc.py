@@ -12,12 +12,279 @@ an abstraction of the IRC protocol.
 """
 
 from luckybot.protocols.base import Message
+from luckybot.protocols.state import StateTracker
+from luckybot.protocols.isupport import ISupport
+from luckybot.protocols.joins import JoinManager
 
 import re
+from datetime import datetime
 
 class IRCException(Exception):
 	pass
 
+# Characters a channel name can start with
+CHANNEL_PREFIXES = '#&'
+
+# IRCv3 capabilities requested from the server when it supports them
+CAPABILITIES = ('batch', 'message-tags', 'server-time', 'multi-prefix', 'away-notify')
+
+# Batch types which are delivered to plugins as one event, instead of
+# each line on its own
+BULK_BATCH_TYPES = ('netsplit', 'netjoin')
+
+# Escape sequences used in IRCv3 message tag values
+TAG_ESCAPES = {
+	':': ';',
+	's': ' ',
+	'\\': '\\',
+	'r': '\r',
+	'n': '\n'
+}
+
+def unescape_tag_value(value):
+	"""
+		Unescapes an IRCv3 message tag value
+
+		:Args:
+			* value (string): The escaped value
+	"""
+
+	if '\\' not in value:
+		return value
+
+	parts = []
+	i = 0
+	while i < len(value):
+		char = value[i]
+		if char == '\\':
+			i += 1
+			if i < len(value):
+				parts.append(TAG_ESCAPES.get(value[i], value[i]))
+		else:
+			parts.append(char)
+
+		i += 1
+
+	return ''.join(parts)
+
+class IRCMessage(Message):
+	"""
+		A parsed line from an IRC server.
+
+		The nickname, hostname, channel and bot command are only derived
+		from the line when they're accessed for the first time. The
+		`bot_command` and `bot_args` attributes only exist when the line
+		is a bot command, so use `hasattr` to check for one.
+	"""
+
+	__slots__ = ('tags_raw', 'sender', 'command', 'params', 'args', 'message',
+		'cmd_prefix', 'chantypes', '_tags', '_nick', '_realname', '_hostname',
+		'_channel', '_bot_command', '_bot_args')
+
+	def __init__(self, type, raw, sender, command, params, args, message,
+			tags_raw=None, cmd_prefix=None, chantypes=CHANNEL_PREFIXES):
+		"""
+			Creates a new message, normally called by
+			:meth:`IRCProtocol.parse_line`
+
+			:Args:
+				* type (int): Message type
+				* raw (string): The line as received from the server
+				* sender (string): The message prefix, without colon
+				* command (string): IRC command or reply code
+				* params (string): Everything after the command
+				* args (list): The separate parameters
+				* message (string): The trailing parameter
+				* tags_raw (string): The unparsed IRCv3 tags
+				* cmd_prefix (string): Prefix for bot commands
+				* chantypes (string): Characters channel names start with
+		"""
+
+		Message.__init__(self, type, raw)
+
+		self.sender = sender
+		self.command = command
+		self.params = params
+		self.args = args
+		self.message = message
+		self.tags_raw = tags_raw
+		self.cmd_prefix = cmd_prefix
+		self.chantypes = chantypes
+
+	@property
+	def tags(self):
+		"""
+			Dictionary of IRCv3 message tags
+		"""
+
+		try:
+			return self._tags
+		except AttributeError:
+			pass
+
+		self._tags = {}
+		if self.tags_raw:
+			for tag in self.tags_raw.split(';'):
+				if not tag:
+					continue
+
+				key, sep, value = tag.partition('=')
+				self._tags[key] = unescape_tag_value(value) if sep else True
+
+		return self._tags
+
+	@property
+	def server_time(self):
+		"""
+			The time the server received the message, from the IRCv3
+			server-time tag, as UTC datetime. None when the tag is missing.
+		"""
+
+		if not self.tags_raw or 'time' not in self.tags:
+			return None
+
+		value = self.tags['time']
+		try:
+			time = datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+		except (TypeError, ValueError):
+			return None
+
+		# Optional fraction of a second
+		if value[19:20] == '.':
+			fraction = value[20:].rstrip('Z')[:6]
+			if fraction.isdigit():
+				time = time.replace(microsecond=int(fraction.ljust(6, '0')))
+
+		return time
+
+	def _split_sender(self):
+		"""
+			Splits a nick!user@host prefix in its parts
+		"""
+
+		if self.type != Message.USER_MESSAGE:
+			self._nick = self._realname = self._hostname = None
+			return
+
+		user, sep, self._hostname = self.sender.partition('@')
+		self._nick, sep, self._realname = user.partition('!')
+
+	@property
+	def nick(self):
+		try:
+			return self._nick
+		except AttributeError:
+			self._split_sender()
+			return self._nick
+
+	@property
+	def realname(self):
+		try:
+			return self._realname
+		except AttributeError:
+			self._split_sender()
+			return self._realname
+
+	@property
+	def hostname(self):
+		try:
+			return self._hostname
+		except AttributeError:
+			self._split_sender()
+			return self._hostname
+
+	@property
+	def channel(self):
+		"""
+			The channel the message was sent to, or the nickname of the
+			sender if it was sent directly to us
+		"""
+
+		try:
+			return self._channel
+		except AttributeError:
+			pass
+
+		if self.args and self.args[0][:1] in self.chantypes:
+			self._channel = self.args[0]
+		else:
+			self._channel = self.nick
+
+		return self._channel
+
+	def _split_bot_command(self):
+		"""
+			Checks if the message calls a bot command
+		"""
+
+		self._bot_command = self._bot_args = None
+
+		if self.type != Message.USER_MESSAGE or self.command != 'PRIVMSG' or not self.cmd_prefix:
+			return
+
+		message = self.message
+		length = len(self.cmd_prefix)
+		if message[0:length] == self.cmd_prefix:
+			space_pos = message.find(' ', length)
+			if space_pos == -1:
+				space_pos = len(message)
+
+			self._bot_command = message[length:space_pos]
+			self._bot_args = message[space_pos+1:]
+
+	@property
+	def bot_command(self):
+		try:
+			bot_command = self._bot_command
+		except AttributeError:
+			self._split_bot_command()
+			bot_command = self._bot_command
+
+		if bot_command is None:
+			raise AttributeError, "Message is not a bot command"
+
+		return bot_command
+
+	@property
+	def bot_args(self):
+		try:
+			bot_args = self._bot_args
+		except AttributeError:
+			self._split_bot_command()
+			bot_args = self._bot_args
+
+		if bot_args is None:
+			raise AttributeError, "Message is not a bot command"
+
+		return bot_args
+
+class Batch(object):
+	"""
+		Messages the server grouped with an IRCv3 BATCH, for example all
+		QUIT messages caused by a netsplit
+	"""
+
+	__slots__ = ('reference', 'type', 'params', 'message', 'messages')
+
+	def __init__(self, reference, type, params, message):
+		"""
+			:Args:
+				* reference (string): Reference tag of the batch
+				* type (string): Batch type, like netsplit or netjoin
+				* params (list): Parameters of the batch type
+				* message (:class:`IRCMessage`): The message which started
+				  the batch
+		"""
+
+		self.reference = reference
+		self.type = type
+		self.params = params
+		self.message = message
+		self.messages = []
+
+	def __len__(self):
+		return len(self.messages)
+
 class IRCProtocol(object):
 	"""
 		This class provides an abstraction of the IRC protocol, and handles
@@ -38,6 +305,26 @@ class IRCProtocol(object):
 		"""
 
 		self.server = server
+		self.last_line = None
+		self.last_message = None
+
+		# Features and limits of the server
+		self.isupport = ISupport()
+
+		# Channels we're in, and their users
+		self.state = StateTracker(self.server.info.get('nickname'), self.isupport)
+
+		# Channels we should be in
+		self.joins = JoinManager(self)
+
+		# Capabilities the server offers, and the ones which are enabled
+		self.available_caps = {}
+		self.capabilities = set()
+		self.negotiating = False
+
+		# Open batches, by reference tag
+		self.batches = {}
+
 		self.server.add_listener('connected', self.start)
 		self.server.add_listener('data_in', self.on_line)
 
@@ -47,6 +334,21 @@ class IRCProtocol(object):
 			the initial commands for an IRC server
 		"""
 
+		self.isupport.reset()
+		self.state.update_modes()
+		self.state.clear()
+		self.state.nickname = self.server.info['nickname']
+		self.joins.reset()
+
+		self.available_caps = {}
+		self.capabilities = set()
+		self.batches = {}
+
+		# Servers which don't know CAP ignore it and just register us,
+		# otherwise registration waits until we've sent CAP END
+		self.negotiating = True
+		self.server.send("CAP LS 302")
+
 		self.server.send("USER %s 1 * :LuckyBot" % self.server.info['nickname'])
 		self.server.send(self.set_nick(self.server.info['nickname']))
 
@@ -62,106 +364,211 @@ class IRCProtocol(object):
 
 		message = self.parse_line(data)
 
+		if message is None:
+			return
+
+		self.state.update(message)
+		self.joins.update(message)
+
+		batch = self.get_batch(message)
+		if batch is not None:
+			batch.messages.append(message)
+
 		# Check for PING
-		if message.raw.startswith("PING"):
-			self.server.send("PONG :%s" % message.raw[6:])
+		if message.command == "PING":
+			self.server.send("PONG :%s" % message.message)
 
 		if message.type == Message.SERVER_MESSAGE:
-			if hasattr(self, 'on_command_%s' % message.command):
-				func = getattr(self, 'on_command_%s' % message.command.lower())
+			func = getattr(self, 'on_command_%s' % message.command.lower(), None)
+			if func:
 				func(message)
 
-	def on_command_001(self, message):
+	def wanted_caps(self):
+		"""
+			Capabilities we'd like to enable, by default
+			:data:`CAPABILITIES`, or the comma separated `capabilities`
+			directive of the server
+		"""
+
+		if self.server.info.get('capabilities'):
+			return [cap.strip() for cap in self.server.info['capabilities'].split(',') if cap.strip()]
+
+		return CAPABILITIES
+
+	def request_caps(self, offered):
+		"""
+			Requests the capabilities we want from the given ones
+
+			:Returns:
+				True when a request was sent
+		"""
+
+		wanted = [cap for cap in self.wanted_caps() if cap in offered and cap not in self.capabilities]
+		if not wanted:
+			return False
+
+		self.server.send("CAP REQ :%s" % ' '.join(wanted))
+		return True
+
+	def end_negotiation(self):
+		if self.negotiating:
+			self.negotiating = False
+			self.server.send("CAP END")
+
+	def on_command_cap(self, message):
 		"""
-			Called when we successfully authenticated with the server,
-			which means we can join channels
+			Handles capability negotiation, see
+			http://ircv3.net/specs/core/capability-negotiation.html
 		"""
 
-		# Join the channels, if given
-		if 'channels' in self.server.info:
-			channels = self.server.info['channels'].split(',')
-			for channel in channels:
-				self.server.send(self.join(channel.strip()))
+		if len(message.args) < 3:
+			return
+
+		subcommand = message.args[1].upper()
+		caps = message.args[-1].split()
+
+		if subcommand in ('LS', 'NEW'):
+			for cap in caps:
+				name, sep, value = cap.partition('=')
+				self.available_caps[name] = value
+
+			# A multiline LS reply has an asterisk before the last argument
+			if subcommand == 'LS' and len(message.args) > 3 and message.args[2] == '*':
+				return
+
+			offered = caps if subcommand == 'NEW' else self.available_caps
+			if not self.request_caps(offered):
+				self.end_negotiation()
+		elif subcommand == 'ACK':
+			for cap in caps:
+				if cap[:1] == '-':
+					self.capabilities.discard(cap[1:])
+				else:
+					self.capabilities.add(cap.lstrip('~='))
+
+			self.end_negotiation()
+		elif subcommand == 'NAK':
+			self.end_negotiation()
+		elif subcommand == 'DEL':
+			for cap in caps:
+				self.capabilities.discard(cap)
+				self.available_caps.pop(cap, None)
+
+	def on_command_batch(self, message):
+		"""
+			Starts or ends a batch. Messages of batches with a type in
+			:data:`BULK_BATCH_TYPES` are collected, and emitted as one
+			batch signal when the batch ends.
+		"""
+
+		if not message.args or len(message.args[0]) < 2:
+			return
+
+		reference = message.args[0][1:]
+		if message.args[0][0] == '+':
+			if len(message.args) > 1 and message.args[1].lower() in BULK_BATCH_TYPES:
+				self.batches[reference] = Batch(reference, message.args[1].lower(),
+					message.args[2:], message)
+		else:
+			batch = self.batches.pop(reference, None)
+			if batch is not None:
+				self.server.emit_signal('batch', batch)
+
+	def get_batch(self, message):
+		"""
+			Returns the collected batch the given message is part of, or
+			None when the message should be handled on its own
+		"""
+
+		if not self.batches or message is None or not message.tags_raw:
+			return None
+
+		return self.batches.get(message.tags.get('batch'))
+
+	def on_command_005(self, message):
+		"""
+			RPL_ISUPPORT, the server tells which features it supports
+		"""
+
+		if len(message.args) < 3:
+			return
+
+		self.isupport.parse(message.args[1:-1])
+		self.state.update_modes()
+
+	def on_command_376(self, message):
+		"""
+			Called at the end of the MOTD, which means we're registered
+			and the server told us its limits, so we can join channels
+		"""
+
+		self.joins.join_all()
+
+	# No MOTD
+	on_command_422 = on_command_376
 
 	def parse_line(self, data):
 		"""
 			Parses a line from the server into an object with useful
 			attributes.
 
+			The last parsed line is cached, so the protocol and the
+			plugins can share the same message object.
+
 			:Args:
-				* data (string): THe line received from the server
+				* data (string): The line received from the server
 		"""
 
 		if len(data) == 0:
 			return None
 
-		if data[0] == ':':
-			# Get all message parts
-			regexp = re.compile(r'\:(.*?) ([a-z0-9]+) (.*?)\r?\n', re.I)
-			match = regexp.match(data)
+		if data is self.last_line:
+			return self.last_message
 
-			message_from = match.group(1)
-			command = match.group(2)
-			params = match.group(3).strip()
+		line = data.rstrip('\r\n')
 
-			return_obj = None
+		tags_raw = None
+		if line[:1] == '@':
+			tags_raw, sep, line = line[1:].partition(' ')
+			line = line.lstrip(' ')
 
-			# Check from who this message came
-			if message_from.find("@") != -1:
-				# Message came from a user
-				# Retreive nick etc
-				regexp2 = re.compile(r'(.*?)!(.*?)@(.*?)$')
-				match2 = regexp2.match(message_from)
+		sender = None
+		if line[:1] == ':':
+			sender, sep, line = line[1:].partition(' ')
+			line = line.lstrip(' ')
 
-				# Get the channel
-				regexp = re.compile(r'#([^ ]+)')
+		command, sep, params = line.partition(' ')
+		params = params.lstrip(' ')
 
-				match = regexp.match(params)
-				# Set channel to the nickname if it was a private message
-				# to the bot
-				if match:
-					channel = '#%s' % match.group(1)
-				else:
-					channel = match2.group(1)
-
-				args = {
-					'sender': message_from,
-					'command': command,
-					'params': params,
-					'nick': match2.group(1),
-					'realname': match2.group(2),
-					'hostname': match2.group(3),
-					'message': params[params.find(':')+1:],
-					'channel': channel
-				}
-
-				cmd_prefix = self.server.info['prefix']
-				message = args['message']
-
-				# Check if a bot command is called
-				if command == 'PRIVMSG' and message[0:len(cmd_prefix)] == cmd_prefix:
-					space_pos = message.find(' ', len(cmd_prefix))
-					if space_pos == -1:
-						space_pos = len(message)
-
-					bot_command = message[len(cmd_prefix):space_pos]
-					args['bot_command'] = bot_command
-					args['bot_args'] = message[space_pos+1:]
-
-				return_obj = Message(Message.USER_MESSAGE, data, **args)
-			else:
-				args = {
-					'sender': message_from,
-					'command': command,
-					'params': params,
-					'message': params[params.find(':')+1:]
-				}
+		# Split the parameters, the last one may contain spaces when
+		# prefixed with a colon
+		if params[:1] == ':':
+			args = [params[1:]]
+			message = args[0]
+		else:
+			middle, sep, trailing = params.partition(' :')
+			args = middle.split()
 
-				return_obj = Message(Message.SERVER_MESSAGE, data, **args)
+			if sep:
+				args.append(trailing)
+				message = trailing
+			else:
+				message = params
 
-			return return_obj
+		if sender is None:
+			type = Message.RAW_MESSAGE
+		elif '@' in sender:
+			type = Message.USER_MESSAGE
 		else:
-			return Message(Message.RAW_MESSAGE, data)
+			type = Message.SERVER_MESSAGE
+
+		message = IRCMessage(type, data, sender, command, params, args,
+			message, tags_raw, self.server.info.get('prefix'), self.isupport.chantypes)
+
+		self.last_line = data
+		self.last_message = message
+
+		return message
 
 	def pm(self, dest, message):
 		"""
@@ -205,7 +612,7 @@ class IRCProtocol(object):
 				* channel (string): The channel to join
 		"""
 
-		if not channel.startswith('#'):
+		if not self.isupport.is_channel(channel):
 			channel = '#%s' % (channel)
 
 		return "JOIN %s" % channel
@@ -218,7 +625,7 @@ class IRCProtocol(object):
 				* channel (string): The channel to leave
 		"""
 
-		if not channel.startswith('#'):
+		if not self.isupport.is_channel(channel):
 			channel = '#%s' % channel
 
 		return "PART %s" % channel
@@ -0,0 +1,192 @@
+"""
+:mod:`luckybot.protocols.isupport` - Server features
+====================================================
+
+This module parses the RPL_ISUPPORT (005) reply, in which the server
+tells which features and limits it has, and provides case folding of
+nicknames and channels according to the server's casemapping.
+
+.. module:: luckybot.protocols.isupport
+   :synopsis: Server features
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+
+import string
+
+# Translation tables for each casemapping, rfc1459 also considers []\~
+# the uppercase versions of {}|^
+CASEMAP_TABLES = {
+	'ascii': string.maketrans(string.ascii_uppercase, string.ascii_lowercase),
+	'rfc1459': string.maketrans(string.ascii_uppercase + '[]\\~', string.ascii_lowercase + '{}|^'),
+	'strict-rfc1459': string.maketrans(string.ascii_uppercase + '[]\\', string.ascii_lowercase + '{}|')
+}
+
+DEFAULT_CASEMAPPING = 'rfc1459'
+
+def casefold(name, casemapping=DEFAULT_CASEMAPPING):
+	"""
+		Converts a nickname or channel to the key used to compare it
+
+		:Args:
+			* name (string): The nickname or channel
+			* casemapping (string): Casemapping of the server
+	"""
+
+	if isinstance(name, unicode):
+		return name.lower()
+
+	return name.translate(CASEMAP_TABLES.get(casemapping, CASEMAP_TABLES[DEFAULT_CASEMAPPING]))
+
+def unescape_value(value):
+	"""
+		Unescapes the \\xHH sequences ISUPPORT values may contain
+	"""
+
+	if '\\x' not in value:
+		return value
+
+	parts = value.split('\\x')
+	result = [parts[0]]
+	for part in parts[1:]:
+		try:
+			result.append(chr(int(part[:2], 16)) + part[2:])
+		except ValueError:
+			result.append('\\x' + part)
+
+	return ''.join(result)
+
+class ISupport(object):
+	"""
+		Features the server advertised in RPL_ISUPPORT, with the defaults
+		from RFC 1459 for everything it didn't mention
+	"""
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		"""
+			Goes back to the defaults, for example after a reconnect
+		"""
+
+		# All tokens the server sent, name -> value
+		self.tokens = {}
+
+		self.casemapping = DEFAULT_CASEMAPPING
+		self.table = CASEMAP_TABLES[DEFAULT_CASEMAPPING]
+		self.chantypes = '#&'
+		self.prefix = ('ov', '@+')
+
+		# Channel mode types: lists, always a parameter, a parameter when
+		# set, and never a parameter
+		self.chanmodes = ('beI', 'k', 'l', 'imnpst')
+
+		# Maximum number of mode changes in one MODE command
+		self.modes = 3
+
+		# Maximum length of a line, including CRLF
+		self.linelen = 512
+
+		# Maximum number of targets of PRIVMSG and NOTICE, and per
+		# command, None means unlimited
+		self.maxtargets = 1
+		self.targmax = {}
+
+	def parse(self, tokens):
+		"""
+			Parses the tokens of an RPL_ISUPPORT reply
+
+			:Args:
+				* tokens (list): The arguments between our nickname and
+				  the trailing text
+		"""
+
+		for token in tokens:
+			if token[:1] == '-':
+				self.tokens.pop(token[1:].upper(), None)
+				continue
+
+			name, sep, value = token.partition('=')
+			name = name.upper()
+			value = unescape_value(value)
+			self.tokens[name] = value
+
+			handler = getattr(self, 'parse_%s' % name.lower(), None)
+			if handler:
+				try:
+					handler(value)
+				except ValueError:
+					pass
+
+	def parse_casemapping(self, value):
+		value = value.lower()
+		if value in CASEMAP_TABLES:
+			self.casemapping = value
+			self.table = CASEMAP_TABLES[value]
+
+	def parse_chantypes(self, value):
+		self.chantypes = value
+
+	def parse_prefix(self, value):
+		if not value:
+			self.prefix = ('', '')
+			return
+
+		if value[:1] != '(' or ')' not in value:
+			return
+
+		modes, sep, symbols = value[1:].partition(')')
+		if len(modes) == len(symbols):
+			self.prefix = (modes, symbols)
+
+	def parse_chanmodes(self, value):
+		types = value.split(',')
+		if len(types) >= 4:
+			self.chanmodes = tuple(types[:4])
+
+	def parse_modes(self, value):
+		self.modes = int(value) if value else None
+
+	def parse_linelen(self, value):
+		self.linelen = int(value)
+
+	def parse_maxtargets(self, value):
+		self.maxtargets = int(value) if value else None
+
+	def parse_targmax(self, value):
+		self.targmax = {}
+		for item in value.split(','):
+			command, sep, limit = item.partition(':')
+			if command:
+				self.targmax[command.upper()] = int(limit) if limit else None
+
+	def lower(self, name):
+		"""
+			Converts a nickname or channel to the key used to compare it,
+			according to the casemapping of the server
+		"""
+
+		if isinstance(name, unicode):
+			return name.lower()
+
+		return name.translate(self.table)
+
+	def is_channel(self, name):
+		return name[:1] in self.chantypes
+
+	def max_targets(self, command):
+		"""
+			Returns the maximum number of targets the given command may
+			have, or None when only the line length limits it. MAXTARGETS
+			only applies to PRIVMSG and NOTICE.
+		"""
+
+		command = command.upper()
+		if command in self.targmax:
+			return self.targmax[command]
+
+		if command in ('PRIVMSG', 'NOTICE'):
+			return self.maxtargets
+
+		return None
@@ -0,0 +1,264 @@
+"""
+:mod:`luckybot.protocols.joins` - Channel joining
+=================================================
+
+This module joins channels with as few JOIN commands as the server
+allows, and keeps track of the channels the bot should be in, so they
+can be joined again after a reconnect or a kick.
+
+.. module:: luckybot.protocols.joins
+   :synopsis: Channel joining
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+
+from collections import OrderedDict
+import time
+
+# Replies telling a JOIN failed, including the common ones servers
+# send for forwarded (470), invalid (479), TLS only (480, 489) and oper
+# only (520) channels
+JOIN_ERRORS = frozenset(['403', '405', '437', '470', '471', '473', '474', '475',
+	'476', '477', '479', '480', '489', '520'])
+
+def parse_channels(value):
+	"""
+		Parses a comma separated list of channels, where each channel
+		can be followed by its key, like `#public,#secret key`
+
+		:Returns:
+			A list of (channel, key) tuples, key is None for channels
+			without a key
+	"""
+
+	channels = []
+	for item in value.split(','):
+		parts = item.split()
+		if parts:
+			channels.append((parts[0], parts[1] if len(parts) > 1 else None))
+
+	return channels
+
+class JoinManager(object):
+	"""
+		Packs channels in comma separated JOIN commands, within the line
+		length and target limits of the server, and measures the time
+		between sending the JOIN and receiving the end of the NAMES list
+		of each channel.
+	"""
+
+	commands = frozenset(['JOIN', 'PART', 'KICK', '366']) | JOIN_ERRORS
+
+	def __init__(self, protocol):
+		"""
+			Constructor
+
+			:Args:
+				* protocol (:class:`luckybot.protocols.irc.IRCProtocol`): The
+				  protocol of the server
+		"""
+
+		self.protocol = protocol
+		self.isupport = protocol.isupport
+		self.state = protocol.state
+
+		info = protocol.server.info
+		self.rejoin = str(info.get('rejoin_on_kick', 'true')).lower() in ('1', 'yes', 'true', 'on')
+
+		# Seconds to wait for the server to answer a JOIN, after which
+		# the channel may be joined again
+		self.timeout = float(info.get('join_timeout', 60))
+
+		# Channels we should be in, folded name -> (name, key), in the
+		# order they were configured or joined
+		self.channels = OrderedDict()
+		for name, key in parse_channels(info.get('channels', '')):
+			if not self.isupport.is_channel(name):
+				name = '#%s' % name
+
+			self.channels[self.isupport.lower(name)] = (name, key)
+
+		# Metrics
+		self.latency = {}
+		self.failed = {}
+		self.joined = 0
+
+		self.reset()
+
+	def reset(self):
+		"""
+			Forgets the joins in progress, for example after a reconnect
+		"""
+
+		# Folded name -> (name, key, time the JOIN was sent)
+		self.pending = {}
+
+	def expire(self, now):
+		"""
+			Gives up on the joins the server didn't answer in time, or
+			answered with a reply we don't know of
+		"""
+
+		for folded, request in self.pending.items():
+			if now - request[2] >= self.timeout:
+				del self.pending[folded]
+				self.failed[folded] = 'timeout'
+
+	def pack(self, channels):
+		"""
+			Creates JOIN commands for the given channels. Channels with a
+			key are put first, as the keys are matched by position.
+
+			:Args:
+				* channels (list): List of (channel, key) tuples
+
+			:Returns:
+				A list of lines
+		"""
+
+		channels = [channel for channel in channels if channel[1]] + \
+			[channel for channel in channels if not channel[1]]
+
+		max_targets = self.isupport.max_targets('JOIN')
+		max_length = self.isupport.linelen - 2
+
+		lines = []
+		names = []
+		keys = []
+		length = len('JOIN ')
+
+		for name, key in channels:
+			extra = len(name) + 1
+			if key:
+				extra += len(key) + 1
+
+			if names and (length + extra > max_length or
+					(max_targets is not None and len(names) >= max_targets)):
+				lines.append(self.format(names, keys))
+				names = []
+				keys = []
+				length = len('JOIN ')
+
+			names.append(name)
+			if key:
+				keys.append(key)
+
+			length += extra
+
+		if names:
+			lines.append(self.format(names, keys))
+
+		return lines
+
+	def format(self, names, keys):
+		if keys:
+			return 'JOIN %s %s' % (','.join(names), ','.join(keys))
+
+		return 'JOIN %s' % ','.join(names)
+
+	def join(self, channels):
+		"""
+			Joins the given channels
+
+			:Args:
+				* channels (list): Channel names, or (channel, key) tuples
+		"""
+
+		now = time.time()
+		self.expire(now)
+
+		requests = []
+		for channel in channels:
+			name, key = (channel, None) if isinstance(channel, basestring) else channel
+			if not self.isupport.is_channel(name):
+				name = '#%s' % name
+
+			folded = self.isupport.lower(name)
+
+			# Use the key we know of when none was given
+			if key is None and folded in self.channels:
+				key = self.channels[folded][1]
+
+			if folded in self.pending:
+				continue
+
+			self.pending[folded] = (name, key, now)
+			requests.append((name, key))
+
+		for line in self.pack(requests):
+			self.protocol.server.send(line)
+
+	def join_all(self):
+		"""
+			Joins all channels we should be in, called when we're
+			registered with the server
+		"""
+
+		self.join(self.channels.values())
+
+	def update(self, message):
+		"""
+			Updates the joins with a message from the server
+
+			:Args:
+				* message (:class:`luckybot.protocols.irc.IRCMessage`): The message
+		"""
+
+		if message.command not in self.commands or not message.args:
+			return
+
+		command = message.command
+		if command == 'JOIN':
+			if self.state.is_me(message.nick):
+				for name in message.args[0].split(','):
+					folded = self.isupport.lower(name)
+					request = self.pending.get(folded)
+					key = request[1] if request else self.channels.get(folded, (name, None))[1]
+					self.channels[folded] = (name, key)
+		elif command == 'PART':
+			if self.state.is_me(message.nick):
+				for name in message.args[0].split(','):
+					self.channels.pop(self.isupport.lower(name), None)
+		elif command == 'KICK':
+			if len(message.args) < 2:
+				return
+
+			if any(self.state.is_me(nick) for nick in message.args[1].split(',')):
+				if self.rejoin:
+					self.join([message.args[0]])
+				else:
+					self.channels.pop(self.isupport.lower(message.args[0]), None)
+		elif len(message.args) > 1:
+			folded = self.isupport.lower(message.args[1])
+			request = self.pending.pop(folded, None)
+			if request is None:
+				return
+
+			if command == '366':
+				self.latency[folded] = time.time() - request[2]
+				self.failed.pop(folded, None)
+				self.joined += 1
+			else:
+				self.failed[folded] = command
+
+	def stats(self):
+		"""
+			Returns the join metrics
+
+			:Returns:
+				A dict with the number of joins waiting for the server,
+				completed and failed joins, the average and maximum join
+				latency in seconds, and the latency per channel
+		"""
+
+		self.expire(time.time())
+		latencies = self.latency.values()
+
+		return {
+			'pending': len(self.pending),
+			'joined': self.joined,
+			'failed': len(self.failed),
+			'avg_latency': sum(latencies) / len(latencies) if latencies else 0.0,
+			'max_latency': max(latencies) if latencies else 0.0,
+			'latency': dict(self.latency)
+		}
@@ -0,0 +1,402 @@
+"""
+:mod:`luckybot.protocols.state` - Channel state tracking
+========================================================
+
+This module keeps track of the channels the bot is in, and the users in
+those channels, using the messages the server sends anyway.
+
+Each nickname is stored once, with a small integer ID, and channels only
+store the IDs of their members. A user in many channels costs one string,
+a nickname change only updates one place, and a nickname is forgotten as
+soon as it isn't in any of our channels anymore. Names are compared
+using the casemapping of the server.
+
+.. module:: luckybot.protocols.state
+   :synopsis: Channel state tracking
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+
+from luckybot.protocols.isupport import ISupport
+
+class Channel(object):
+	"""
+		A channel we're in
+	"""
+
+	__slots__ = ('name', 'members', 'names')
+
+	def __init__(self, name):
+		self.name = name
+
+		# Nick ID -> string with the member modes of that user
+		self.members = {}
+
+		# Users collected from NAMES replies, until the end of the list
+		self.names = None
+
+	def __len__(self):
+		return len(self.members)
+
+class StateTracker(object):
+	"""
+		Keeps track of channel membership and member modes.
+
+		:meth:`update` should be called with every message from the
+		server, all lookups are dictionary lookups.
+	"""
+
+	# Commands the tracker is interested in
+	commands = frozenset(['001', '353', '366', 'JOIN', 'PART', 'KICK',
+		'QUIT', 'NICK', 'MODE'])
+
+	def __init__(self, nickname=None, isupport=None):
+		"""
+			Constructor
+
+			:Args:
+				* nickname (string): Our own nickname
+				* isupport (:class:`luckybot.protocols.isupport.ISupport`):
+				  Features of the server, for the casemapping and modes
+		"""
+
+		self.nickname = nickname
+		self.isupport = isupport if isupport else ISupport()
+		self.lower = self.isupport.lower
+		self.update_modes()
+
+		self.clear()
+
+	def clear(self):
+		"""
+			Forgets all channels and users, for example after a reconnect
+		"""
+
+		self.channels = {}
+
+		# Lowercase nickname -> ID, and per ID the nickname and the
+		# number of channels the user is in
+		self.ids = {}
+		self.nicks = []
+		self.refcounts = []
+		self.free_ids = []
+
+	def update_modes(self):
+		"""
+			Takes the member modes, their prefix symbols, and the channel
+			modes with parameters from the server features. Called when
+			the server sent RPL_ISUPPORT.
+		"""
+
+		self.prefix_modes, self.prefix_symbols = self.isupport.prefix
+		self.symbol_modes = dict(zip(self.prefix_symbols, self.prefix_modes))
+
+		chanmodes = self.isupport.chanmodes
+		self.param_modes = chanmodes[0] + chanmodes[1]
+		self.set_param_modes = chanmodes[2]
+
+	def is_me(self, nick):
+		return self.nickname is not None and self.lower(nick) == self.lower(self.nickname)
+
+	def acquire(self, nick):
+		"""
+			Looks up the ID of a nickname, and adds a reference to it.
+			IDs of forgotten nicknames are reused.
+		"""
+
+		key = self.lower(nick)
+		id = self.ids.get(key)
+
+		if id is None:
+			if type(nick) is str:
+				nick = intern(nick)
+
+			if self.free_ids:
+				id = self.free_ids.pop()
+				self.nicks[id] = nick
+				self.refcounts[id] = 0
+			else:
+				id = len(self.nicks)
+				self.nicks.append(nick)
+				self.refcounts.append(0)
+
+			self.ids[key] = id
+
+		self.refcounts[id] += 1
+		return id
+
+	def release(self, id):
+		"""
+			Removes a reference to a nickname ID, and forgets the
+			nickname when it's not in any channel anymore
+		"""
+
+		self.refcounts[id] -= 1
+		if self.refcounts[id] <= 0:
+			del self.ids[self.lower(self.nicks[id])]
+			self.nicks[id] = None
+			self.free_ids.append(id)
+
+	def add_member(self, channel, nick, modes=''):
+		id = self.ids.get(self.lower(nick))
+		if id is not None and id in channel.members:
+			channel.members[id] = modes
+			return
+
+		channel.members[self.acquire(nick)] = modes
+
+	def remove_member(self, channel, id):
+		if channel.members.pop(id, None) is not None:
+			self.release(id)
+
+	def remove_channel(self, name):
+		channel = self.channels.pop(self.lower(name), None)
+		if channel is None:
+			return
+
+		for id in channel.members:
+			self.release(id)
+
+		channel.members = {}
+
+	def update(self, message):
+		"""
+			Updates the state with a message from the server
+
+			:Args:
+				* message (:class:`luckybot.protocols.irc.IRCMessage`): The message
+		"""
+
+		if message.command not in self.commands:
+			return
+
+		getattr(self, 'on_command_%s' % message.command.lower())(message)
+
+	def on_command_001(self, message):
+		if message.args:
+			self.nickname = message.args[0]
+
+	def on_command_353(self, message):
+		"""
+			A part of the NAMES list of a channel, the list replaces the
+			current members when it's complete
+		"""
+
+		if len(message.args) < 3:
+			return
+
+		channel = self.get_channel(message.args[-2])
+		if channel is None:
+			return
+
+		if channel.names is None:
+			channel.names = {}
+
+		symbol_modes = self.symbol_modes
+		for name in message.args[-1].split():
+			modes = ''
+			while name and name[0] in symbol_modes:
+				modes += symbol_modes[name[0]]
+				name = name[1:]
+
+			# With userhost-in-names, the entries are full hostmasks
+			name = name.partition('!')[0]
+			if name:
+				channel.names[self.lower(name)] = (name, intern(modes))
+
+	def on_command_366(self, message):
+		if len(message.args) < 2:
+			return
+
+		channel = self.get_channel(message.args[1])
+		if channel is None or channel.names is None:
+			return
+
+		names = channel.names
+		channel.names = None
+
+		for id in channel.members.keys():
+			if self.lower(self.nicks[id]) not in names:
+				self.remove_member(channel, id)
+
+		for name, modes in names.itervalues():
+			self.add_member(channel, name, modes)
+
+	def on_command_join(self, message):
+		if not message.args:
+			return
+
+		nick = message.nick
+		for name in message.args[0].split(','):
+			if self.is_me(nick):
+				self.remove_channel(name)
+				channel = self.channels[self.lower(name)] = Channel(name)
+			else:
+				channel = self.get_channel(name)
+
+			if channel is not None:
+				self.add_member(channel, nick)
+
+	def on_command_part(self, message):
+		if not message.args:
+			return
+
+		nick = message.nick
+		for name in message.args[0].split(','):
+			if self.is_me(nick):
+				self.remove_channel(name)
+				continue
+
+			channel = self.get_channel(name)
+			id = self.ids.get(self.lower(nick))
+			if channel is not None and id is not None:
+				self.remove_member(channel, id)
+
+	def on_command_kick(self, message):
+		if len(message.args) < 2:
+			return
+
+		for nick in message.args[1].split(','):
+			if self.is_me(nick):
+				self.remove_channel(message.args[0])
+				continue
+
+			channel = self.get_channel(message.args[0])
+			id = self.ids.get(self.lower(nick))
+			if channel is not None and id is not None:
+				self.remove_member(channel, id)
+
+	def on_command_quit(self, message):
+		if self.is_me(message.nick):
+			self.clear()
+			return
+
+		id = self.ids.get(self.lower(message.nick))
+		if id is None:
+			return
+
+		for channel in self.channels.values():
+			self.remove_member(channel, id)
+
+	def on_command_nick(self, message):
+		old = message.nick
+		new = message.args[0] if message.args else message.message
+		if not new:
+			return
+
+		if self.is_me(old):
+			self.nickname = new
+
+		id = self.ids.pop(self.lower(old), None)
+		if id is None:
+			return
+
+		if type(new) is str:
+			new = intern(new)
+
+		self.nicks[id] = new
+		self.ids[self.lower(new)] = id
+
+	def on_command_mode(self, message):
+		"""
+			Keeps member modes up to date, other channel modes are only
+			parsed to find the parameters belonging to member modes
+		"""
+
+		if len(message.args) < 2:
+			return
+
+		channel = self.get_channel(message.args[0])
+		if channel is None:
+			return
+
+		params = iter(message.args[2:])
+		adding = True
+		for char in message.args[1]:
+			if char == '+':
+				adding = True
+			elif char == '-':
+				adding = False
+			elif char in self.prefix_modes:
+				nick = next(params, None)
+				id = self.ids.get(self.lower(nick)) if nick else None
+				if id is None or id not in channel.members:
+					continue
+
+				modes = channel.members[id].replace(char, '')
+				if adding:
+					# Keep the modes ordered by rank
+					modes = ''.join(mode for mode in self.prefix_modes
+						if mode == char or mode in modes)
+
+				channel.members[id] = intern(modes)
+			elif char in self.param_modes or (adding and char in self.set_param_modes):
+				next(params, None)
+
+	def get_channel(self, name):
+		"""
+			Returns the :class:`Channel` object for the given channel, or
+			None when we're not in it
+		"""
+
+		return self.channels.get(self.lower(name))
+
+	def get_channels(self):
+		"""
+			Returns the names of the channels we're in
+		"""
+
+		return [channel.name for channel in self.channels.values()]
+
+	def get_users(self, name):
+		"""
+			Returns the nicknames of the users in the given channel
+		"""
+
+		channel = self.get_channel(name)
+		if channel is None:
+			return []
+
+		nicks = self.nicks
+		return [nicks[id] for id in channel.members.keys()]
+
+	def get_user_channels(self, nick):
+		"""
+			Returns the names of our channels the given user is in
+		"""
+
+		id = self.ids.get(self.lower(nick))
+		if id is None:
+			return []
+
+		return [channel.name for channel in self.channels.values() if id in channel.members]
+
+	def is_in_channel(self, name, nick):
+		"""
+			Checks if a user is in the given channel
+		"""
+
+		return self.get_modes(name, nick) is not None
+
+	def get_modes(self, name, nick):
+		"""
+			Returns the member modes of a user in a channel, for example
+			'o' for an operator, or None when the user isn't in it
+		"""
+
+		channel = self.get_channel(name)
+		id = self.ids.get(self.lower(nick))
+		if channel is None or id is None:
+			return None
+
+		return channel.members.get(id)
+
+	def has_mode(self, name, nick, mode):
+		"""
+			Checks if a user has the given member mode in a channel
+		"""
+
+		return mode in (self.get_modes(name, nick) or '')
+
+	def __len__(self):
+		return len(self.ids)